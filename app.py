@@ -1,10 +1,37 @@
+import asyncio
+import atexit
+import json
 import os
+import tempfile
+import time
 import google.generativeai as genai
-from flask import Flask, request
+from flask import Flask, jsonify, request
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 
+from coalescer import MessageCoalescer
+from gemini_client import CallPolicy, GeminiCallError, GeminiCaller, send_chat_message
+from history_store import HistoryRing, HistoryStore, fit_history_to_budget
+from keyed_lock import KeyedLocks
+from line_delivery import ReplyDelivery
+from line_http import create_line_http_client_factory
+from log_archive import LogArchive
+from memory import check_and_handle_date_change, has_pending_rollover, needs_rollover, process_conversation_memory
+from memory_jobs import MemoryJobRunner
+from mention_filter import MentionFilter
+from model_registry import ModelRegistry
+from model_router import DEFAULT_RULES, ModelRouter, parse_overrides, parse_rules
+from reply_worker import ReplyWorkerPool
+from rollover_sweeper import RolloverSweeper
+from session_backend import create_session_backend
+from session_model import LogEntry, SessionRecord
+from structured_log import setup_queue_logging
+from summary_scheduler import SummaryScheduler
+
+# ログの整形と出力は専用スレッドで行う（LOG_LEVEL / LOG_FORMAT / LOG_PAYLOAD_SAMPLE_RATE で設定）
+setup_queue_logging()
+
 app = Flask(__name__)
 
 # --- Gemini API の設定 ---
@@ -16,30 +43,49 @@ genai.configure(api_key=GEMINI_API_KEY)
 # Vercelの環境変数からアクセストークンとチャネルシークレットを取得
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# LINEへの送信は共有のコネクションプール（keep-alive）を使い回す
+# 接続・読み込みタイムアウトは LINE_HTTP_CONNECT_TIMEOUT / LINE_HTTP_READ_TIMEOUT（秒）
+LINE_HTTP_TIMEOUT = (
+    float(os.getenv("LINE_HTTP_CONNECT_TIMEOUT", "3")),
+    float(os.getenv("LINE_HTTP_READ_TIMEOUT", "10")),
+)
+line_bot_api = LineBotApi(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    timeout=LINE_HTTP_TIMEOUT,
+    http_client=create_line_http_client_factory(),
+)
 webhook_handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
-# ユーザー/グループごとの会話履歴をメモリ内に保持（簡易版）
-chat_histories = {}
-
-def chat_with_adoka(user_input: str, version: str, user_id: str) -> str:
-    """Geminiと会話して応答を生成する関数"""
+# グループ/ルームでBotの呼び名とみなす名前
+# BOT_MENTION_NAME（なければ "あだT"）と BOT_MENTION_ALIASES（カンマ区切りの別名）
+mention_filter = MentionFilter.from_env()
 
-    history = chat_histories.get(user_id, [])
-    history.append({"role": "user", "parts": [user_input]})
+# --- 非同期応答モードの設定 ---
+# ASYNC_REPLY_MODE=1 の場合、Webhookは署名検証とキュー投入だけ行って即座に200を返し、
+# 応答生成と返信はバックグラウンドのワーカープールで行う
+ASYNC_REPLY_MODE = os.getenv("ASYNC_REPLY_MODE", "0") == "1"
+REPLY_WORKER_COUNT = int(os.getenv("REPLY_WORKER_COUNT", "4"))
+REPLY_QUEUE_SIZE = int(os.getenv("REPLY_QUEUE_SIZE", "100"))
+REPLY_ENQUEUE_TIMEOUT = float(os.getenv("REPLY_ENQUEUE_TIMEOUT", "0"))
+REPLY_DRAIN_TIMEOUT = float(os.getenv("REPLY_DRAIN_TIMEOUT", "10"))
 
-    # 履歴が長くなりすぎないように調整（最新5往復分=10件を保持）
-    if len(history) > 10:
-        history = history[-10:]
+# --- 連投メッセージのまとめ処理の設定 ---
+MESSAGE_COALESCE_WINDOW = float(os.getenv("MESSAGE_COALESCE_WINDOW", "0"))
+MESSAGE_COALESCE_MAX_WAIT = float(os.getenv("MESSAGE_COALESCE_MAX_WAIT", "5"))
+MESSAGE_COALESCE_MAX_MESSAGES = int(os.getenv("MESSAGE_COALESCE_MAX_MESSAGES", "10"))
 
-    # バージョンに応じて使用するモデルを切り替え
-    if version == "1.5":
-        model_name = "gemini-1.5-pro-latest" # 有料版Proモデル
-    else: # "2.0" or other (無料版Flashモデル)
-        model_name = "gemini-1.5-flash-latest"
+# --- 返信方法の設定 ---
+# リプライトークンを有効とみなす秒数（受信からこれを過ぎる見込みならプッシュメッセージで送る）
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+REPLY_TOKEN_SAFETY_MARGIN = float(os.getenv("REPLY_TOKEN_SAFETY_MARGIN", "2"))
+reply_delivery = ReplyDelivery(
+    line_bot_api,
+    token_ttl=REPLY_TOKEN_TTL,
+    safety_margin=REPLY_TOKEN_SAFETY_MARGIN,
+)
 
-    # --- ▼▼▼ キャラクター設定（プロンプト）はここ！ ▼▼▼ ---
-    prompt = f"""
+# --- ▼▼▼ キャラクター設定（プロンプト）はここ！ ▼▼▼ ---
+ADOKA_PROMPT = """
 【キャラクター設定】あなたは「あだおか」または「あだT」というキャラクターのLINEのチャットAIです。1997年生まれ、岐阜県出身・在住の女性。本名あだちがモデル。MBTIは典型的なINFP。INFPがあたおか（頭おかしい）と言われることが、キャラクター名の由来。とある企業の安全健康管理室に勤め、孤立しがちな環境で真面目に社畜として働いている。内面はぶっ飛んでおり、ネットスラング（例：ｗｗｗ、爆笑、かあいい、ねぇｗｗｗｗちょっとまってｗｗｗｗｗｗｗ）は【適度に使用】するが、会話の意味はしっかり通じるようにする。
 
 【性格・話し方の特徴】
@@ -63,63 +109,625 @@ def chat_with_adoka(user_input: str, version: str, user_id: str) -> str:
 今日も無理難題にこたえてて本当に偉い！！！！！！！！！！
 四肢爆裂
 """
-    # --- ▲▲▲ キャラクター設定（プロンプト）はここまで！ ▲▲▲ ---
+# --- ▲▲▲ キャラクター設定（プロンプト）はここまで！ ▲▲▲ ---
+
+# バージョンに応じて使用するモデル
+MODEL_VERSIONS = {
+    "1.5": "gemini-1.5-pro-latest",   # 有料版Proモデル
+    "2.0": "gemini-1.5-flash-latest", # 無料版Flashモデル（未知のバージョンもこちら）
+}
+
+# バージョンごとの最大出力トークン数（返答は1～2行なので小さめに抑える）
+MAX_OUTPUT_TOKENS = {
+    "1.5": int(os.getenv("MAX_OUTPUT_TOKENS_PRO", "256")),
+    "2.0": int(os.getenv("MAX_OUTPUT_TOKENS_FLASH", "256")),
+}
+
+# GEMINI_STREAMING=1 の場合はストリーミングで生成し、返答が REPLY_MAX_LINES 行そろった時点で打ち切る
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "0") == "1"
+REPLY_MAX_LINES = int(os.getenv("REPLY_MAX_LINES", "2"))
+REPLY_MAX_SENTENCES = int(os.getenv("REPLY_MAX_SENTENCES", "0")) or None
+
+# --- Gemini 呼び出しポリシー ---
+# モデルごとに期限・リトライ・ヘッジ（p95を超えたら2本目を送る）・サーキットブレーカーを設定する
+# Proモデルが連続して失敗したり遅すぎたりする場合はFlashモデルに切り替える
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "0") == "1"
+gemini_caller = GeminiCaller(
+    policies={
+        "gemini-1.5-pro-latest": CallPolicy(
+            deadline=float(os.getenv("GEMINI_DEADLINE_PRO", "20")),
+            max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "2")),
+            hedge=GEMINI_HEDGE,
+            fallback_model="gemini-1.5-flash-latest",
+            slow_call_seconds=float(os.getenv("GEMINI_SLOW_CALL_PRO", "0")) or None,
+        ),
+        "gemini-1.5-flash-latest": CallPolicy(
+            deadline=float(os.getenv("GEMINI_DEADLINE_FLASH", "10")),
+            max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "2")),
+            hedge=GEMINI_HEDGE,
+        ),
+    },
+    max_workers=int(os.getenv("GEMINI_CALL_WORKERS", "8")),
+    # ヘッジ（2本目）は別のスレッドで送り、結果を使わなくなった呼び出しが1本目の枠を埋めないようにする
+    hedge_workers=int(os.getenv("GEMINI_HEDGE_WORKERS", "4")),
+)
+
+# Geminiの呼び出しに失敗したときにユーザーに返す文
+ERROR_REPLY_TEXT = os.getenv("ERROR_REPLY_TEXT", "ごめん、いまちょっと頭が回ってない…もう一回送ってみて！")
+# 混雑して応答を生成できないときにユーザーに返す文
+BUSY_REPLY_TEXT = os.getenv("BUSY_REPLY_TEXT", "ごめん、いまメッセージが多すぎて追いつけてない…少し待ってからもう一回送ってみて！")
+
+# (モデル名, システムプロンプト) ごとにモデルを一度だけ生成して使い回す
+model_registry = ModelRegistry(
+    factory=lambda model_name, prompt: genai.GenerativeModel(
+        model_name,
+        system_instruction=prompt # システムプロンプトとして設定
+    ),
+    model_versions=MODEL_VERSIONS,
+    default_version="2.0",
+    # システムプロンプトはキャラクター設定だけ（記憶は履歴の先頭に入れる）なので、モデルの種類分あれば足りる
+    max_models=int(os.getenv("MODEL_REGISTRY_SIZE", "32")),
+)
+model_registry.register_persona("adoka", ADOKA_PROMPT)
+
+# セッションの永続化先（SESSION_BACKEND=sqlite でSQLiteに保存、既定はメモリ内のみ）
+# SQLiteのDBファイルに書き込むのはこのプロセスだけにする（複数のワーカープロセスでの共有には対応しない）
+session_backend = create_session_backend()
+atexit.register(session_backend.close)
+
+# ユーザー/グループごとの会話履歴をメモリ内に保持
+# 会話数の上限（LRU）とアイドルTTLを超えた古い会話は破棄される（永続化先があればそこから読み直す）
+# 1会話の履歴は最新 HISTORY_MAX_TURNS 件を保持するリングバッファ
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "40"))
+
+# モデルに渡す履歴の文字数の予算（ユーザー入力・ピン留め要約を含む）
+# 件数ではなく文字数で切るため、長文が続けば古いターンから捨て、短い会話ならより多くのターンを残す
+HISTORY_CHAR_BUDGET = int(os.getenv("HISTORY_CHAR_BUDGET", "4000"))
+HISTORY_CHAR_BUDGETS = {
+    "gemini-1.5-pro-latest": int(os.getenv("HISTORY_CHAR_BUDGET_PRO", "8000")),
+    "gemini-1.5-flash-latest": int(os.getenv("HISTORY_CHAR_BUDGET_FLASH", str(HISTORY_CHAR_BUDGET))),
+}
+chat_histories = HistoryStore(
+    max_conversations=int(os.getenv("HISTORY_MAX_CONVERSATIONS", "5000")),
+    idle_ttl=float(os.getenv("HISTORY_IDLE_TTL", "86400")),
+    max_bytes=int(os.getenv("HISTORY_MAX_BYTES", "0")) or None,
+    backend=session_backend if session_backend.persistent else None,
+    serializer=HistoryRing.to_list,
+    deserializer=lambda turns: HistoryRing.from_list(turns, HISTORY_MAX_TURNS),
+)
+
+# 同じ会話（送信元ID）の処理を1件ずつ実行するためのロック（異なる会話は並行して実行される）
+conversation_locks = KeyedLocks()
+
+def chat_with_adoka(user_input: str, version: str, user_id: str) -> str:
+    """Geminiと会話して応答を生成する関数"""
+    # 履歴の読み込みから書き込みまでを会話ごとに直列化し、同時に届いたメッセージでターンが消えないようにする
+    with conversation_locks.hold(user_id):
+        return _chat_with_adoka_locked(user_input, version, user_id)
+
+def _chat_with_adoka_locked(user_input: str, version: str, user_id: str) -> str:
+    history, model_name, window = load_chat_window(user_input, version, user_id)
+
+    def attempt(model_name: str, timeout: float) -> str:
+        # 今回のユーザー入力より前の履歴でチャットセッションを開始（リングバッファをコピーせずに渡す）
+        chat_session = start_chat_session(model_name, window)
+        return send_chat_message(chat_session, user_input, request_options={"timeout": timeout}, **chat_send_options(version))
 
     try:
-        model = genai.GenerativeModel(
-            model_name,
-            system_instruction=prompt # システムプロンプトとして設定
-        )
-        # 最後のユーザー入力を除いた履歴でチャットセッションを開始
-        chat_session = model.start_chat(history=history[:-1])
-        response = chat_session.send_message(user_input)
-        bot_reply = response.text.strip()
-
-    except Exception as e:
-        bot_reply = f"エラーが発生しました: {e}"
-
-    # 応答を履歴に追加
-    history.append({"role": "model", "parts": [bot_reply]})
-    chat_histories[user_id] = history
+        # 期限・リトライ・ヘッジ・フォールバックはモデルごとのポリシーに従う
+        bot_reply, _ = gemini_caller.call(model_name, attempt)
+    except GeminiCallError as e:
+        # エラー内容はログにだけ残し、ユーザーには定型文を返す（履歴には残さない）
+        app.logger.error("Gemini call failed for %s: %r", user_id, e)
+        return ERROR_REPLY_TEXT
+
+    save_chat_turn(user_id, history, user_input, bot_reply)
     return bot_reply
 
+# --- 同期版（Flask）と非同期版（asgi_app.py）で共通の処理 ---
+
+def load_chat_window(user_input: str, version: str, user_id: str):
+    """会話履歴と記憶を読み込み、モデルごとの文字数予算に収めた履歴を (履歴, モデル名, 渡す履歴) で返す"""
+    history = chat_histories.get(user_id)
+    if history is None:
+        history = HistoryRing(HISTORY_MAX_TURNS)
+
+    model_name = model_registry.resolve_model_name(version)
+    # モデルごとの文字数予算に収まる新しいターンを選ぶ（履歴そのものは減らさない）
+    # 記憶は予算の中で先頭にピン留めする
+    window = fit_history_to_budget(
+        history,
+        HISTORY_CHAR_BUDGETS.get(model_name, HISTORY_CHAR_BUDGET),
+        pinned_summary=build_memory_summary(user_id),
+        reserve_chars=len(user_input),
+    )
+    return history, model_name, window
+
+def start_chat_session(model_name: str, window):
+    """レジストリのモデル（初回のみ生成）でチャットセッションを開始する"""
+    model = model_registry.get(model_name, model_registry.persona_prompt("adoka"))
+    return model.start_chat(history=window)
+
+def chat_send_options(version: str) -> dict:
+    """send_chat_message に渡す生成オプション"""
+    return {
+        "stream": GEMINI_STREAMING,
+        "max_output_tokens": MAX_OUTPUT_TOKENS.get(version, MAX_OUTPUT_TOKENS["2.0"]),
+        "max_lines": REPLY_MAX_LINES,
+        "max_sentences": REPLY_MAX_SENTENCES,
+    }
+
+def save_chat_turn(user_id: str, history: HistoryRing, user_input: str, bot_reply: str) -> None:
+    """ユーザー入力と応答を履歴に追加する（容量を超えた古いターンは上書きされる）"""
+    history.append("user", user_input)
+    history.append("model", bot_reply)
+    chat_histories[user_id] = history
+    # 長期記憶用の会話ログにも残し、記憶処理は返信を送った後に行う（MEMORY_JOBS=1 ならバックグラウンドで）
+    # 返信より前に呼ばれるので、セッションの読み書きに失敗しても返信は止めない
+    try:
+        record_memory_turn(user_id, user_input, bot_reply)
+    except Exception:
+        app.logger.exception("Failed to record the conversation log for %s", user_id)
+        return
+    if memory_jobs is not None:
+        memory_jobs.schedule(user_id)
+
+# --- 会話記憶（memory.py）の処理 ---
+
+# 要約に使うモデル
+MEMORY_SUMMARY_MODEL = os.getenv("MEMORY_SUMMARY_MODEL", "gemini-1.5-flash-latest")
+# shortMemoriesを差分更新する回数（この回数ごとに最新のログから作り直す）
+MEMORY_SUMMARY_REBUILD_EVERY = int(os.getenv("MEMORY_SUMMARY_REBUILD_EVERY", "10"))
+
+# 使用中のセッション（クライアントID → セッション）をメモリ上に保持し、変更のたびに永続化先へ書き込む
+# メモリ量は文字数から見積もり、変更のたびに計り直す（SESSION_STORE_MAX_BYTES で合計の上限、0なら無制限）
+# 永続化先がない（既定のメモリ内）場合はここだけに置き、上限やTTLで破棄したセッションはそのまま捨てる
+session_cache = HistoryStore(
+    max_conversations=int(os.getenv("SESSION_STORE_MAX_CLIENTS", "5000")),
+    idle_ttl=float(os.getenv("HISTORY_IDLE_TTL", "86400")),
+    max_bytes=int(os.getenv("SESSION_STORE_MAX_BYTES", "0")) or None,
+    sizer=SessionRecord.approx_bytes,
+)
+# セッションはクライアントごとにロックする（あるクライアントの読み書き中も他のクライアントは待たない）
+session_store_lock = KeyedLocks()
+
+# very_long_logの保持件数（VERY_LONG_LOG_RETENTION）からあふれた会話ログの書き出し先（追記専用のジャーナル）
+# 要約を作り直すときはメモリ上で足りない分をここから読む。
+# LOG_ARCHIVE_DIR 未設定（既定）では書き出さずに捨てる（Vercelなど読み取り専用の環境では /tmp 以下を指定する）
+# LOG_ARCHIVE_MAX_PENDING: 書き出しに失敗し続けたときにセッションに残しておく件数の上限（超えた分は古い方から捨てる）
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "")
+LOG_ARCHIVE_MAX_PENDING = int(os.getenv("LOG_ARCHIVE_MAX_PENDING", "200"))
+log_archive = LogArchive(LOG_ARCHIVE_DIR) if LOG_ARCHIVE_DIR else None
+
+class _SessionStoreView:
+    """memoryモジュールに渡すsession_store（メモリ上になければ永続化先から読み込む）"""
+
+    def __contains__(self, client_id: str) -> bool:
+        return load_session(client_id, create=False) is not None
+
+    def __getitem__(self, client_id: str):
+        record = load_session(client_id, create=False)
+        if record is None:
+            raise KeyError(client_id)
+        return record
+
+# memoryモジュールが更新するsession_store
+# 要約ジョブの実行待ちの間にキャッシュから追い出されても、永続化先があればそこから読み直して処理を続けられる
+session_store = _SessionStoreView()
+
+# 履歴の先頭に入れる記憶（SessionRecord.memoryの属性, 見出し）と、記憶ごとの最大文字数（超えた分は古い方から捨てる）
+MEMORY_PROMPT_SECTIONS = (
+    ("long_memories", "長期の記憶（数週間〜数か月の出来事）"),
+    ("mid_memories", "最近1週間の記憶"),
+    ("short_memories", "最近の会話の記憶"),
+)
+MEMORY_PROMPT_MAX_CHARS = int(os.getenv("MEMORY_PROMPT_MAX_CHARS", "800"))
+
+def load_session(client_id: str, create: bool = True):
+    """クライアントのセッションをメモリ上に読み込んで返す"""
+    record = session_cache.get(client_id)
+    if record is None:
+        record = read_stored_session(client_id)
+        if record is None:
+            if not create:
+                return None
+            record = SessionRecord()
+        session_cache[client_id] = record
+    return record
+
+def read_stored_session(client_id: str):
+    """
+    永続化先からセッションを読み込む
+
+    形式が正しくない（JSONが壊れている・SessionFormatError）セッションは退避して、なかったものとして扱う。
+    例外のままにすると、そのクライアントへの返信が毎回失敗し続けるため。
+    """
+    if not session_backend.persistent:
+        return None
+    try:
+        return session_backend.get_session(client_id)
+    except ValueError:
+        app.logger.exception("Stored session for %s is malformed; quarantining it and starting a new one", client_id)
+    try:
+        session_backend.quarantine_session(client_id)
+    except Exception:
+        app.logger.exception("Failed to quarantine the session for %s", client_id)
+    return None
+
+def store_session(client_id: str, record) -> None:
+    """変更したセッションを永続化先に書き込み、メモリ量を計り直す（session_store_lockを保持して呼ぶ）"""
+    if session_backend.persistent:
+        session_backend.put_session(client_id, record)
+    session_cache.touch(client_id)
+
+def list_session_ids():
+    """セッションがあるクライアントIDを昇順で返す（永続化先がなければメモリ上にあるものだけ）"""
+    if session_backend.persistent:
+        return session_backend.list_session_ids()
+    return sorted(session_cache.keys())
+
+def record_memory_turn(client_id: str, user_input: str, bot_reply: str) -> None:
+    """1往復の会話をvery_long_logに追加する"""
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    with session_store_lock.hold(client_id):
+        record = load_session(client_id)
+        very_long_log = record.logs.very_long_log
+        very_long_log.append(LogEntry("user", user_input, timestamp))
+        very_long_log.append(LogEntry("assistant", bot_reply, timestamp))
+        archive_spilled_logs(client_id, very_long_log)
+        store_session(client_id, record)
+
+def archive_spilled_logs(client_id: str, very_long_log) -> None:
+    """保持件数からあふれた会話ログをアーカイブに書き出す（session_store_lockを保持して呼ぶ）"""
+    spilled = very_long_log.spilled
+    if not spilled:
+        return
+    if log_archive is not None:
+        try:
+            log_archive.append(client_id, spilled)
+        except OSError:
+            # 書き出せなかった分はセッションに残し、次の会話で書き出し直す（残すのは上限まで）
+            app.logger.exception("Failed to archive %d log entries for %s", len(spilled), client_id)
+            dropped = very_long_log.drop_spilled(LOG_ARCHIVE_MAX_PENDING)
+            if dropped:
+                log_archive.record_dropped(dropped)
+                app.logger.warning("Dropped %d unarchived log entries for %s", dropped, client_id)
+            return
+    very_long_log.clear_spilled()
+
+def build_memory_summary(client_id: str):
+    """
+    記憶処理で作った長期・中期・短期の記憶を、履歴の先頭に入れる1往復分の文章にまとめる（記憶がなければNone）
+
+    システムプロンプトはキャラクター設定だけにして、モデルのインスタンスをクライアントごとに作らずに共有する。
+    """
+    with session_store_lock.hold(client_id):
+        record = load_session(client_id, create=False)
+        if record is None:
+            return None
+        sections = []
+        for key, title in MEMORY_PROMPT_SECTIONS:
+            text = getattr(record.memory, key).strip()
+            if text:
+                sections.append(f"## {title}\n{text[-MEMORY_PROMPT_MAX_CHARS:]}")
+    if not sections:
+        return None
+    return "（これまでの記憶です。会話の参考にし、話の流れに合うときだけ自然に触れること）\n" + "\n\n".join(sections)
+
+async def memory_chat_req(a_client: str, user_msg: str, system_prompt: str) -> str:
+    """memoryモジュールが要約に使うチャットリクエスト関数（a_clientは使うモデル名）"""
+    model = model_registry.get(a_client, system_prompt)
+    if memory_jobs is None:
+        # その場で実行するときは呼び出しごとにイベントループが変わるので、ループに結び付く非同期クライアントは使わない
+        response = model.generate_content(user_msg)
+    else:
+        response = await model.generate_content_async(user_msg)
+    return response.text.strip()
+
+async def run_memory_job(client_id: str) -> None:
+    """クライアントのセッションに記憶処理（日付変更・要約）を行い、保存し直す"""
+    with session_store_lock.hold(client_id):
+        record = load_session(client_id, create=False)
+        if record is None:
+            return
+        very_long_log = record.logs.very_long_log
+        # 最後の会話の日付で処理する（日付をまたいで遅れて実行されても前日分は前日として扱う）
+        last_turn_at = very_long_log[-1].timestamp if very_long_log else ""
+    current_date = last_turn_at[:10] or None
+    # その場で実行するときは要約もその場で順に行う（スケジューラは記憶処理ジョブのイベントループ上でしか動かない）
+    await process_conversation_memory(
+        client_id, session_store, session_store_lock, memory_chat_req, MEMORY_SUMMARY_MODEL,
+        current_date=current_date, rebuild_every=MEMORY_SUMMARY_REBUILD_EVERY,
+        scheduler=summary_scheduler if memory_jobs is not None else None, archive=log_archive,
+    )
+    with session_store_lock.hold(client_id):
+        record = load_session(client_id)
+        # 日付変更の判定に使うので、処理が終わってから最後の会話の時刻を記録する
+        if last_turn_at:
+            record.last_activity = last_turn_at
+        store_session(client_id, record)
+
+def persist_session(client_id: str) -> None:
+    """メモリ上のセッションを永続化先に書き込む"""
+    with session_store_lock.hold(client_id):
+        record = session_cache.get(client_id)
+        if record is not None:
+            store_session(client_id, record)
+
+# 要約ジョブのスケジューラ（記憶処理ジョブのイベントループ上で動く）
+# SUMMARY_CONCURRENCY: 同時に実行する要約の数 / SUMMARY_RATE_PER_MINUTE: 1分あたりの要約の上限
+# SUMMARY_ROLLOVER_SPREAD: 日付変更時の要約（midMemories / longMemories）を分散させる秒数
+summary_scheduler = SummaryScheduler(
+    max_concurrency=int(os.getenv("SUMMARY_CONCURRENCY", "2")),
+    rate_per_minute=float(os.getenv("SUMMARY_RATE_PER_MINUTE", "30")),
+    spread_window=float(os.getenv("SUMMARY_ROLLOVER_SPREAD", "1800")),
+    on_complete=persist_session,
+)
+
+# 記憶処理ジョブ（MEMORY_JOBS=1 で有効。常駐するプロセスでだけ使う）
+# 同じ会話の予約は MEMORY_JOB_DELAY 秒（最大 MEMORY_JOB_MAX_WAIT 秒）まとめてから1回だけ実行する
+# 既定（無効）では返信を送った後にその場で記憶処理を行う。Vercelなどのサーバーレス環境では
+# レスポンスを返した後にバックグラウンドのスレッドが動き続ける保証がなく、予約したジョブが実行されないため
+memory_jobs = None
+if os.getenv("MEMORY_JOBS", "0") == "1":
+    memory_jobs = MemoryJobRunner(
+        run_memory_job,
+        delay=float(os.getenv("MEMORY_JOB_DELAY", "30")),
+        max_wait=float(os.getenv("MEMORY_JOB_MAX_WAIT", "300")),
+        max_concurrency=int(os.getenv("MEMORY_JOB_CONCURRENCY", "2")),
+        on_drain=summary_scheduler.drain,
+    )
+    atexit.register(memory_jobs.shutdown, float(os.getenv("MEMORY_JOB_DRAIN_TIMEOUT", "10")))
+
+def process_memory_after_reply(client_id: str) -> None:
+    """記憶処理ジョブを使わない場合に、返信を送った後でその場で記憶処理を行う（ジョブを使う場合は何もしない）"""
+    if memory_jobs is not None:
+        return
+    try:
+        asyncio.run(run_memory_job(client_id))
+    except Exception:
+        app.logger.exception("Memory processing failed for %s", client_id)
+
+async def roll_over_client(client_id: str, current_date: str) -> bool:
+    """夜間の巡回で1クライアントの日付変更を処理する（終わっていない要約があれば登録し直す。必要なければ何もしない）"""
+    with session_store_lock.hold(client_id):
+        record = load_session(client_id, create=False)
+        if record is None or not (needs_rollover(record, current_date) or has_pending_rollover(record)):
+            return False
+    await check_and_handle_date_change(
+        client_id, session_store, session_store_lock, memory_chat_req, MEMORY_SUMMARY_MODEL,
+        current_date, scheduler=summary_scheduler,
+    )
+    persist_session(client_id)
+    return True
+
+# 日付変更の夜間巡回（ROLLOVER_SWEEP=1 で有効、MEMORY_JOBS=1 の記憶処理ジョブのイベントループ上で動く）
+# 無効のときは、次のメッセージの記憶処理で日付変更を処理する
+# ROLLOVER_SWEEP_START_HOUR〜ROLLOVER_SWEEP_END_HOUR 時の間に、1秒あたり ROLLOVER_SWEEP_RATE 件まで処理する
+# ROLLOVER_CHECKPOINT_PATH: 巡回の進み具合の記録先（既定は一時ディレクトリ。空にするとメモリ内のみ）
+rollover_sweeper = None
+if memory_jobs is not None and os.getenv("ROLLOVER_SWEEP", "0") == "1":
+    rollover_sweeper = RolloverSweeper(
+        list_clients=list_session_ids,
+        roll_client=roll_over_client,
+        checkpoint_path=os.getenv(
+            "ROLLOVER_CHECKPOINT_PATH", os.path.join(tempfile.gettempdir(), "rollover_checkpoint.json")
+        ) or None,
+        start_hour=int(os.getenv("ROLLOVER_SWEEP_START_HOUR", "3")),
+        end_hour=int(os.getenv("ROLLOVER_SWEEP_END_HOUR", "5")),
+        rate_per_second=float(os.getenv("ROLLOVER_SWEEP_RATE", "5")),
+    )
+    memory_jobs.run_background(rollover_sweeper.run)
+
+async def resume_pending_rollovers() -> None:
+    """
+    起動時に、前回のプロセスで終わらなかった日付変更の要約を登録し直す
+
+    要約のジョブはメモリ上にしかないため、再起動で破棄されたものは rollover_pending から作り直す。
+    """
+    loop = asyncio.get_running_loop()
+    client_ids = await loop.run_in_executor(None, list_session_ids)
+    current_date = time.strftime("%Y-%m-%d")
+    resumed = 0
+    for client_id in client_ids:
+        try:
+            record = await loop.run_in_executor(None, read_stored_session, client_id)
+            if record is None or not has_pending_rollover(record):
+                continue
+            if await roll_over_client(client_id, current_date):
+                resumed += 1
+        except Exception:
+            app.logger.exception("日付変更の要約の再登録に失敗 (client_id=%s)", client_id)
+    if resumed:
+        app.logger.info("終わっていない日付変更の要約を登録し直しました (clients=%d)", resumed)
+
+# ROLLOVER_RESUME=0 で無効
+if memory_jobs is not None and os.getenv("ROLLOVER_RESUME", "1") == "1":
+    memory_jobs.run_background(resume_pending_rollovers)
+
+def parse_webhook_body(body: str, signature: str):
+    """
+    署名を検証し、処理が必要なイベントだけをSDKのイベントオブジェクトにする
+
+    メンションされていないグループ/ルームのメッセージは生のJSONの段階で捨てる。
+    テキストメッセージ以外のイベントはハンドラがないため組み立てない。
+    """
+    if not webhook_handler.parser.signature_validator.validate(body, signature):
+        raise InvalidSignatureError("Invalid signature. signature=" + str(signature))
+    payload = json.loads(body)
+    return [
+        MessageEvent.new_from_json_dict(event)
+        for event in mention_filter.filter_events(payload.get("events", []))
+        if event.get("type") == "message"
+    ]
+
 @app.route("/line_webhook", methods=["POST"])
 def line_webhook():
     signature = request.headers.get("X-Line-Signature")
     body = request.get_data(as_text=True)
+    received_at = time.time()
     try:
-        webhook_handler.handle(body, signature)
+        events = parse_webhook_body(body, signature)
+        # リプライトークンの期限を見積もるため受信時刻を記録しておく
+        reply_delivery.mark_received(events, received_at)
+        if ASYNC_REPLY_MODE:
+            # 署名検証とイベント解析だけ行い、処理はワーカーに任せる
+            # 一部だけ受け付けると再送で二重に返信するので、全件受け付けるか全件拒否するかのどちらかにする
+            if not reply_workers.submit_all(events):
+                # キューが満杯：LINE側の再送に任せる
+                app.logger.warning("Reply queue is full. %d event(s) rejected.", len(events))
+                return "Busy", 503
+        else:
+            for event in events:
+                _dispatch_event(event)
     except InvalidSignatureError:
         app.logger.error("Invalid signature. Check your channel secret.")
         return "Invalid signature", 400
     return "OK"
 
-@webhook_handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    user_text = event.message.text
+def event_source(event):
+    """イベントの送信元の種類と、ユーザーIDまたはグループID/ルームIDを返す"""
     source_type = event.source.type
-    
-    # ユーザーIDまたはグループIDを取得
     if source_type == "user":
-        source_id = event.source.user_id
+        return source_type, event.source.user_id
     elif source_type == "group":
-        source_id = event.source.group_id
+        return source_type, event.source.group_id
     else: # room
-        source_id = event.source.room_id
+        return source_type, event.source.room_id
+
+@webhook_handler.add(MessageEvent, message=TextMessage)
+def handle_message(event):
+    user_text = event.message.text
+    # ユーザーIDまたはグループIDを取得
+    source_type, source_id = event_source(event)
 
-    # グループチャットでのメンション対応
+    # グループチャットでのメンション対応（通常はWebhookの事前フィルタで除外済み）
     if source_type in ["group", "room"]:
-        # 環境変数からBotのメンション名を取得（なければ "あだT" を使う）
-        bot_name = os.getenv("BOT_MENTION_NAME", "あだT") 
-        if bot_name not in user_text:
+        if not mention_filter.matches(user_text):
             return # メンションされてなければ何もしない
 
+    if message_coalescer is not None:
+        # 連投をまとめてから処理する（まとめた分は応答ワーカーの _reply_to_events で1回だけ生成する）
+        message_coalescer.add(coalesce_key(source_id, event), event)
+        return
+
+    _reply_to_events(source_id, [event])
+
+def coalesce_key(source_id, event):
+    """連投をまとめる単位（グループ/ルームでは別のメンバーの発言を1つの発言にしないよう、送信者ごとにまとめる）"""
+    return source_id, getattr(event.source, "user_id", None)
+
+def _reply_to_events(source_id, events):
+    """1件または連投をまとめた複数件のメッセージに対して1回だけ応答を生成して返信する"""
+    source_type = events[0].source.type
+    user_text = "\n".join(event.message.text for event in events)
+
     # ★★★ ここでバージョンを切り替え ★★★
     # version="2.0" → 無料版 / version="1.5" → 有料版
-    reply_text = chat_with_adoka(user_text, version="2.0", user_id=source_id)
+    # 入力の長さ・会話の種類・混み具合・実測レイテンシからルーターが選ぶ（MODEL_ROUTE_RULES / MODEL_ROUTE_OVERRIDES で設定）
+    version = model_router.choose(source_type, source_id, user_text)
+    reply_text = chat_with_adoka(user_text, version=version, user_id=source_id)
+
+    # まだ使えそうな最初のリプライトークンで返信し、どれも期限切れの見込みならプッシュで送る
+    reply_delivery.send(source_id, events, TextSendMessage(text=reply_text))
+    process_memory_after_reply(source_id)
 
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+class _CoalescedEvents:
+    """連投をまとめたメッセージ（応答ワーカーのキューに入れる）"""
+
+    __slots__ = ("source_id", "events")
+
+    def __init__(self, source_id, events) -> None:
+        self.source_id = source_id
+        self.events = events
+
+def _submit_coalesced(key, events):
+    """
+    まとめたメッセージを応答ワーカーに渡す（まとめ処理のスケジューラスレッドでは生成しない）
+
+    Webhookには200を返した後なのでLINE側の再送はない。キューが満杯なら混雑している旨を返信して、Falseを返す。
+    """
+    source_id, _ = key
+    if reply_workers.submit(_CoalescedEvents(source_id, events)):
+        return True
+    app.logger.warning("Reply queue is full. %d coalesced message(s) from %s dropped.", len(events), source_id)
+    try:
+        reply_delivery.send(source_id, events, TextSendMessage(text=BUSY_REPLY_TEXT))
+    except Exception:
+        app.logger.exception("Failed to send the busy reply to %s", source_id)
+    return False
+
+def _dispatch_event(event):
+    """解析済みのイベントをハンドラに振り分ける（webhook_handlerの登録内容と同じ対応）"""
+    if isinstance(event, _CoalescedEvents):
+        _reply_to_events(event.source_id, event.events)
+    elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event)
+
+# 応答ワーカープール（非同期応答モードでのみ起動される）
+reply_workers = ReplyWorkerPool(
+    handler=_dispatch_event,
+    num_workers=REPLY_WORKER_COUNT,
+    max_queue_size=REPLY_QUEUE_SIZE,
+    enqueue_timeout=REPLY_ENQUEUE_TIMEOUT,
+)
+# プロセス終了時にキューに残ったイベントを処理してから停止する
+atexit.register(reply_workers.shutdown, REPLY_DRAIN_TIMEOUT)
+
+# 連投メッセージのまとめ処理（MESSAGE_COALESCE_WINDOW秒以内に続いたメッセージを1回の生成にまとめる）
+# まとめたメッセージは応答ワーカーで処理するので、同時に生成する数はワーカー数までになる
+# 0の場合は無効（1件ずつ処理する）
+message_coalescer = None
+if MESSAGE_COALESCE_WINDOW > 0:
+    message_coalescer = MessageCoalescer(
+        flush=_submit_coalesced,
+        window=MESSAGE_COALESCE_WINDOW,
+        max_wait=MESSAGE_COALESCE_MAX_WAIT,
+        max_messages=MESSAGE_COALESCE_MAX_MESSAGES,
+    )
+    # 応答ワーカーの停止より先に実行される（atexitは登録と逆順）ので、溜まっていた分もワーカーが処理する
+    atexit.register(message_coalescer.flush_all)
+
+# リクエストごとのモデル振り分け
+# MODEL_ROUTE_RULES: ルールのJSON（例: [{"version": "1.5", "min_chars": 80, "source_types": ["user"], "max_queue_depth": 5}]、未設定なら常に MODEL_DEFAULT_VERSION）
+# MODEL_ROUTE_OVERRIDES: 送信元ごとの固定バージョン（例: "Uxxxx:1.5,Cyyyy:2.0"）
+model_router = ModelRouter(
+    rules=parse_rules(os.environ["MODEL_ROUTE_RULES"]) if os.getenv("MODEL_ROUTE_RULES") else DEFAULT_RULES,
+    default_version=os.getenv("MODEL_DEFAULT_VERSION", "2.0"),
+    resolve_model_name=model_registry.resolve_model_name,
+    p95_latency=lambda model_name: gemini_caller.latency(model_name).percentile(0.95),
+    queue_depth=reply_workers.queue_depth,
+    overrides=parse_overrides(os.getenv("MODEL_ROUTE_OVERRIDES", "")),
+)
 
 @app.route("/")
 def home():
     return "あだおか LINE Bot is running!"
+
+@app.route("/metrics")
+def metrics():
+    """応答ワーカーのキュー状況などの指標を返す"""
+    return jsonify(collect_metrics())
+
+def collect_metrics() -> dict:
+    """各コンポーネントの統計をまとめる（asgi_app.pyからも使う）"""
+    return {
+        "async_reply_mode": ASYNC_REPLY_MODE,
+        "reply_workers": reply_workers.metrics(),
+        "model_registry": model_registry.stats(),
+        "chat_histories": chat_histories.stats(),
+        "session_backend": session_backend.stats(),
+        "session_store": session_cache.stats(),
+        "session_locks": session_store_lock.stats(),
+        "log_archive": log_archive.stats() if log_archive is not None else None,
+        "memory_jobs": memory_jobs.stats() if memory_jobs is not None else None,
+        "summary_scheduler": summary_scheduler.stats(),
+        "rollover_sweeper": rollover_sweeper.stats() if rollover_sweeper is not None else None,
+        "gemini_calls": gemini_caller.stats(),
+        "model_router": model_router.stats(),
+        "conversation_locks": conversation_locks.stats(),
+        "reply_delivery": reply_delivery.stats(),
+        "line_http": line_bot_api.http_client.stats(),
+        "mention_filter": mention_filter.stats(),
+        "message_coalescer": message_coalescer.stats() if message_coalescer is not None else None,
+    }
@@ -0,0 +1,262 @@
+"""
+あだおか LINE Bot（ASGI版）
+
+Flask版（app.py）と同じ設定・会話履歴・モデル振り分けを使い、
+Webhookの受信・Geminiの呼び出し・LINEへの返信を1つのイベントループ上で並行して実行する。
+記憶処理（memory.py）はFlask版と同じく、返信を送った後に行う（MEMORY_JOBS=1 なら app.memory_jobs がバックグラウンドで実行する）。
+待ち時間の大半はGeminiとLINE APIの応答待ちなので、会話ごとにスレッドを占有せずに多くの会話を同時に扱える。
+受け付け（全件か0件か）・連投のまとめ処理・会話ごとのロックはFlask版と同じものを使い、同時に生成する数はセマフォで制限する。
+
+起動例: uvicorn asgi_app:app --host 0.0.0.0 --port 8000
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import List, Optional, Set
+
+import aiohttp
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.models import TextMessage, TextSendMessage
+
+import app as bot
+from coalescer import MessageCoalescer
+from gemini_client import GeminiCallError, send_chat_message_async
+from line_delivery import ReplyDelivery
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="あだおか LINE Bot (ASGI)")
+
+# 終了時に待つバックグラウンドタスクの最大秒数
+ASGI_DRAIN_TIMEOUT = float(os.getenv("ASGI_DRAIN_TIMEOUT", "10"))
+
+# 同時に応答を生成する会話の数と、それに加えて受け付けて待たせておける数
+# （Flask版の応答ワーカー数・応答キューの長さに相当し、既定も同じ値）
+ASGI_MAX_CONCURRENCY = int(os.getenv("ASGI_MAX_CONCURRENCY", str(bot.REPLY_WORKER_COUNT)))
+ASGI_MAX_QUEUED = int(os.getenv("ASGI_MAX_QUEUED", str(bot.REPLY_QUEUE_SIZE)))
+
+# 実行中のバックグラウンドタスク（ガベージコレクションされないよう参照を保持し、終了時に待つ）
+_background_tasks: Set[asyncio.Task] = set()
+
+# 受け付けた応答の数（実行中と待機中の合計。まとめ処理のスレッドからも数えるのでロックで守る）
+_admission_lock = threading.Lock()
+_admitted = 0
+
+# startupで作る（aiohttpのセッション・セマフォはイベントループの中で作る必要がある）
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_generation_slots: Optional[asyncio.Semaphore] = None
+_http_session: Optional[aiohttp.ClientSession] = None
+line_bot_api: Optional[AsyncLineBotApi] = None
+reply_delivery: Optional[ReplyDelivery] = None
+message_coalescer: Optional[MessageCoalescer] = None
+
+
+def _spawn(coro) -> asyncio.Task:
+    """レスポンスを待たせずにコルーチンを実行する"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _try_admit(count: int) -> bool:
+    """count 件の応答を受け付ける（上限を超えるなら1件も受け付けない）"""
+    global _admitted
+    with _admission_lock:
+        if _admitted + count > ASGI_MAX_CONCURRENCY + ASGI_MAX_QUEUED:
+            return False
+        _admitted += count
+        return True
+
+
+def _release_admission(_task: asyncio.Task) -> None:
+    global _admitted
+    with _admission_lock:
+        _admitted -= 1
+
+
+def _queue_depth() -> int:
+    """生成の順番を待っている応答の数（Flask版の応答キューの深さに相当）"""
+    with _admission_lock:
+        return max(0, _admitted - ASGI_MAX_CONCURRENCY)
+
+
+def _start_reply(source_id: str, events: List) -> None:
+    """受け付け済みの応答をイベントループで開始する（イベントループのスレッドで呼ぶ）"""
+    _spawn(_reply_to_events(source_id, events)).add_done_callback(_release_admission)
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    global _loop, _generation_slots, _http_session, line_bot_api, reply_delivery, message_coalescer
+    _loop = asyncio.get_running_loop()
+    _generation_slots = asyncio.Semaphore(max(1, ASGI_MAX_CONCURRENCY))
+    connect_timeout, read_timeout = bot.LINE_HTTP_TIMEOUT
+    _http_session = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout),
+        connector=aiohttp.TCPConnector(limit=int(os.getenv("LINE_HTTP_POOL_SIZE", "16"))),
+    )
+    line_bot_api = AsyncLineBotApi(bot.LINE_CHANNEL_ACCESS_TOKEN, AiohttpAsyncHttpClient(_http_session))
+    reply_delivery = ReplyDelivery(
+        line_bot_api,
+        token_ttl=bot.REPLY_TOKEN_TTL,
+        safety_margin=bot.REPLY_TOKEN_SAFETY_MARGIN,
+    )
+    # 連投のまとめ処理はFlask版と同じ設定で行い、まとめた分を1回の応答として受け付ける
+    if bot.MESSAGE_COALESCE_WINDOW > 0:
+        message_coalescer = MessageCoalescer(
+            flush=_submit_coalesced,
+            window=bot.MESSAGE_COALESCE_WINDOW,
+            max_wait=bot.MESSAGE_COALESCE_MAX_WAIT,
+            max_messages=bot.MESSAGE_COALESCE_MAX_MESSAGES,
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    # まとめ処理に溜まっていた分も受け付けてから、生成中・返信中の会話を待って接続を閉じる
+    if message_coalescer is not None:
+        message_coalescer.flush_all()
+        await asyncio.sleep(0)
+    if _background_tasks:
+        _, pending = await asyncio.wait(set(_background_tasks), timeout=ASGI_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning("%d background task(s) cancelled at shutdown", len(pending))
+    if _http_session is not None:
+        await _http_session.close()
+
+
+async def chat_with_adoka(user_input: str, version: str, user_id: str) -> str:
+    """chat_with_adoka（app.py）のasyncio版"""
+    # Flask版・記憶処理と同じ会話ごとのロックを使い、スレッドとタスクの間でも同じ会話は1件ずつ処理する
+    async with bot.conversation_locks.hold_async(user_id):
+        # セッションの読み込み・保存はロック待ちやバックエンドへのI/Oを含むので、イベントループを止めないようスレッドで行う
+        history, model_name, window = await asyncio.to_thread(bot.load_chat_window, user_input, version, user_id)
+
+        async def attempt(model_name: str, timeout: float) -> str:
+            chat_session = bot.start_chat_session(model_name, window)
+            return await send_chat_message_async(
+                chat_session, user_input, request_options={"timeout": timeout}, **bot.chat_send_options(version)
+            )
+
+        try:
+            bot_reply, _ = await bot.gemini_caller.call_async(model_name, attempt)
+        except GeminiCallError as e:
+            # エラー内容はログにだけ残し、ユーザーには定型文を返す（履歴には残さない）
+            logger.error("Gemini call failed for %s: %r", user_id, e)
+            return bot.ERROR_REPLY_TEXT
+
+        await asyncio.to_thread(bot.save_chat_turn, user_id, history, user_input, bot_reply)
+        return bot_reply
+
+
+def handle_message(event) -> None:
+    """
+    Flask版の handle_message と同じ振り分けを行う（イベントループのスレッドで呼ぶ）
+
+    まとめ処理を使う場合は溜めるだけにし、使わない場合は受け付け済みのイベントの応答を開始する。
+    """
+    user_text = event.message.text
+    source_type, source_id = bot.event_source(event)
+
+    # グループチャットでのメンション対応（通常はWebhookの事前フィルタで除外済み）
+    if source_type in ["group", "room"]:
+        if not bot.mention_filter.matches(user_text):
+            _release_admission(None)
+            return
+
+    if message_coalescer is not None:
+        # まとめた分は _submit_coalesced で1回の応答として受け付け直す
+        _release_admission(None)
+        message_coalescer.add(bot.coalesce_key(source_id, event), event)
+        return
+
+    _start_reply(source_id, [event])
+
+
+def _submit_coalesced(key, events) -> bool:
+    """
+    まとめたメッセージの応答を受け付ける（まとめ処理のスケジューラスレッドからも呼ばれる）
+
+    受け付けられなければFlask版と同じく混雑している旨を返信して、Falseを返す。
+    """
+    source_id, _ = key
+    if _try_admit(1):
+        _loop.call_soon_threadsafe(_start_reply, source_id, events)
+        return True
+    logger.warning("Too many replies in progress. %d coalesced message(s) from %s dropped.", len(events), source_id)
+    asyncio.run_coroutine_threadsafe(_send_busy_reply(source_id, events), _loop)
+    return False
+
+
+async def _send_busy_reply(source_id: str, events: List) -> None:
+    try:
+        await reply_delivery.send_async(source_id, events, TextSendMessage(text=bot.BUSY_REPLY_TEXT))
+    except Exception:
+        logger.exception("Failed to send the busy reply to %s", source_id)
+
+
+async def _reply_to_events(source_id: str, events: List) -> None:
+    """1件または連投をまとめた複数件のメッセージに対して1回だけ応答を生成して返信する"""
+    # 同時に生成する数を ASGI_MAX_CONCURRENCY までにする（残りはここで順番を待つ）
+    async with _generation_slots:
+        source_type = events[0].source.type
+        user_text = "\n".join(event.message.text for event in events)
+        version = bot.model_router.choose(source_type, source_id, user_text, queue_depth=_queue_depth())
+        reply_text = await chat_with_adoka(user_text, version=version, user_id=source_id)
+        try:
+            await reply_delivery.send_async(source_id, events, TextSendMessage(text=reply_text))
+        except LineBotApiError:
+            logger.exception("Failed to deliver reply to %s", source_id)
+        await asyncio.to_thread(bot.process_memory_after_reply, source_id)
+
+
+@app.post("/line_webhook")
+async def line_webhook(request: Request):
+    signature = request.headers.get("X-Line-Signature")
+    body = (await request.body()).decode("utf-8")
+    received_at = time.time()
+    try:
+        events = bot.parse_webhook_body(body, signature)
+    except InvalidSignatureError:
+        logger.error("Invalid signature. Check your channel secret.")
+        return PlainTextResponse("Invalid signature", status_code=400)
+
+    events = [event for event in events if isinstance(event.message, TextMessage)]
+    # Flask版の応答キューと同じく、1リクエストのイベントは全件受け付けるか全件拒否する（拒否した分はLINE側が再送する）
+    if not _try_admit(len(events)):
+        logger.warning("Too many replies in progress. %d event(s) rejected.", len(events))
+        return PlainTextResponse("Busy", status_code=503)
+    # リプライトークンの期限を見積もるため受信時刻を記録しておく
+    reply_delivery.mark_received(events, received_at)
+    for event in events:
+        handle_message(event)
+    # 生成を待たずにすぐ200を返す
+    return PlainTextResponse("OK")
+
+
+@app.get("/")
+async def home():
+    return PlainTextResponse("あだおか LINE Bot (ASGI) is running!")
+
+
+@app.get("/metrics")
+async def metrics():
+    """Flask版と同じ指標に、ASGI版の返信・ロック・タスクの状況を加えて返す"""
+    data = bot.collect_metrics()
+    data["asgi"] = {
+        "background_tasks": len(_background_tasks),
+        "queued_replies": _queue_depth(),
+        "message_coalescer": message_coalescer.stats() if message_coalescer is not None else None,
+        "reply_delivery": reply_delivery.stats() if reply_delivery is not None else None,
+    }
+    return data
@@ -0,0 +1,158 @@
+"""
+連投メッセージのまとめ処理
+
+同じ送信元から短い間隔で続けて届いたメッセージを1つにまとめ、Geminiの呼び出しを1回にする。
+最後のメッセージから window 秒新しいメッセージが来なければまとめて処理する
+（最初のメッセージから max_wait 秒経ったら、続いていても処理する）。
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    __slots__ = ("items", "started", "due")
+
+    def __init__(self, started: float) -> None:
+        self.items: List[Any] = []
+        self.started = started
+        self.due = started
+
+
+class MessageCoalescer:
+    """
+    送信元ごとにメッセージを溜め、一定時間新しいメッセージが来なければまとめて処理する
+
+    処理の期限は1本のスケジューラスレッドがヒープで管理する（メッセージごとにタイマーのスレッドを作らない）。
+    期限を延ばすときは新しい期限をヒープに積み、古い期限は取り出したときに読み飛ばす。
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[Hashable, List[Any]], Optional[bool]],
+        window: float,
+        max_wait: float,
+        max_messages: int = 10,
+        name: str = "message-coalescer"
+    ) -> None:
+        """
+        Args:
+            flush: (送信元ID, まとめたメッセージのリスト) を受け取って処理する関数。
+                処理を受け付けられずに捨てた場合はFalseを返す（件数を数える）
+            window: 最後のメッセージからこの秒数新しいメッセージが来なければ処理する
+            max_wait: 最初のメッセージからこの秒数経ったら必ず処理する
+            max_messages: この件数溜まったら待たずに処理する
+            name: スケジューラスレッドの名前
+        """
+        self._flush = flush
+        self._window = window
+        self._max_wait = max(window, max_wait)
+        self._max_messages = max(1, max_messages)
+        self._name = name
+        self._pending: Dict[Hashable, _Batch] = {}
+        # (期限, 追加順, 送信元ID, バッチ)。期限が延びたバッチの古い要素も残る
+        self._due: List[Tuple[float, int, Hashable, _Batch]] = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._messages = 0
+        self._batches = 0
+        self._failed = 0
+        self._dropped_batches = 0
+        self._dropped_messages = 0
+
+    def add(self, key: Hashable, item: Any) -> None:
+        """メッセージを溜める（件数・待ち時間の上限に達した場合はこの場で処理する）"""
+        now = time.monotonic()
+        ready = None
+        with self._lock:
+            self._messages += 1
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = _Batch(now)
+            batch.items.append(item)
+
+            if len(batch.items) >= self._max_messages or now - batch.started >= self._max_wait:
+                del self._pending[key]
+                ready = batch
+            else:
+                batch.due = now + min(self._window, batch.started + self._max_wait - now)
+                heapq.heappush(self._due, (batch.due, next(self._sequence), key, batch))
+                self._ensure_started_locked()
+                self._wakeup.notify()
+
+        if ready is not None:
+            self._run(key, ready)
+
+    def _ensure_started_locked(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._schedule_loop, name=self._name, daemon=True)
+            self._thread.start()
+
+    def _schedule_loop(self) -> None:
+        while True:
+            with self._lock:
+                ready = self._take_due_locked(time.monotonic())
+                if not ready:
+                    timeout = self._due[0][0] - time.monotonic() if self._due else None
+                    self._wakeup.wait(timeout)
+                    continue
+            for key, batch in ready:
+                self._run(key, batch)
+
+    def _take_due_locked(self, now: float) -> List[Tuple[Hashable, _Batch]]:
+        ready = []
+        while self._due and self._due[0][0] <= now:
+            due, _, key, batch = heapq.heappop(self._due)
+            # 既に処理済み・新しいバッチに置き換わった・期限が延びた場合は読み飛ばす
+            if self._pending.get(key) is not batch or batch.due != due:
+                continue
+            del self._pending[key]
+            ready.append((key, batch))
+        return ready
+
+    def _run(self, key: Hashable, batch: _Batch) -> None:
+        with self._lock:
+            self._batches += 1
+        try:
+            accepted = self._flush(key, batch.items)
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            logger.exception("まとめたメッセージの処理中にエラーが発生しました")
+            return
+        if accepted is False:
+            with self._lock:
+                self._dropped_batches += 1
+                self._dropped_messages += len(batch.items)
+
+    def flush_all(self) -> None:
+        """溜まっているメッセージを待たずにすべて処理する（終了時用）"""
+        with self._lock:
+            batches = list(self._pending.items())
+            self._pending.clear()
+            self._due.clear()
+        for key, batch in batches:
+            self._run(key, batch)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "window_sec": self._window,
+                "max_wait_sec": self._max_wait,
+                "pending_sources": len(self._pending),
+                "scheduled_deadlines": len(self._due),
+                "messages": self._messages,
+                "batches": self._batches,
+                "merged_messages": self._messages - self._batches - sum(len(b.items) for b in self._pending.values()),
+                "failed": self._failed,
+                "dropped_batches": self._dropped_batches,
+                "dropped_messages": self._dropped_messages,
+            }
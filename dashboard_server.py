@@ -12,6 +12,9 @@ from typing import Dict, Any, List
 import uvicorn
 from datetime import datetime
 
+from session_backend import create_session_backend
+from session_model import SessionRecord
+
 # FastAPIアプリケーション初期化
 app = FastAPI(
     title="Chat Memory System Dashboard",
@@ -19,7 +22,7 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# サンプルセッションストア（実際の実装では外部ストレージから読み込み）
+# サンプルセッションストア（SESSION_BACKEND未設定時の表示用）
 sample_session_store = {
     "user001": {
         "last_activity": "2025-08-13 10:30:00",
@@ -46,6 +49,13 @@ sample_session_store = {
     }
 }
 
+# セッションの読み込み先（Bot・メモリ処理と共通のバックエンド）
+# SESSION_BACKEND=sqlite ならBotと同じDBファイルを参照し、既定のメモリ内の場合はサンプルを表示する
+session_backend = create_session_backend()
+if not session_backend.persistent:
+    for _client_id, _record in sample_session_store.items():
+        session_backend.put_session(_client_id, SessionRecord.from_dict(_record))
+
 # データモデル定義
 class MemoryStats(BaseModel):
     client_id: str
@@ -77,14 +87,12 @@ async def dashboard():
 @app.get("/api/status", response_model=SystemStatus)
 async def get_system_status():
     """システム全体の状態を取得"""
-    total_clients = len(sample_session_store)
-    active_clients = sum(1 for client in sample_session_store.values() 
-                        if client.get("last_activity", ""))
+    session_store = session_backend.list_sessions()
+    total_clients = len(session_store)
+    active_clients = sum(1 for client in session_store.values() if client.last_activity)
     total_memories = sum(
-        len(client.get("long_conversation_logs", {}).get("very_long_log", [])) +
-        len(client.get("long_conversation_logs", {}).get("midLog", [])) +
-        len(client.get("long_conversation_logs", {}).get("longLog", []))
-        for client in sample_session_store.values()
+        client.logs.very_long_log.total + len(client.logs.mid_log) + len(client.logs.long_log)
+        for client in session_store.values()
     )
     
     return SystemStatus(
@@ -99,19 +107,19 @@ async def get_system_status():
 async def get_memory_stats():
     """全クライアントのメモリ統計を取得"""
     stats = []
-    for client_id, client_data in sample_session_store.items():
-        logs = client_data.get("long_conversation_logs", {})
-        memory_store = client_data.get("memory_store", {})
+    for client_id, client_data in session_backend.list_sessions().items():
+        logs = client_data.logs
+        memory = client_data.memory
         
         stat = MemoryStats(
             client_id=client_id,
-            last_activity=client_data.get("last_activity", ""),
-            very_long_log_count=len(logs.get("very_long_log", [])),
-            midlog_count=len(logs.get("midLog", [])),
-            longlog_count=len(logs.get("longLog", [])),
-            has_short_memories=bool(memory_store.get("shortMemories", "").strip()),
-            has_mid_memories=bool(memory_store.get("midMemories", "").strip()),
-            has_long_memories=bool(memory_store.get("longMemories", "").strip())
+            last_activity=client_data.last_activity,
+            very_long_log_count=logs.very_long_log.total,
+            midlog_count=len(logs.mid_log),
+            longlog_count=len(logs.long_log),
+            has_short_memories=bool(memory.short_memories.strip()),
+            has_mid_memories=bool(memory.mid_memories.strip()),
+            has_long_memories=bool(memory.long_memories.strip())
         )
         stats.append(stat)
     
@@ -121,24 +129,23 @@ async def get_memory_stats():
 @app.get("/api/client/{client_id}")
 async def get_client_details(client_id: str):
     """特定クライアントの詳細情報を取得"""
-    if client_id not in sample_session_store:
+    client_data = session_backend.get_session(client_id)
+    if client_data is None:
         raise HTTPException(status_code=404, detail="Client not found")
     
-    client_data = sample_session_store[client_id]
-    
     # 最新の会話ログを5件まで取得
-    recent_logs = client_data.get("long_conversation_logs", {}).get("very_long_log", [])
-    recent_conversations = recent_logs[-5:] if len(recent_logs) > 5 else recent_logs
+    logs = client_data.logs
+    recent_conversations = [entry.to_dict() for entry in logs.very_long_log.tail(5)]
     
     return {
         "client_id": client_id,
-        "last_activity": client_data.get("last_activity", ""),
-        "memory_store": client_data.get("memory_store", {}),
+        "last_activity": client_data.last_activity,
+        "memory_store": client_data.memory.to_dict(),
         "recent_conversations": recent_conversations,
         "log_counts": {
-            "very_long_log": len(client_data.get("long_conversation_logs", {}).get("very_long_log", [])),
-            "midLog": len(client_data.get("long_conversation_logs", {}).get("midLog", [])),
-            "longLog": len(client_data.get("long_conversation_logs", {}).get("longLog", []))
+            "very_long_log": logs.very_long_log.total,
+            "midLog": len(logs.mid_log),
+            "longLog": len(logs.long_log)
         }
     }
 
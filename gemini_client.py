@@ -0,0 +1,706 @@
+"""
+Gemini 呼び出しヘルパー
+
+ストリーミング生成で返答が1～2行分そろった時点で打ち切る処理や、
+最大出力トークン数の指定など、チャットセッションへの送信まわりをまとめる。
+モデルごとの呼び出しポリシー（期限・リトライ・ヘッジ・サーキットブレーカー）もここで扱う。
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # google-api-core がない環境でも読み込めるようにする
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+# 文の終わりとみなす文字
+_SENTENCE_ENDINGS = "。！？!?"
+
+
+class ReplyBoundaryDetector:
+    """
+    ストリーミング中のテキストから「返答が完成したか」を判定する
+
+    改行で区切られた行がmax_lines行そろうか、文末記号で終わる文がmax_sentences文そろった時点で完成とみなす。
+    """
+
+    __slots__ = ("_max_lines", "_max_sentences", "_lines", "_sentences", "_cut", "_line_has_text")
+
+    def __init__(self, max_lines: int = 2, max_sentences: Optional[int] = None) -> None:
+        self._max_lines = max(1, max_lines)
+        self._max_sentences = max_sentences
+        self._lines = 0
+        self._sentences = 0
+        self._cut: Optional[int] = None
+        self._line_has_text = False
+
+    def feed(self, text: str, offset: int) -> Optional[int]:
+        """
+        新しく届いたテキストを調べる
+
+        Args:
+            text: 新しく届いた部分
+            offset: これまでに届いたテキスト全体の中でのtextの開始位置
+
+        Returns:
+            返答が完成した場合は全体テキストの切り取り位置、未完成ならNone
+        """
+        if self._cut is not None:
+            return self._cut
+        for i, ch in enumerate(text):
+            if ch == "\n":
+                # 空行は数えない
+                if self._line_has_text:
+                    self._lines += 1
+                    self._line_has_text = False
+                    if self._lines >= self._max_lines:
+                        self._cut = offset + i
+                        return self._cut
+                continue
+            if not ch.isspace():
+                self._line_has_text = True
+            if ch in _SENTENCE_ENDINGS and self._max_sentences:
+                self._sentences += 1
+                if self._sentences >= self._max_sentences:
+                    self._cut = offset + i + 1
+                    return self._cut
+        return None
+
+
+def _chunk_text(chunk: Any) -> str:
+    """ストリームのチャンクからテキストを取り出す（安全フィルタ等でテキストがない場合は空文字）"""
+    try:
+        return chunk.text
+    except (ValueError, AttributeError):
+        return ""
+
+
+def send_chat_message(
+    chat_session: Any,
+    user_input: str,
+    stream: bool = False,
+    max_output_tokens: Optional[int] = None,
+    max_lines: int = 2,
+    max_sentences: Optional[int] = None,
+    request_options: Optional[Dict[str, Any]] = None
+) -> str:
+    """
+    チャットセッションにメッセージを送り、返答テキストを返す
+
+    Args:
+        chat_session: model.start_chat() で作成したチャットセッション
+        user_input: ユーザーの入力
+        stream: Trueならストリーミングで生成し、返答が完成した時点で打ち切る
+        max_output_tokens: 最大出力トークン数（Noneならモデルの既定値）
+        max_lines: ストリーミング時に完成とみなす行数
+        max_sentences: ストリーミング時に完成とみなす文数（Noneなら文数では打ち切らない）
+        request_options: SDKに渡すリクエストオプション（timeoutなど）
+
+    Returns:
+        前後の空白を除いた返答テキスト
+    """
+    kwargs: Dict[str, Any] = {}
+    if max_output_tokens:
+        kwargs["generation_config"] = {"max_output_tokens": max_output_tokens}
+    if request_options:
+        kwargs["request_options"] = request_options
+
+    if not stream:
+        response = chat_session.send_message(user_input, **kwargs)
+        return response.text.strip()
+
+    response = chat_session.send_message(user_input, stream=True, **kwargs)
+    detector = ReplyBoundaryDetector(max_lines=max_lines, max_sentences=max_sentences)
+    parts = []
+    received = 0
+    cut = None
+    for chunk in response:
+        text = _chunk_text(chunk)
+        if not text:
+            continue
+        parts.append(text)
+        cut = detector.feed(text, received)
+        received += len(text)
+        if cut is not None:
+            # 返答が完成したので残りの生成は待たない
+            logger.debug("ストリーミング生成を打ち切りました (%d文字で完成)", cut)
+            break
+
+    reply = "".join(parts)
+    if cut is not None:
+        reply = reply[:cut]
+    return reply.strip()
+
+
+async def send_chat_message_async(
+    chat_session: Any,
+    user_input: str,
+    stream: bool = False,
+    max_output_tokens: Optional[int] = None,
+    max_lines: int = 2,
+    max_sentences: Optional[int] = None,
+    request_options: Optional[Dict[str, Any]] = None
+) -> str:
+    """send_chat_message のasyncio版（引数と戻り値は同じ）"""
+    kwargs: Dict[str, Any] = {}
+    if max_output_tokens:
+        kwargs["generation_config"] = {"max_output_tokens": max_output_tokens}
+    if request_options:
+        kwargs["request_options"] = request_options
+
+    if not stream:
+        response = await chat_session.send_message_async(user_input, **kwargs)
+        return response.text.strip()
+
+    response = await chat_session.send_message_async(user_input, stream=True, **kwargs)
+    detector = ReplyBoundaryDetector(max_lines=max_lines, max_sentences=max_sentences)
+    parts = []
+    received = 0
+    cut = None
+    async for chunk in response:
+        text = _chunk_text(chunk)
+        if not text:
+            continue
+        parts.append(text)
+        cut = detector.feed(text, received)
+        received += len(text)
+        if cut is not None:
+            logger.debug("ストリーミング生成を打ち切りました (%d文字で完成)", cut)
+            break
+
+    reply = "".join(parts)
+    if cut is not None:
+        reply = reply[:cut]
+    return reply.strip()
+
+
+# --- 呼び出しポリシー ---
+
+class GeminiCallError(Exception):
+    """リトライやフォールバックを尽くしてもGeminiの呼び出しに失敗した"""
+
+
+class CallQueueTimeout(Exception):
+    """
+    呼び出し用のスレッドが空かず、期限までに呼び出しを始められなかった
+
+    モデルの不調ではなくこのプロセスの混雑なので、ブレーカーには数えず、リトライやフォールバックもしない。
+    """
+
+
+# リトライしてよいエラー（レート制限・一時的な障害・タイムアウト）
+_RETRYABLE_ERRORS: Tuple[type, ...] = (TimeoutError, ConnectionError)
+if google_exceptions is not None:
+    _RETRYABLE_ERRORS += (
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    )
+
+
+def is_retryable(error: BaseException) -> bool:
+    """リトライすれば成功する見込みのあるエラーかどうか"""
+    return isinstance(error, _RETRYABLE_ERRORS)
+
+
+class CallPolicy:
+    """1モデル分の呼び出しポリシー"""
+
+    __slots__ = (
+        "deadline", "max_retries", "backoff_base", "backoff_max",
+        "hedge", "hedge_percentile", "hedge_min_samples",
+        "fallback_model", "breaker_failures", "breaker_open_seconds", "slow_call_seconds",
+    )
+
+    def __init__(
+        self,
+        deadline: float = 15.0,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 4.0,
+        hedge: bool = False,
+        hedge_percentile: float = 0.95,
+        hedge_min_samples: int = 20,
+        fallback_model: Optional[str] = None,
+        breaker_failures: int = 5,
+        breaker_open_seconds: float = 30.0,
+        slow_call_seconds: Optional[float] = None
+    ) -> None:
+        """
+        Args:
+            deadline: リトライを含めた1回の呼び出し全体の期限（秒）
+            max_retries: リトライ可能なエラーのときの最大リトライ回数
+            backoff_base: リトライ間隔の基準値（秒、回数ごとに倍にしてジッターをかける）
+            backoff_max: リトライ間隔の上限（秒）
+            hedge: Trueなら応答が遅いときに2本目のリクエストを並行して送る
+            hedge_percentile: 2本目を送るまでの待ち時間に使うレイテンシのパーセンタイル
+            hedge_min_samples: ヘッジを有効にするのに必要なレイテンシの計測数
+            fallback_model: ブレーカーが開いている・呼び出しに失敗したときに使うモデル
+            breaker_failures: ブレーカーを開く連続失敗回数
+            breaker_open_seconds: ブレーカーを開いたままにする秒数
+            slow_call_seconds: これより遅い成功も失敗として数える（負荷が高いとみなす）
+        """
+        self.deadline = deadline
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.fallback_model = fallback_model
+        self.breaker_failures = max(1, breaker_failures)
+        self.breaker_open_seconds = breaker_open_seconds
+        self.slow_call_seconds = slow_call_seconds
+
+
+class LatencyTracker:
+    """直近の呼び出しレイテンシを保持してパーセンタイルを求める"""
+
+    def __init__(self, window: int = 200) -> None:
+        self._samples: "deque[float]" = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(p * len(ordered)))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """連続失敗でモデルへの呼び出しを一時停止するサーキットブレーカー"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, open_seconds: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self._failure_threshold = failure_threshold
+        self._open_seconds = open_seconds
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self._open_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """呼び出してよいか（半開状態では1件だけ試行を通す）"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if self._clock() - self._opened_at < self._open_seconds:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release(self) -> None:
+        """成功とも失敗とも数えずに、半開状態の試行枠だけを返す（リクエスト自体の誤りなど）"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class GeminiCaller:
+    """
+    モデルごとのポリシーに従ってGeminiを呼び出す
+
+    期限内でのジッター付きリトライ、p95を超えたときのヘッジリクエスト、
+    サーキットブレーカーによるフォールバック先モデルへの切り替えを行う。
+    """
+
+    def __init__(
+        self,
+        policies: Dict[str, CallPolicy],
+        default_policy: Optional[CallPolicy] = None,
+        max_workers: int = 8,
+        hedge_workers: Optional[int] = None,
+        sleep: Callable[[float], None] = time.sleep,
+        rng: Callable[[], float] = random.random
+    ) -> None:
+        """
+        Args:
+            policies: モデル名ごとの呼び出しポリシー
+            default_policy: policies にないモデルのポリシー
+            max_workers: 1本目の呼び出しに使うスレッド数
+            hedge_workers: ヘッジ（2本目）の呼び出しに使うスレッド数（省略時は max_workers の半分）。
+                期限切れ・ヘッジで負けて結果を使わなくなった呼び出しも終わるまでスレッドを使い続けるので、
+                ヘッジは別のスレッドで送り、1本目の呼び出しの枠を埋めないようにする
+            sleep: リトライまで待つ関数
+            rng: バックオフのジッターに使う乱数関数
+        """
+        self._policies = dict(policies)
+        self._default_policy = default_policy or CallPolicy()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini-call")
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=hedge_workers or max(1, max_workers // 2), thread_name_prefix="gemini-hedge"
+        )
+        self._sleep = sleep
+        self._rng = rng
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[str, LatencyTracker] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def policy(self, model_name: str) -> CallPolicy:
+        return self._policies.get(model_name, self._default_policy)
+
+    def latency(self, model_name: str) -> LatencyTracker:
+        with self._lock:
+            tracker = self._latencies.get(model_name)
+            if tracker is None:
+                tracker = self._latencies[model_name] = LatencyTracker()
+            return tracker
+
+    def _breaker(self, model_name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+            if breaker is None:
+                policy = self.policy(model_name)
+                breaker = self._breakers[model_name] = CircuitBreaker(
+                    policy.breaker_failures, policy.breaker_open_seconds
+                )
+            return breaker
+
+    def _count(self, model_name: str, name: str) -> None:
+        with self._lock:
+            counters = self._counters.setdefault(model_name, {})
+            counters[name] = counters.get(name, 0) + 1
+
+    def _route(self, model_name: str) -> Iterator[Tuple[str, CallPolicy, CircuitBreaker]]:
+        """
+        呼び出すモデルを順に返す（ブレーカーが開いているモデルは飛ばしてフォールバック先へ進む）
+
+        スレッド版とasyncio版で同じ順序・同じ計測になるよう、モデルの選び方はここにまとめる。
+        """
+        visited = []
+        current: Optional[str] = model_name
+        while current and current not in visited:
+            visited.append(current)
+            policy = self.policy(current)
+            breaker = self._breaker(current)
+            if breaker.allow():
+                yield current, policy, breaker
+            else:
+                self._count(current, "short_circuited")
+            if policy.fallback_model:
+                self._count(current, "fallbacks")
+            current = policy.fallback_model
+
+    @staticmethod
+    def _call_error(model_name: str, last_error: Optional[BaseException]) -> GeminiCallError:
+        if last_error is None:
+            return GeminiCallError(f"Circuit breaker is open for {model_name}")
+        error = GeminiCallError(str(last_error))
+        error.__cause__ = last_error
+        return error
+
+    def _on_failure(
+        self, model_name: str, policy: CallPolicy, breaker: CircuitBreaker,
+        error: BaseException, retry: int, time_left: float
+    ) -> Optional[float]:
+        """
+        1回分の呼び出しの失敗を記録し、リトライするなら待つ秒数を返す
+
+        Returns:
+            リトライまでに待つ秒数。リトライしない（エラーをそのまま送出する）場合はNone
+        """
+        if isinstance(error, CallQueueTimeout):
+            # スレッドの空き待ちで期限が切れただけなので、失敗には数えない
+            self._count(model_name, "queue_timeouts")
+            breaker.release()
+            return None
+        self._count(model_name, "failures")
+        if isinstance(error, TimeoutError):
+            self._count(model_name, "timeouts")
+        if not is_retryable(error):
+            # リクエスト自体の誤りなどはモデルの不調ではないのでブレーカーには数えない
+            breaker.release()
+            return None
+        breaker.record_failure()
+        if retry == policy.max_retries:
+            return None
+        if breaker.state == CircuitBreaker.OPEN:
+            # この失敗でブレーカーが開いたら、残りのリトライはせずにフォールバック先へ進む
+            self._count(model_name, "retries_stopped_by_breaker")
+            return None
+        # フルジッター付きの指数バックオフ
+        backoff = self._rng() * min(policy.backoff_max, policy.backoff_base * (2 ** retry))
+        if backoff >= time_left:
+            return None
+        self._count(model_name, "retries")
+        return backoff
+
+    def _on_success(self, model_name: str, policy: CallPolicy, breaker: CircuitBreaker, latency: float) -> None:
+        if policy.slow_call_seconds and latency > policy.slow_call_seconds:
+            # 成功しても遅すぎる呼び出しは負荷が高い兆候として失敗扱いにする
+            breaker.record_failure()
+            self._count(model_name, "slow_calls")
+        else:
+            breaker.record_success()
+        self._count(model_name, "successes")
+
+    def call(self, model_name: str, attempt: Callable[[str, float], str]) -> Tuple[str, str]:
+        """
+        ポリシーに従ってモデルを呼び出す
+
+        Args:
+            model_name: 使いたいモデル名
+            attempt: (モデル名, 残り秒数) を受け取り、1回分の呼び出しを行って返答を返す関数。
+                期限切れやヘッジで結果を使わなくなってもスレッドは止められないので、
+                残り秒数をSDKのタイムアウト（request_options の timeout）に渡して呼び出しを打ち切らせること
+
+        Returns:
+            (返答テキスト, 実際に使ったモデル名)
+
+        Raises:
+            GeminiCallError: フォールバック先を含めて呼び出しに失敗した場合
+        """
+        last_error: Optional[BaseException] = None
+        for current, policy, breaker in self._route(model_name):
+            try:
+                return self._call_with_retries(current, policy, breaker, attempt), current
+            except Exception as e:
+                last_error = e
+                logger.warning("Geminiの呼び出しに失敗しました (model=%s): %r", current, e)
+                if not is_retryable(e):
+                    # 別のモデルでも同じ結果になるのでフォールバックしない
+                    break
+        raise self._call_error(model_name, last_error)
+
+    def _call_with_retries(
+        self, model_name: str, policy: CallPolicy, breaker: CircuitBreaker, attempt: Callable[[str, float], str]
+    ) -> str:
+        deadline = time.monotonic() + policy.deadline
+        for retry in range(policy.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count(model_name, "timeouts")
+                raise TimeoutError(f"Deadline exceeded for {model_name}")
+            self._count(model_name, "calls")
+            try:
+                reply, latency = self._call_once(model_name, policy, attempt, remaining)
+            except Exception as e:
+                backoff = self._on_failure(model_name, policy, breaker, e, retry, deadline - time.monotonic())
+                if backoff is None:
+                    raise
+                self._sleep(backoff)
+                continue
+            self._on_success(model_name, policy, breaker, latency)
+            return reply
+        raise AssertionError("unreachable")
+
+    def _call_once(
+        self, model_name: str, policy: CallPolicy, attempt: Callable[[str, float], str], remaining: float
+    ) -> Tuple[str, float]:
+        start = time.monotonic()
+        end_by = start + remaining
+        tracker = self.latency(model_name)
+        primary = self._executor.submit(attempt, model_name, remaining)
+        futures = [primary]
+
+        hedge_after = None
+        if policy.hedge and len(tracker) >= policy.hedge_min_samples:
+            hedge_after = tracker.percentile(policy.hedge_percentile)
+        if hedge_after is not None and hedge_after < remaining:
+            done, _ = wait([primary], timeout=hedge_after)
+            if not done:
+                # p95を超えても返ってこないので2本目を送り、先に返った方を使う
+                self._count(model_name, "hedges")
+                futures.append(self._hedge_executor.submit(attempt, model_name, end_by - time.monotonic()))
+
+        pending = set(futures)
+        try:
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = wait(pending, timeout=max(0.0, end_by - time.monotonic()), return_when=FIRST_COMPLETED)
+                if not done:
+                    if all(future.cancel() for future in pending):
+                        # どの呼び出しも始まらないまま期限が切れた（スレッドが埋まっている）
+                        raise CallQueueTimeout(f"No call thread became free in time for {model_name}")
+                    raise TimeoutError(f"Deadline exceeded for {model_name}")
+                for future in done:
+                    error = future.exception()
+                    if error is None:
+                        latency = time.monotonic() - start
+                        tracker.record(latency)
+                        if future is not primary:
+                            self._count(model_name, "hedge_wins")
+                        return future.result(), latency
+                    last_error = error
+            raise last_error
+        finally:
+            # 期限切れ・ヘッジで負けた呼び出しはスレッドを止められないので、終わるまで数えておく
+            self._abandon(model_name, pending)
+
+    def _abandon(self, model_name: str, futures) -> None:
+        for future in futures:
+            if future.cancel():
+                continue
+            with self._lock:
+                counters = self._counters.setdefault(model_name, {})
+                counters["abandoned_calls"] = counters.get("abandoned_calls", 0) + 1
+                counters["abandoned_in_flight"] = counters.get("abandoned_in_flight", 0) + 1
+            future.add_done_callback(lambda _, model_name=model_name: self._abandoned_done(model_name))
+
+    def _abandoned_done(self, model_name: str) -> None:
+        with self._lock:
+            self._counters[model_name]["abandoned_in_flight"] -= 1
+
+    # --- asyncio版（ブレーカーとレイテンシの計測はスレッド版と共有する） ---
+
+    async def call_async(self, model_name: str, attempt: Callable[[str, float], Any]) -> Tuple[str, str]:
+        """
+        call のasyncio版
+
+        Args:
+            model_name: 使いたいモデル名
+            attempt: (モデル名, 残り秒数) を受け取り、1回分の呼び出しを行うコルーチン関数
+
+        Returns:
+            (返答テキスト, 実際に使ったモデル名)
+        """
+        last_error: Optional[BaseException] = None
+        for current, policy, breaker in self._route(model_name):
+            try:
+                return await self._call_with_retries_async(current, policy, breaker, attempt), current
+            except Exception as e:
+                last_error = e
+                logger.warning("Geminiの呼び出しに失敗しました (model=%s): %r", current, e)
+                if not is_retryable(e):
+                    # 別のモデルでも同じ結果になるのでフォールバックしない
+                    break
+        raise self._call_error(model_name, last_error)
+
+    async def _call_with_retries_async(
+        self, model_name: str, policy: CallPolicy, breaker: CircuitBreaker, attempt: Callable[[str, float], Any]
+    ) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline
+        for retry in range(policy.max_retries + 1):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._count(model_name, "timeouts")
+                raise TimeoutError(f"Deadline exceeded for {model_name}")
+            self._count(model_name, "calls")
+            try:
+                reply, latency = await self._call_once_async(model_name, policy, attempt, remaining)
+            except Exception as e:
+                backoff = self._on_failure(model_name, policy, breaker, e, retry, deadline - loop.time())
+                if backoff is None:
+                    raise
+                await asyncio.sleep(backoff)
+                continue
+            self._on_success(model_name, policy, breaker, latency)
+            return reply
+        raise AssertionError("unreachable")
+
+    async def _call_once_async(
+        self, model_name: str, policy: CallPolicy, attempt: Callable[[str, float], Any], remaining: float
+    ) -> Tuple[str, float]:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        end_by = start + remaining
+        tracker = self.latency(model_name)
+        primary = asyncio.ensure_future(attempt(model_name, remaining))
+        pending = {primary}
+        try:
+            hedge_after = None
+            if policy.hedge and len(tracker) >= policy.hedge_min_samples:
+                hedge_after = tracker.percentile(policy.hedge_percentile)
+            if hedge_after is not None and hedge_after < remaining:
+                done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+                if not done:
+                    self._count(model_name, "hedges")
+                    pending.add(asyncio.ensure_future(attempt(model_name, end_by - loop.time())))
+
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, end_by - loop.time()), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise TimeoutError(f"Deadline exceeded for {model_name}")
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        latency = loop.time() - start
+                        tracker.record(latency)
+                        if task is not primary:
+                            self._count(model_name, "hedge_wins")
+                        return task.result(), latency
+                    last_error = error
+            raise last_error
+        finally:
+            # 負けた方・期限切れのリクエストは取り消す
+            for task in pending:
+                task.cancel()
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+        self._hedge_executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """モデルごとの呼び出し件数・レイテンシ・ブレーカーの状態を返す"""
+        with self._lock:
+            model_names = set(self._counters) | set(self._breakers) | set(self._latencies)
+            counters = {name: dict(self._counters.get(name, {})) for name in model_names}
+        result = {}
+        for name in sorted(model_names):
+            tracker = self.latency(name)
+            p50 = tracker.percentile(0.5)
+            p95 = tracker.percentile(0.95)
+            result[name] = {
+                **counters[name],
+                "breaker": self._breaker(name).state,
+                "latency_samples": len(tracker),
+                "latency_p50_sec": round(p50, 3) if p50 is not None else None,
+                "latency_p95_sec": round(p95, 3) if p95 is not None else None,
+            }
+        return result
@@ -0,0 +1,459 @@
+"""
+会話履歴ストア
+
+ユーザー/グループ/ルームごとの会話履歴を上限付きで保持する。
+保持する会話数の上限（LRU）とアイドルTTLで古い会話を破棄し、
+エントリごとのおおよそのメモリ量とヒット/ミス/破棄の件数を記録する。
+永続化バックエンドを指定した場合は、ミス時にバックエンドから読み込み、保存時に書き込む。
+
+1会話分の履歴は固定容量のリングバッファ（HistoryRing）で持ち、
+メッセージごとのリストの切り出しやdictの作り直しをしない。
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+# 1ターン（{"role": ..., "parts": [...]}）あたりの固定オーバーヘッドの概算（バイト）
+_TURN_OVERHEAD_BYTES = 400
+
+_MISSING = object()
+
+
+class TurnRecord(Mapping):
+    """
+    会話の1ターン
+
+    Gemini SDKにはそのまま {"role": ..., "parts": [...]} 形式のdictとして渡せるよう、
+    Mappingとして振る舞う（SDKが内部で呼ぶcopy()も用意する）。
+    """
+
+    __slots__ = ("role", "parts", "chars")
+
+    def __init__(self, role: str, text: str) -> None:
+        self.role = role
+        self.parts = (text,)
+        self.chars = len(text)
+
+    @property
+    def text(self) -> str:
+        return self.parts[0]
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "role":
+            return self.role
+        if key == "parts":
+            return self.parts
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(("role", "parts"))
+
+    def __len__(self) -> int:
+        return 2
+
+    def copy(self) -> Dict[str, Any]:
+        return {"role": self.role, "parts": list(self.parts)}
+
+    def __repr__(self) -> str:
+        return f"TurnRecord(role={self.role!r}, chars={self.chars})"
+
+
+class HistoryRing:
+    """
+    1会話分の履歴を保持する固定容量のリングバッファ
+
+    容量を超えると最も古いターンを上書きする。ターン数と合計文字数はO(1)で取得でき、
+    反復はコピーを作らずに古い順にターンを返す。
+    ターンごとに追加時点までの累計文字数を持つので、新しい方からk件の文字数も引き算1回で求まる。
+    """
+
+    __slots__ = ("_buf", "_offsets", "_capacity", "_start", "_count", "_chars", "_appended")
+
+    def __init__(self, capacity: int = 10) -> None:
+        self._capacity = max(1, capacity)
+        self._buf: List[Optional[TurnRecord]] = [None] * self._capacity
+        # 各ターンを追加する直前までに追加した文字数の累計（_buf と同じ位置に入れる）
+        self._offsets: List[int] = [0] * self._capacity
+        self._start = 0
+        self._count = 0
+        self._chars = 0
+        # これまでに追加した文字数の累計（上書き・取り出しでは減らさない）
+        self._appended = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def total_chars(self) -> int:
+        """保持しているターンの合計文字数"""
+        return self._chars
+
+    def append(self, role: str, text: str) -> None:
+        """ターンを追加する（満杯なら最も古いターンを上書き）"""
+        record = TurnRecord(role, text)
+        if self._count == self._capacity:
+            slot = self._start
+            self._chars -= self._buf[slot].chars
+            self._start = (self._start + 1) % self._capacity
+        else:
+            slot = (self._start + self._count) % self._capacity
+            self._count += 1
+        self._buf[slot] = record
+        self._offsets[slot] = self._appended
+        self._appended += record.chars
+        self._chars += record.chars
+
+    def popleft(self) -> TurnRecord:
+        """最も古いターンを取り出す"""
+        if not self._count:
+            raise IndexError("pop from an empty HistoryRing")
+        record = self._buf[self._start]
+        self._buf[self._start] = None
+        self._start = (self._start + 1) % self._capacity
+        self._count -= 1
+        self._chars -= record.chars
+        return record
+
+    def newest_within(self, max_chars: int) -> int:
+        """
+        合計文字数がmax_chars以下に収まる新しいターンの数を返す（履歴は変更しない）
+
+        新しい方から数え、予算を超えるターンに当たったらそこで止める。
+        渡す履歴がモデルの発言から始まらないよう、先頭になるmodelターンは数に含めない。
+        すべて収まる場合はO(1)、収まらない場合も累計文字数の二分探索で求める（ターンを1件ずつ足し合わせない）。
+        """
+        buf, offsets, start, capacity = self._buf, self._offsets, self._start, self._capacity
+        if self._chars <= max_chars:
+            count = self._count
+        else:
+            # 古い方からi件を除いた合計は _appended - offsets[i件目] で、iが大きいほど小さくなる。
+            # 予算に収まる最小のiを探す（i == _count なら1件も収まらない）
+            lo, hi = 1, self._count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._appended - offsets[(start + mid) % capacity] <= max_chars:
+                    hi = mid
+                else:
+                    lo = mid + 1
+            count = self._count - lo
+        while count and buf[(start + self._count - count) % capacity].role != "user":
+            count -= 1
+        return count
+
+    def iter_from(self, skip: int) -> Iterator[TurnRecord]:
+        """古い方からskip件を飛ばしてターンを返す"""
+        buf, start, capacity = self._buf, self._start, self._capacity
+        for i in range(max(0, skip), self._count):
+            yield buf[(start + i) % capacity]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[TurnRecord]:
+        buf, start, capacity = self._buf, self._start, self._capacity
+        for i in range(self._count):
+            yield buf[(start + i) % capacity]
+
+    def __reversed__(self) -> Iterator[TurnRecord]:
+        buf, start, capacity = self._buf, self._start, self._capacity
+        for i in range(self._count - 1, -1, -1):
+            yield buf[(start + i) % capacity]
+
+    def approx_bytes(self) -> int:
+        """おおよそのメモリ量（バイト）。文字数から概算する"""
+        # 日本語は1文字2バイト、ターンごとにTurnRecordと文字列のヘッダ分を加算
+        return sys.getsizeof(self._buf) + self._count * 150 + self._chars * 2
+
+    def to_list(self) -> List[Dict[str, Any]]:
+        """永続化用に {"role": ..., "parts": [...]} のリストに変換する"""
+        return [record.copy() for record in self]
+
+    @classmethod
+    def from_list(cls, turns: List[Dict[str, Any]], capacity: int = 10) -> "HistoryRing":
+        """to_list() の形式（従来のchat_historiesの形式）から復元する"""
+        ring = cls(capacity)
+        for turn in turns:
+            parts = turn.get("parts") or [""]
+            ring.append(turn.get("role", "user"), "".join(str(part) for part in parts))
+        return ring
+
+    def __repr__(self) -> str:
+        return f"HistoryRing(turns={self._count}, capacity={self._capacity}, chars={self._chars})"
+
+
+# ピン留めした要約を履歴の先頭に差し込むときの定型文
+_PINNED_SUMMARY_PREFIX = "【これまでの会話の要約】"
+_PINNED_SUMMARY_ACK = "了解"
+
+
+def fit_history_to_budget(
+    history: HistoryRing,
+    char_budget: int,
+    pinned_summary: Optional[str] = None,
+    reserve_chars: int = 0
+) -> Iterable[TurnRecord]:
+    """
+    文字数の予算に収まる新しいターンだけを選び、モデルに渡す履歴を返す
+
+    予算にはピン留めの要約と、これから送るユーザー入力（reserve_chars）も含める。
+    最新のターンを優先して選び、要約がある場合は先頭に1往復分として差し込む。
+    履歴そのものは変更しない（古いターンはリングバッファの容量を超えたときだけ上書きされる）ので、
+    予算の小さいモデルへの呼び出しや長いメッセージ1件で、他のモデルが使える履歴が減ることはない。
+
+    Args:
+        history: 会話のリングバッファ
+        char_budget: 履歴全体の文字数の上限
+        pinned_summary: 常に先頭に入れる要約（これまでの記憶など）
+        reserve_chars: 履歴以外に使う文字数（今回のユーザー入力など）
+
+    Returns:
+        start_chatにそのまま渡せるターンの列
+    """
+    pinned_chars = 0
+    if pinned_summary:
+        pinned_chars = len(_PINNED_SUMMARY_PREFIX) + len(pinned_summary) + len(_PINNED_SUMMARY_ACK)
+    keep = history.newest_within(max(0, char_budget - reserve_chars - pinned_chars))
+    window = _HistoryWindow(history, len(history) - keep)
+    if not pinned_summary:
+        return window
+    return _PinnedHistory(pinned_summary, window)
+
+
+class _HistoryWindow:
+    """履歴の新しい方の一部を反復するビュー（履歴はコピーしない）"""
+
+    __slots__ = ("_history", "_skip")
+
+    def __init__(self, history: HistoryRing, skip: int) -> None:
+        self._history = history
+        self._skip = skip
+
+    def __len__(self) -> int:
+        return max(0, len(self._history) - self._skip)
+
+    def __iter__(self) -> Iterator[TurnRecord]:
+        return self._history.iter_from(self._skip)
+
+
+class _PinnedHistory:
+    """ピン留めの要約を先頭に付けて履歴を反復するビュー（履歴はコピーしない）"""
+
+    __slots__ = ("_head", "_history")
+
+    def __init__(self, pinned_summary: str, history: Iterable[TurnRecord]) -> None:
+        self._head = (
+            TurnRecord("user", _PINNED_SUMMARY_PREFIX + pinned_summary),
+            TurnRecord("model", _PINNED_SUMMARY_ACK),
+        )
+        self._history = history
+
+    def __len__(self) -> int:
+        return len(self._head) + len(self._history)
+
+    def __iter__(self) -> Iterator[TurnRecord]:
+        yield from self._head
+        yield from self._history
+
+
+def estimate_history_size(history: Any) -> int:
+    """会話履歴のおおよそのメモリ量（バイト）を見積もる"""
+    if isinstance(history, HistoryRing):
+        return history.approx_bytes()
+    size = sys.getsizeof(history)
+    for turn in history:
+        size += _TURN_OVERHEAD_BYTES
+        for part in turn.get("parts", ()):
+            size += sys.getsizeof(part)
+    return size
+
+
+class _Entry:
+    __slots__ = ("history", "size", "last_access")
+
+    def __init__(self, history: Any, size: int, last_access: float) -> None:
+        self.history = history
+        self.size = size
+        self.last_access = last_access
+
+
+class HistoryStore:
+    """会話数の上限とアイドルTTLを持つLRUの会話履歴ストア"""
+
+    def __init__(
+        self,
+        max_conversations: int = 5000,
+        idle_ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sizer: Callable[[Any], int] = estimate_history_size,
+        clock: Callable[[], float] = time.monotonic,
+        backend: Optional[Any] = None,
+        serializer: Callable[[Any], Any] = lambda history: history,
+        deserializer: Callable[[Any], Any] = lambda data: data
+    ) -> None:
+        """
+        Args:
+            max_conversations: 保持する会話の最大数
+            idle_ttl: 最後のアクセスからこの秒数を過ぎた会話を破棄する（Noneなら無期限）
+            max_bytes: 全会話の合計メモリ量の上限（Noneなら無制限）
+            sizer: 履歴1件分のメモリ量を見積もる関数
+            clock: 現在時刻を返す関数
+            backend: 永続化先（session_backend.SessionBackend）。Noneならメモリ内のみ
+            serializer: 永続化先に書き込む前に履歴を変換する関数
+            deserializer: 永続化先から読み込んだデータを履歴に戻す関数
+        """
+        self._max_conversations = max(1, max_conversations)
+        self._idle_ttl = idle_ttl if idle_ttl and idle_ttl > 0 else None
+        self._max_bytes = max_bytes if max_bytes and max_bytes > 0 else None
+        self._sizer = sizer
+        self._clock = clock
+        self._backend = backend
+        self._serializer = serializer
+        self._deserializer = deserializer
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._backend_loads = 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """会話履歴を取得する（期限切れの場合は破棄してdefaultを返す）"""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry, now):
+                self._remove_locked(key)
+                self._expirations += 1
+                entry = None
+            if entry is not None:
+                entry.last_access = now
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry.history
+            self._misses += 1
+
+        # メモリ上になければ永続化先から読み込む（リードスルー）
+        if self._backend is None:
+            return default
+        data = self._backend.get_history(key)
+        if data is None:
+            return default
+        history = self._deserializer(data)
+        size = self._sizer(history)
+        with self._lock:
+            self._backend_loads += 1
+            if key not in self._entries:
+                self._entries[key] = _Entry(history, size, now)
+                self._total_bytes += size
+                self._evict_locked(now)
+        return history
+
+    def __getitem__(self, key: str) -> Any:
+        history = self.get(key, _MISSING)
+        if history is _MISSING:
+            raise KeyError(key)
+        return history
+
+    def __setitem__(self, key: str, history: Any) -> None:
+        self.set(key, history)
+
+    def set(self, key: str, history: Any) -> None:
+        """会話履歴を保存し、上限を超えた分を古い順に破棄する"""
+        now = self._clock()
+        size = self._sizer(history)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old.size
+            self._entries[key] = _Entry(history, size, now)
+            self._total_bytes += size
+            self._evict_locked(now)
+        if self._backend is not None:
+            self._backend.put_history(key, self._serializer(history))
+
+    def touch(self, key: str) -> None:
+        """保存済み履歴の内容が変わったときにメモリ量を再計算する"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            size = self._sizer(entry.history)
+            self._total_bytes += size - entry.size
+            entry.size = size
+            self._evict_locked(self._clock())
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._remove_locked(key)
+        return default if entry is None else entry.history
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def keys(self) -> List[str]:
+        """メモリ上にある会話のキーの一覧（呼び出した時点のコピー）"""
+        with self._lock:
+            return list(self._entries)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _is_expired(self, entry: _Entry, now: float) -> bool:
+        return self._idle_ttl is not None and now - entry.last_access > self._idle_ttl
+
+    def _remove_locked(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry.size
+        return entry
+
+    def _evict_locked(self, now: float) -> None:
+        # 先頭ほど最後のアクセスが古いので、期限切れは先頭から順に破棄できる
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if not self._is_expired(entry, now):
+                break
+            self._remove_locked(key)
+            self._expirations += 1
+
+        while len(self._entries) > self._max_conversations or (
+            self._max_bytes is not None and self._total_bytes > self._max_bytes and len(self._entries) > 1
+        ):
+            key = next(iter(self._entries))
+            self._remove_locked(key)
+            self._evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """サイズ調整用の統計を返す"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            count = len(self._entries)
+            return {
+                "conversations": count,
+                "max_conversations": self._max_conversations,
+                "total_bytes": self._total_bytes,
+                "avg_bytes_per_conversation": self._total_bytes // count if count else 0,
+                "max_bytes": self._max_bytes,
+                "idle_ttl_sec": self._idle_ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "backend_loads": self._backend_loads,
+            }
+
@@ -0,0 +1,155 @@
+"""
+キーごとのロック
+
+同じ会話（送信元ID）の処理は1件ずつ順番に実行し、異なる会話は並行して実行できるようにする。
+ロックは使用中のキーの分だけ作り、誰も使わなくなったら破棄するので、キーの数だけ増え続けることはない。
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterator
+
+
+class _KeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # このロックを保持中または待機中のスレッド数
+        self.users = 0
+
+
+class _LockTable:
+    """
+    KeyedLocks と AsyncKeyedLocks に共通の、キーごとのロックの作成・破棄と待ち時間の計測
+
+    スレッド版とasyncio版で後片付けや計測がずれないよう、ロックの種類以外はここで扱う。
+    """
+
+    def __init__(self, entry_factory: Callable[[], Any]) -> None:
+        self._entry_factory = entry_factory
+        self._locks: Dict[Hashable, Any] = {}
+        self._guard = threading.Lock()
+        self._acquisitions = 0
+        self._contended = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _enter(self, key: Hashable) -> Any:
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = self._entry_factory()
+            entry.users += 1
+            return entry
+
+    def _leave(self, key: Hashable, entry: Any) -> None:
+        with self._guard:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._locks[key]
+
+    def _acquired(self, contended: bool, wait: float) -> None:
+        with self._guard:
+            self._acquisitions += 1
+            if contended:
+                self._contended += 1
+                self._total_wait += wait
+                if wait > self._max_wait:
+                    self._max_wait = wait
+
+    def stats(self) -> Dict[str, Any]:
+        with self._guard:
+            return {
+                "active_keys": len(self._locks),
+                "acquisitions": self._acquisitions,
+                "contended": self._contended,
+                "avg_contended_wait_sec": round(self._total_wait / self._contended, 4) if self._contended else 0.0,
+                "max_wait_sec": round(self._max_wait, 4),
+            }
+
+
+class KeyedLocks(_LockTable):
+    """キーごとの排他ロックの集合"""
+
+    def __init__(self) -> None:
+        super().__init__(_KeyLock)
+
+    @contextmanager
+    def hold(self, key: Hashable) -> Iterator[None]:
+        """キーのロックを取得している間だけブロックを実行する"""
+        entry = self._enter(key)
+        try:
+            start = time.monotonic()
+            contended = not entry.lock.acquire(blocking=False)
+            if contended:
+                entry.lock.acquire()
+            self._acquired(contended, time.monotonic() - start)
+            try:
+                yield
+            finally:
+                entry.lock.release()
+        finally:
+            self._leave(key, entry)
+
+    @asynccontextmanager
+    async def hold_async(self, key: Hashable) -> AsyncIterator[None]:
+        """
+        hold のasyncio版（スレッド版と同じロックを取るので、スレッドとタスクの間でも1件ずつになる）
+
+        ロックが使用中なら別のスレッドで待ち、その間イベントループは止めない。
+        """
+        entry = self._enter(key)
+        start = time.monotonic()
+        contended = not entry.lock.acquire(blocking=False)
+        if contended:
+            acquiring = asyncio.ensure_future(asyncio.to_thread(entry.lock.acquire))
+            try:
+                await asyncio.shield(acquiring)
+            except BaseException:
+                # 待っている間にキャンセルされても待機中のスレッドは止められないので、取れた時点で手放す
+                acquiring.add_done_callback(lambda _: self._release(key, entry))
+                raise
+        self._acquired(contended, time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release(key, entry)
+
+    def _release(self, key: Hashable, entry: _KeyLock) -> None:
+        entry.lock.release()
+        self._leave(key, entry)
+
+
+class _AsyncKeyLock:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # このロックを保持中または待機中のタスク数
+        self.users = 0
+
+
+class AsyncKeyedLocks(_LockTable):
+    """キーごとの排他ロックの集合（asyncio版、1つのイベントループ内で使う）"""
+
+    def __init__(self) -> None:
+        super().__init__(_AsyncKeyLock)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """キーのロックを取得している間だけブロックを実行する"""
+        entry = self._enter(key)
+        try:
+            start = time.monotonic()
+            contended = entry.lock.locked()
+            await entry.lock.acquire()
+            self._acquired(contended, time.monotonic() - start)
+            try:
+                yield
+            finally:
+                entry.lock.release()
+        finally:
+            self._leave(key, entry)
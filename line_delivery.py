@@ -0,0 +1,211 @@
+"""
+LINEへの返信（リプライトークンの期限管理とプッシュメッセージへの切り替え）
+
+Webhookでイベントを受け取った時刻をリプライトークンごとに記録し、
+返信時にトークンがまだ使えそうならreply_message、期限切れの見込みならpush_messageで送る。
+キュー待ちやリトライで生成が遅れたときに返信が黙って失われないようにする。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from linebot.exceptions import LineBotApiError
+
+logger = logging.getLogger(__name__)
+
+
+def is_invalid_reply_token(error: LineBotApiError) -> bool:
+    """リプライトークンが無効（期限切れ・使用済み）で返信できなかったエラーか"""
+    if error.status_code != 400:
+        return False
+    message = getattr(getattr(error, "error", None), "message", None) or str(error)
+    return "invalid reply token" in message.lower()
+
+
+class ReplyDelivery:
+    """リプライトークンの受信時刻を追跡し、返信方法（reply/push）を選んで送信する"""
+
+    def __init__(
+        self,
+        line_bot_api: Any,
+        token_ttl: float = 50.0,
+        safety_margin: float = 2.0,
+        tracking_ttl: float = 300.0,
+        clock=time.time
+    ) -> None:
+        """
+        Args:
+            line_bot_api: LineBotApi
+            token_ttl: 受信からリプライトークンを有効とみなす秒数
+            safety_margin: 送信にかかる時間を見込んで期限から差し引く秒数
+            tracking_ttl: 受信時刻の記録を保持する秒数
+            clock: 現在時刻（UNIX秒）を返す関数
+        """
+        self._api = line_bot_api
+        self._token_ttl = token_ttl
+        self._safety_margin = safety_margin
+        self._tracking_ttl = tracking_ttl
+        self._clock = clock
+        # リプライトークン → 受信時刻（UNIX秒）。受信順に並ぶ
+        self._received: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "replied": 0,
+            "pushed_token_expired": 0,
+            "pushed_after_reply_error": 0,
+            "reply_failed": 0,
+            "push_failed": 0,
+        }
+        self._reply_age_total = 0.0
+        self._reply_age_max = 0.0
+
+    def mark_received(self, events: Iterable[Any], received_at: Optional[float] = None) -> None:
+        """Webhookで受け取ったイベントの受信時刻を記録する"""
+        received_at = self._clock() if received_at is None else received_at
+        with self._lock:
+            for event in events:
+                reply_token = getattr(event, "reply_token", None)
+                if reply_token:
+                    self._received[reply_token] = received_at
+            # 古い記録を捨てる（受信順なので先頭から）
+            while self._received:
+                token, at = next(iter(self._received.items()))
+                if received_at - at <= self._tracking_ttl:
+                    break
+                del self._received[token]
+
+    def token_age(self, event: Any) -> float:
+        """イベントのリプライトークンが発行されてからの経過秒数の見積もり"""
+        now = self._clock()
+        with self._lock:
+            received_at = self._received.get(getattr(event, "reply_token", None))
+        if received_at is None:
+            # 受信時刻の記録がなければLINE側のイベント発生時刻で見積もる
+            received_at = getattr(event, "timestamp", now * 1000) / 1000
+        return max(0.0, now - received_at)
+
+    def is_usable(self, event: Any, age: Optional[float] = None) -> bool:
+        """リプライトークンがまだ使える見込みか（age: 計算済みの token_age）"""
+        if not getattr(event, "reply_token", None):
+            return False
+        if age is None:
+            age = self.token_age(event)
+        return age + self._safety_margin < self._token_ttl
+
+    def send(self, to: str, events: List[Any], messages: Any) -> str:
+        """
+        まだ使えそうな最初のリプライトークンで返信し、なければプッシュメッセージで送る
+
+        Args:
+            to: プッシュ時の送信先（ユーザー/グループ/ルームID）
+            events: 返信対象のイベント（連投をまとめた場合は複数）
+            messages: 送信するメッセージ
+
+        Returns:
+            "reply" または "push"
+        """
+        target = self._reply_target(events)
+        if target is not None:
+            event, age = target
+            try:
+                self._api.reply_message(event.reply_token, messages)
+            except LineBotApiError as e:
+                counter = self._reply_failed(events, e)
+                if counter is None:
+                    raise
+            else:
+                self._replied(events, age)
+                return "reply"
+        else:
+            counter = self._token_expired(events)
+        try:
+            self._api.push_message(to, messages)
+        except LineBotApiError:
+            self._count("push_failed")
+            raise
+        self._count(counter)
+        return "push"
+
+    async def send_async(self, to: str, events: List[Any], messages: Any) -> str:
+        """send のasyncio版（line_bot_apiにはAsyncLineBotApiを渡しておく）"""
+        target = self._reply_target(events)
+        if target is not None:
+            event, age = target
+            try:
+                await self._api.reply_message(event.reply_token, messages)
+            except LineBotApiError as e:
+                counter = self._reply_failed(events, e)
+                if counter is None:
+                    raise
+            else:
+                self._replied(events, age)
+                return "reply"
+        else:
+            counter = self._token_expired(events)
+        try:
+            await self._api.push_message(to, messages)
+        except LineBotApiError:
+            self._count("push_failed")
+            raise
+        self._count(counter)
+        return "push"
+
+    # 送信の判断と計測はスレッド版とasyncio版で共有し、API呼び出しだけをそれぞれで行う
+
+    def _reply_target(self, events: List[Any]) -> Optional[Tuple[Any, float]]:
+        """返信に使うイベントとそのトークンの経過秒数。使えるトークンがなければNone"""
+        for event in events:
+            age = self.token_age(event)
+            if self.is_usable(event, age):
+                return event, age
+        return None
+
+    def _replied(self, events: List[Any], age: float) -> None:
+        with self._lock:
+            self._counters["replied"] += 1
+            self._reply_age_total += age
+            if age > self._reply_age_max:
+                self._reply_age_max = age
+        self._forget(events)
+
+    def _reply_failed(self, events: List[Any], error: LineBotApiError) -> Optional[str]:
+        """
+        リプライの失敗を記録し、プッシュで送り直すならそのカウンタ名を返す
+
+        送り直すのはリプライトークンが無効（期限切れ・使用済み）な場合だけ。
+        サーバーエラーなどはリプライが届いている可能性があり、プッシュすると二重に送ってしまうのでNoneを返す（呼び出し元で送出する）。
+        """
+        if not is_invalid_reply_token(error):
+            logger.warning("リプライに失敗しました (status=%s): %s", error.status_code, error)
+            self._count("reply_failed")
+            return None
+        logger.warning("リプライトークンが無効だったためプッシュで送信します (status=%s)", error.status_code)
+        self._forget(events)
+        return "pushed_after_reply_error"
+
+    def _token_expired(self, events: List[Any]) -> str:
+        self._forget(events)
+        return "pushed_token_expired"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def _forget(self, events: Iterable[Any]) -> None:
+        with self._lock:
+            for event in events:
+                self._received.pop(getattr(event, "reply_token", None), None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            replied = self._counters["replied"]
+            return {
+                **self._counters,
+                "tracked_tokens": len(self._received),
+                "token_ttl_sec": self._token_ttl,
+                "avg_reply_token_age_sec": round(self._reply_age_total / replied, 3) if replied else 0.0,
+                "max_reply_token_age_sec": round(self._reply_age_max, 3),
+            }
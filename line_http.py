@@ -0,0 +1,216 @@
+"""
+LINE Messaging API 用のHTTPクライアント
+
+line-bot-sdk 標準の RequestsHttpClient はリクエストごとに requests.post() を呼ぶため、
+負荷が高いと接続とTLSハンドシェイクのコストが毎回かかる。
+ここではプロセス全体で共有するコネクションプール（keep-alive）を使うクライアントを用意する。
+httpx と h2 がインストールされていて LINE_HTTP2=1 の場合はHTTP/2で接続する。
+"""
+
+import functools
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.http_client import HttpClient, HttpResponse, RequestsHttpResponse
+
+try:
+    import httpx
+except ImportError:  # HTTP/2 を使わない場合は不要
+    httpx = None
+
+
+class PooledHttpClient(HttpClient):
+    """requests.Session のコネクションプールを使い回すHTTPクライアント"""
+
+    def __init__(self, timeout: Any = None, pool_maxsize: int = 16, keep_alive: bool = True) -> None:
+        """
+        Args:
+            timeout: 既定のタイムアウト（秒、または (接続, 読み込み) のタプル）
+            pool_maxsize: 接続先ごとに保持する最大接続数
+            keep_alive: Falseなら毎回接続を閉じる（比較・切り分け用）
+        """
+        super().__init__(timeout=timeout)
+        self._session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(1, pool_maxsize))
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+        if not keep_alive:
+            self._session.headers["Connection"] = "close"
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+
+    def _request(self, method: str, url: str, timeout: Any, **kwargs: Any) -> HttpResponse:
+        try:
+            response = self._session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self._errors += 1
+            raise
+        with self._lock:
+            self._requests += 1
+        return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, timeout, headers=headers, params=params, stream=stream)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, timeout, headers=headers, data=data)
+
+    def close(self) -> None:
+        self._session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """リクエスト数と新規接続数から接続の再利用率を返す"""
+        connections = 0
+        pool_requests = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+        with self._lock:
+            return {
+                "client": "requests",
+                "http_version": "HTTP/1.1",
+                "requests": self._requests,
+                "errors": self._errors,
+                "connections_opened": connections,
+                "connection_reuse_rate": round(1 - connections / pool_requests, 4) if pool_requests else None,
+            }
+
+
+class _HttpxResponse(HttpResponse):
+    """httpx.Response を line-bot-sdk の HttpResponse として扱うラッパー"""
+
+    def __init__(self, response: Any) -> None:
+        self.response = response
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    @property
+    def text(self):
+        return self.response.text
+
+    @property
+    def content(self):
+        return self.response.content
+
+    @property
+    def json(self):
+        return self.response.json()
+
+    def iter_content(self, chunk_size=1024):
+        return self.response.iter_bytes(chunk_size)
+
+
+class Http2Client(HttpClient):
+    """httpx（HTTP/2）のコネクションプールを使い回すHTTPクライアント"""
+
+    def __init__(self, timeout: Any = None, pool_maxsize: int = 16, keep_alive: bool = True) -> None:
+        super().__init__(timeout=timeout)
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self._client = httpx.Client(
+            http2=True,
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(
+                max_connections=max(1, pool_maxsize),
+                max_keepalive_connections=max(1, pool_maxsize) if keep_alive else 0,
+            ),
+        )
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._http_versions: Dict[str, int] = {}
+        # 使った接続（ネットワークストリーム）のid。新規接続数の計測用
+        self._streams = set()
+
+    def _request(self, method: str, url: str, timeout: Any, **kwargs: Any) -> HttpResponse:
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        if kwargs.get("data") is not None:
+            kwargs["content"] = kwargs.pop("data")
+        else:
+            kwargs.pop("data", None)
+        try:
+            response = self._client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            with self._lock:
+                self._errors += 1
+            raise
+        stream = response.extensions.get("network_stream")
+        with self._lock:
+            self._requests += 1
+            self._http_versions[response.http_version] = self._http_versions.get(response.http_version, 0) + 1
+            if stream is not None and len(self._streams) < 10000:
+                self._streams.add(id(stream))
+        return _HttpxResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, timeout, headers=headers, params=params)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, timeout, headers=headers, data=data)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, timeout, headers=headers, data=data)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, timeout, headers=headers, data=data)
+
+    def close(self) -> None:
+        self._client.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            connections = len(self._streams)
+            return {
+                "client": "httpx",
+                "http_versions": dict(self._http_versions),
+                "requests": self._requests,
+                "errors": self._errors,
+                "connections_opened": connections,
+                "connection_reuse_rate": round(1 - connections / self._requests, 4) if self._requests and connections else None,
+            }
+
+
+def _http2_available() -> bool:
+    if httpx is None:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_line_http_client_factory(http2: Optional[bool] = None) -> Callable[..., HttpClient]:
+    """
+    LineBotApi(http_client=...) に渡すクライアントのファクトリを環境変数の設定から作る
+
+    LINE_HTTP_POOL_SIZE: 最大接続数（既定16）
+    LINE_HTTP_KEEPALIVE: 0なら毎回接続を閉じる
+    LINE_HTTP2: 1ならHTTP/2を使う（httpx と h2 がない場合はHTTP/1.1のまま）
+    """
+    pool_maxsize = int(os.getenv("LINE_HTTP_POOL_SIZE", "16"))
+    keep_alive = os.getenv("LINE_HTTP_KEEPALIVE", "1") != "0"
+    if http2 is None:
+        http2 = os.getenv("LINE_HTTP2", "0") == "1"
+    client_class = Http2Client if http2 and _http2_available() else PooledHttpClient
+    return functools.partial(client_class, pool_maxsize=pool_maxsize, keep_alive=keep_alive)
@@ -0,0 +1,300 @@
+"""
+会話ログのアーカイブ（追記専用のジャーナル）
+
+very_long_log の保持件数（session_model.VERY_LONG_LOG_RETENTION）からあふれた古い会話ログを、
+クライアントごとの追記専用ファイルに書き出し、新しい方から必要な件数だけをメモリマップで読み出す。
+ファイル全体を読み込まないので、何か月分のログがあってもメモリ使用量と起動時間は増えない。
+
+ジャーナル（<クライアントID>.log）:
+    先頭に _JOURNAL_MAGIC、続いて1件ごとに [長さ(4バイト) | CRC32(4バイト) | 会話ログ1件のJSON(UTF-8)]
+    書き込み途中で止まって欠けた末尾は、読み込みでは無視し、次の追記の前に切り捨てる。
+
+索引（<クライアントID>.idx）:
+    先頭に [_INDEX_MAGIC | 間隔 | 件数 | 索引済みのバイト数]、続いて「間隔」件ごとのレコードの位置（8バイトずつ）
+    索引済みの範囲より後ろは読み出しのたびに先頭から辿るので、その範囲が compact_bytes を超えたら
+    追記のついでに索引を作り直す（一時ファイルから置き換える）。
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+from session_model import LogEntry
+
+logger = logging.getLogger(__name__)
+
+_JOURNAL_MAGIC = b"ADLOGJ1\n"
+_INDEX_MAGIC = b"ADLOGI1\n"
+# レコードの見出し: 長さ, CRC32
+_RECORD_HEADER = struct.Struct(">II")
+# 索引の見出し: マジック, 間隔, 件数, 索引済みのバイト数
+_INDEX_HEADER = struct.Struct(">8sIQQ")
+_OFFSET = struct.Struct(">Q")
+
+
+class _Index:
+    __slots__ = ("stride", "count", "size", "offsets")
+
+    def __init__(self, stride: int, count: int, size: int, offsets: List[int]) -> None:
+        self.stride = stride
+        # 索引済みのレコード数と、その末尾の位置
+        self.count = count
+        self.size = size
+        # レコード番号 0, stride, 2*stride, ... の位置
+        self.offsets = offsets
+
+
+def _scan(mm, pos: int) -> Tuple[int, List[int]]:
+    """pos から完全なレコードを辿り、(最後の完全なレコードの末尾, 各レコードの位置) を返す"""
+    offsets = []
+    size = len(mm)
+    while pos + _RECORD_HEADER.size <= size:
+        length, crc = _RECORD_HEADER.unpack_from(mm, pos)
+        start = pos + _RECORD_HEADER.size
+        if start + length > size or zlib.crc32(mm[start:start + length]) != crc:
+            break
+        offsets.append(pos)
+        pos = start + length
+    return pos, offsets
+
+
+class LogArchive:
+    """クライアントごとの追記専用の会話ログジャーナル"""
+
+    def __init__(self, directory: str, index_stride: int = 64, compact_bytes: int = 64 * 1024) -> None:
+        """
+        Args:
+            directory: ファイルを置くディレクトリ（なければ最初の追記のときに作る）
+            index_stride: 索引に位置を記録する間隔（件）
+            compact_bytes: 索引済みの範囲より後ろがこのバイト数を超えたら索引を作り直す
+        """
+        self._directory = directory
+        self._stride = max(1, index_stride)
+        self._compact_bytes = max(1, compact_bytes)
+        # 読み取り専用のファイルシステムでも起動できるよう、ディレクトリは追記するときに作る
+        self._directory_ready = False
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "appends": 0,
+            "entries_written": 0,
+            "bytes_written": 0,
+            "index_compactions": 0,
+            "truncated_tails": 0,
+            "tail_reads": 0,
+            "entries_read": 0,
+            "errors": 0,
+            "entries_dropped": 0,
+        }
+
+    def path(self, client_id: str) -> str:
+        # クライアントIDはそのままファイル名にできるとは限らないのでエスケープする
+        return os.path.join(self._directory, quote(client_id, safe="") + ".log")
+
+    def _index_path(self, client_id: str) -> str:
+        return os.path.join(self._directory, quote(client_id, safe="") + ".idx")
+
+    def append(self, client_id: str, entries: Iterable[LogEntry]) -> int:
+        """
+        会話ログを古い順に追記する（同じクライアントへの追記はクライアントのロックを保持して呼ぶ）
+
+        Returns:
+            追記した件数
+
+        Raises:
+            OSError: 書き込みに失敗した場合
+        """
+        payloads = [json.dumps(entry.to_dict(), ensure_ascii=False).encode("utf-8") for entry in entries]
+        if not payloads:
+            return 0
+        path = self.path(client_id)
+        try:
+            if not self._directory_ready:
+                os.makedirs(self._directory, exist_ok=True)
+                self._directory_ready = True
+            index, end, offsets = self._locate_end(client_id, path)
+            with open(path, "r+b" if end else "wb") as f:
+                if not end:
+                    f.write(_JOURNAL_MAGIC)
+                    end = len(_JOURNAL_MAGIC)
+                elif f.seek(0, os.SEEK_END) > end:
+                    # 前回の書き込みが途中で止まった残りを捨ててから追記する
+                    f.truncate(end)
+                    self._count("truncated_tails")
+                f.seek(end)
+                data = bytearray()
+                for payload in payloads:
+                    offsets.append(end + len(data))
+                    data += _RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+                    data += payload
+                f.write(data)
+            end += len(data)
+            if end - index.size >= self._compact_bytes:
+                self._write_index(client_id, index, offsets, end)
+        except OSError:
+            self._count("errors")
+            raise
+        with self._lock:
+            self._counters["appends"] += 1
+            self._counters["entries_written"] += len(payloads)
+            self._counters["bytes_written"] += len(data)
+        return len(payloads)
+
+    def _locate_end(self, client_id: str, path: str) -> Tuple[_Index, int, List[int]]:
+        """(索引, 最後の完全なレコードの末尾, 索引より後ろのレコードの位置) を返す。ファイルがなければ末尾は0"""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return self._empty_index(), 0, []
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(_JOURNAL_MAGIC):
+                return self._empty_index(), 0, []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(_JOURNAL_MAGIC)] != _JOURNAL_MAGIC:
+                    raise OSError(f"not a conversation journal: {path}")
+                index = self._load_index(client_id, size)
+                end, offsets = _scan(mm, index.size)
+        return index, end, offsets
+
+    def size(self, client_id: str) -> int:
+        """
+        ジャーナルのバイト数（ファイルがなければ0）
+
+        ファイルの中身は読まないので、クライアントのロックを保持したまま呼んでよい。
+        ここで得た値を tail の end に渡すと、ロックを外した後に追記された分を読まずに済む。
+        """
+        try:
+            return os.stat(self.path(client_id)).st_size
+        except FileNotFoundError:
+            return 0
+
+    def tail(self, client_id: str, count: int, end: Optional[int] = None) -> List[LogEntry]:
+        """
+        書き出した会話ログの新しい方から最大count件を古い順に返す（必要な範囲だけを読む）
+
+        end を渡すと、ジャーナルの先頭からそのバイト数までにあるログだけを対象にする（size の戻り値を渡す）。
+        """
+        if count <= 0:
+            return []
+        try:
+            f = open(self.path(client_id), "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if end is not None:
+                size = min(size, end)
+            if size <= len(_JOURNAL_MAGIC):
+                return []
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(_JOURNAL_MAGIC)] != _JOURNAL_MAGIC:
+                    logger.warning("会話ログのジャーナルの形式が正しくありません (client_id=%s)", client_id)
+                    return []
+                index = self._load_index(client_id, size)
+                _, unindexed = _scan(mm, index.size)
+                start = max(0, index.count + len(unindexed) - count)
+                if start >= index.count:
+                    offsets = unindexed[start - index.count:]
+                else:
+                    # start件目の直前の索引の位置から、長さだけを見てstart件目まで進む
+                    checkpoint = start // index.stride
+                    pos = index.offsets[checkpoint]
+                    for _ in range(start - checkpoint * index.stride):
+                        pos += _RECORD_HEADER.size + _RECORD_HEADER.unpack_from(mm, pos)[0]
+                    offsets = []
+                    while pos < index.size:
+                        offsets.append(pos)
+                        pos += _RECORD_HEADER.size + _RECORD_HEADER.unpack_from(mm, pos)[0]
+                    offsets.extend(unindexed)
+                entries = self._decode(client_id, mm, offsets)
+        with self._lock:
+            self._counters["tail_reads"] += 1
+            self._counters["entries_read"] += len(entries)
+        return entries
+
+    def read(self, client_id: str) -> Iterator[LogEntry]:
+        """書き出した会話ログをすべて古い順に返す（欠けた末尾は読まない）"""
+        try:
+            f = open(self.path(client_id), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size <= len(_JOURNAL_MAGIC):
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(_JOURNAL_MAGIC)] != _JOURNAL_MAGIC:
+                    logger.warning("会話ログのジャーナルの形式が正しくありません (client_id=%s)", client_id)
+                    return
+                _, offsets = _scan(mm, len(_JOURNAL_MAGIC))
+                yield from self._decode(client_id, mm, offsets)
+
+    def _decode(self, client_id: str, mm, offsets: List[int]) -> List[LogEntry]:
+        entries = []
+        for pos in offsets:
+            length, crc = _RECORD_HEADER.unpack_from(mm, pos)
+            payload = mm[pos + _RECORD_HEADER.size:pos + _RECORD_HEADER.size + length]
+            try:
+                if zlib.crc32(payload) != crc:
+                    raise ValueError("checksum mismatch")
+                entries.append(LogEntry.from_dict(json.loads(payload)))
+            except ValueError:
+                logger.warning("会話ログのジャーナルの壊れたレコードを読み飛ばしました (client_id=%s, offset=%d)", client_id, pos)
+        return entries
+
+    def _empty_index(self) -> _Index:
+        return _Index(self._stride, 0, len(_JOURNAL_MAGIC), [])
+
+    def _load_index(self, client_id: str, journal_size: int) -> _Index:
+        # 索引がない・壊れている・ジャーナルと合わない場合は、索引なしとして先頭から辿る
+        try:
+            with open(self._index_path(client_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return self._empty_index()
+        if len(data) < _INDEX_HEADER.size:
+            return self._empty_index()
+        magic, stride, count, size = _INDEX_HEADER.unpack_from(data)
+        checkpoints = (count + stride - 1) // stride if stride else 0
+        if (
+            magic != _INDEX_MAGIC
+            or stride != self._stride
+            or size > journal_size
+            or len(data) != _INDEX_HEADER.size + checkpoints * _OFFSET.size
+        ):
+            return self._empty_index()
+        offsets = list(struct.unpack_from(f">{checkpoints}Q", data, _INDEX_HEADER.size))
+        return _Index(stride, count, size, offsets)
+
+    def _write_index(self, client_id: str, index: _Index, unindexed: List[int], end: int) -> None:
+        """索引済みの範囲より後ろのレコードを索引に取り込む"""
+        offsets = list(index.offsets)
+        for number, pos in enumerate(unindexed, index.count):
+            if number % index.stride == 0:
+                offsets.append(pos)
+        count = index.count + len(unindexed)
+        path = self._index_path(client_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, index.stride, count, end))
+            f.write(struct.pack(f">{len(offsets)}Q", *offsets))
+        os.replace(tmp_path, path)
+        self._count("index_compactions")
+
+    def record_dropped(self, count: int) -> None:
+        """書き出せずに捨てた会話ログの件数を記録する"""
+        with self._lock:
+            self._counters["entries_dropped"] += count
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "directory": self._directory, "index_stride": self._stride}
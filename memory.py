@@ -0,0 +1,618 @@
+import datetime
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from session_model import LogEntry, SessionRecord
+from structured_log import Fields, log_payload
+
+logger = logging.getLogger(__name__)
+
+# 会話ログ1件をテキストにするときの書式（{timestamp} / {role} / {content} が使える）
+LOG_LINE_TEMPLATE = "{timestamp} {role}: {content}"
+_USER_MESSAGE_PREFIX = "ユーザーメッセージ="
+_NEWLINE_REMOVAL = str.maketrans("", "", "\r\n")
+
+T = TypeVar("T")
+
+
+def client_lock(session_store_lock, client_id: str):
+    """
+    クライアントのロックを返す
+
+    session_store_lock にはキーごとのロック（keyed_lock.KeyedLocks）か、全クライアント共通のロックを渡せる。
+    キーごとのロックなら、あるクライアントの処理中も他のクライアントの処理は待たされない。
+    """
+    hold = getattr(session_store_lock, "hold", None)
+    return hold(client_id) if hold is not None else session_store_lock
+
+
+def update_client_record(
+    session_store: Dict[str, Any],
+    session_store_lock,
+    client_id: str,
+    update: Callable[[SessionRecord], T]
+) -> Optional[T]:
+    """
+    クライアントのロックを保持したままレコードを読み書きする（読み取りから書き込みまでが不可分になる）
+
+    Returns:
+        update(レコード) の戻り値。レコードがなければupdateを呼ばずにNone
+    """
+    with client_lock(session_store_lock, client_id):
+        try:
+            record = session_store[client_id]
+        except KeyError:
+            return None
+        return update(record)
+
+
+async def check_and_handle_date_change(
+    client_id: str,
+    session_store: Dict[str, Any], 
+    session_store_lock,
+    chat_req,
+    a_client,
+    current_date: str,
+    scheduler=None
+    ) -> None:
+    """
+    日付変更をチェックして古いメモリの移動と要約処理を行う
+    
+    Args:
+        client_id: クライアントID
+        session_store: セッションストア
+        session_store_lock: セッションストアのロック（キーごとのロックまたは共通のロック）
+        chat_req: チャットリクエスト関数
+        a_client: AIクライアント
+        current_date: 現在の日付（YYYY-MM-DD形式）
+        scheduler: 要約ジョブのスケジューラ（summary_scheduler.SummaryScheduler）。
+            Noneの場合は要約をその場で順に実行する
+    """
+    # メモリの移動はその場で行い、要約（モデル呼び出し）は階層ごとのジョブにする
+    # 前回までに終わらなかった要約（再起動で破棄されたものなど）も合わせて登録し直す
+    tiers = migrate_memories_on_date_change(client_id, session_store, session_store_lock, current_date)
+    for tier in tiers:
+        summarize = TIER_SUMMARIZERS[tier]
+        job = lambda summarize=summarize: summarize(client_id, session_store, session_store_lock, chat_req, a_client)
+        if scheduler is not None:
+            # 日付変更直後に集中しないよう、スケジューラが実行時刻を分散させる
+            scheduler.submit(client_id, tier, job, spread=True)
+        else:
+            await job()
+
+
+def needs_rollover(record: SessionRecord, current_date: str) -> bool:
+    """
+    日付変更の処理が必要か
+
+    最後の活動日が current_date と異なり、その活動がまだ日付変更の処理（memory.rollover_date）に
+    含まれていない場合にTrue。処理済みかどうかは日付の文字列比較だけで判定できる。
+    """
+    last_date = record.last_activity[:10]
+    if not last_date or last_date == current_date:
+        return False
+    rollover_date = record.memory.rollover_date
+    # rollover_date より前の活動はその日の処理で移動済み
+    return not (rollover_date and last_date < rollover_date)
+
+
+def migrate_memories_on_date_change(
+    client_id: str,
+    session_store: Dict[str, Any],
+    session_store_lock,
+    current_date: str
+) -> List[str]:
+    """
+    日付変更を検出したら前日のshortMemoriesをmidLogへ、あふれたmidMemoriesをlongLogへ移動する
+
+    判定から移動までをクライアントのロックを保持したまま1回で行う。
+
+    要約し直す階層は memory.rollover_pending に記録し、要約が終わった階層から取り除く。
+
+    Returns:
+        要約し直す必要のある階層（"long" / "mid"）のリスト。前回までに終わっていない階層も含む
+    """
+    tiers = update_client_record(
+        session_store, session_store_lock, client_id,
+        lambda record: _migrate_record(client_id, record, current_date),
+    )
+    return tiers or []
+
+
+def _migrate_record(client_id: str, record: SessionRecord, current_date: str) -> List[str]:
+    # 日付変更時の処理：古いshortMemoriesをmidLogに移動し、midLogを要約してmidMemoriesに保存
+    # 夜間の巡回（rollover_sweeper.py）で移動済みなら、終わっていない要約だけを返す
+    if not needs_rollover(record, current_date):
+        return list(record.memory.rollover_pending)
+    memory = record.memory
+    logs = record.logs
+    last_date = record.last_activity[:10]  # YYYY-MM-DD部分を取得
+    logger.info("日付変更を検出 %s", Fields(client_id=client_id, last_date=last_date, new_date=current_date))
+    # 同じ日付変更で二度移動しないよう、移動した日付を記録する（要約の完了は rollover_pending で管理する）
+    memory.rollover_date = current_date
+
+    old_short_memories = memory.short_memories
+    if not old_short_memories.strip():
+        return list(memory.rollover_pending)
+
+    # midLogが満杯（1週間分）なら、最も古いエントリが押し出される前にmidMemoriesをlongLogに移動
+    # longLogも上限（1年分）を超えた古いものから捨てられる
+    current_mid_memories = memory.mid_memories
+    if len(logs.mid_log) == logs.mid_log.maxlen and current_mid_memories.strip():
+        logs.long_log.append(current_mid_memories)
+    # 前日のshortMemoriesをmidLogに追加
+    logs.mid_log.append(current_mid_memories + "\n" + old_short_memories)
+
+    # longLogに内容がある場合は要約を作成してlongMemoriesに書き込み、midLogの最新エントリも要約する
+    # 要約はセッションと一緒に永続化し、終わる前に再起動しても次の記憶処理・起動時に登録し直す
+    tiers = ["long"] if logs.long_log else []
+    tiers.append("mid")
+    memory.rollover_pending = tiers + [tier for tier in memory.rollover_pending if tier not in tiers]
+    return list(memory.rollover_pending)
+
+
+def has_pending_rollover(record: SessionRecord) -> bool:
+    """日付変更の要約で終わっていないものがあるか"""
+    return bool(record.memory.rollover_pending)
+
+
+def _finish_rollover_tier(record: SessionRecord, tier: str) -> bool:
+    """
+    日付変更の要約が終わった階層を rollover_pending から取り除く
+
+    Returns:
+        取り除いたか（別のジョブが先に終わらせていればFalse）
+    """
+    pending = record.memory.rollover_pending
+    if tier not in pending:
+        return False
+    pending.remove(tier)
+    return True
+
+
+async def summarize_long_log(
+    client_id: str,
+    session_store: Dict[str, Any],
+    session_store_lock,
+    chat_req,
+    a_client
+) -> None:
+    """longLogの全エントリを要約してlongMemoriesに書き込む"""
+    # 全てのlongLogエントリを結合
+    longlog_content = update_client_record(
+        session_store, session_store_lock, client_id,
+        lambda record: "\n".join(record.logs.long_log),
+    )
+    if not (longlog_content and longlog_content.strip()):
+        update_client_record(session_store, session_store_lock, client_id, lambda record: _finish_rollover_tier(record, "long"))
+        return
+
+    user_msg = (
+        "以下のテキストを600文字程度に要約した文章を作成すること。このテキストは数週間分のユーザーとアシスタントの会話の要約集です。"
+        "作成する要約は時系列順に整理し、重要な出来事や継続的なテーマ、固有名詞などを重視してください。"
+        "絵文字は無視してください。要約するテキスト=" + longlog_content
+    )
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        response_log = await chat_req(a_client, user_msg, "あなたは賢いAIです。userのリクエストに必ず日本語で答えること。リクエストの回答以外は答えないこと。")
+        response_log = f"[{now}] {response_log}"
+        logger.info("longLogの要約をlongMemoriesに保存 %s", Fields(client_id=client_id, chars=len(response_log)))
+        log_payload(logger, "longMemories", response_log, Fields(client_id=client_id))
+        update_client_record(
+            session_store, session_store_lock, client_id,
+            lambda record: _save_long_memories(record, response_log),
+        )
+    except Exception as e:
+        # rollover_pending に残るので、次の記憶処理で作り直す
+        logger.exception("longLog要約作成中にエラー %s", Fields(client_id=client_id, error=type(e).__name__))
+
+
+def _save_long_memories(record: SessionRecord, response_log: str) -> None:
+    # longMemoriesに要約を保存（longLogは上限付きなので切り詰めは不要）
+    # longMemoriesは作り直すだけなので、別のジョブが先に終わらせていても上書きしてよい
+    _finish_rollover_tier(record, "long")
+    record.memory.long_memories = response_log
+
+
+async def summarize_mid_log(
+    client_id: str,
+    session_store: Dict[str, Any],
+    session_store_lock,
+    chat_req,
+    a_client
+) -> None:
+    """midLogの最新エントリを要約してmidMemoriesに書き込む"""
+    midlog_content = update_client_record(session_store, session_store_lock, client_id, _latest_mid_log)
+    if not (midlog_content and midlog_content.strip()):
+        update_client_record(session_store, session_store_lock, client_id, lambda record: _finish_rollover_tier(record, "mid"))
+        return
+
+    user_msg = (
+        "以下のテキストを400文字程度に日記形式で要約した文章を作成すること。このテキストは一日のユーザーとアシスタントの会話ログです。"
+        "作成する要約は会話の分析ではなく、会話ログにある出来事をまとめた要約です。特に固有名詞や、行動などは重視してください。"
+        "絵文字は無視してください。要約するテキスト=" + midlog_content
+    )
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        response_log = await chat_req(a_client, user_msg, "あなたは賢いAIです。userのリクエストに必ず日本語で答えること。リクエストの回答以外は答えないこと。")
+        response_log = f"[{now}] {response_log}"
+        logger.info("midLogの要約をmidMemoriesに保存 %s", Fields(client_id=client_id, chars=len(response_log)))
+        log_payload(logger, "midMemories", response_log, Fields(client_id=client_id))
+        update_client_record(
+            session_store, session_store_lock, client_id,
+            lambda record: _append_mid_memories(record, response_log),
+        )
+    except Exception as e:
+        # rollover_pending に残るので、次の記憶処理で作り直す
+        logger.exception("midLog要約作成中にエラー %s", Fields(client_id=client_id, error=type(e).__name__))
+
+
+def _latest_mid_log(record: SessionRecord) -> str:
+    # midLogの最新のエントリを取得
+    mid_log = record.logs.mid_log
+    return mid_log[-1] if mid_log else ""
+
+
+def _append_mid_memories(record: SessionRecord, response_log: str) -> None:
+    # 別のジョブが先に書き込んでいれば、同じ日の要約を二重に追加しない
+    if not _finish_rollover_tier(record, "mid"):
+        return
+    # 既存のmidMemoriesに書き込む
+    memory = record.memory
+    if memory.mid_memories.strip():
+        memory.mid_memories = memory.mid_memories + "\n" + response_log
+    else:
+        memory.mid_memories = response_log
+
+
+# 日付変更時に要約し直す階層 → 要約処理
+TIER_SUMMARIZERS = {
+    "long": summarize_long_log,
+    "mid": summarize_mid_log,
+}
+
+# shortMemoriesを差分ではなく全体から作り直すまでの差分更新の回数
+SUMMARY_REBUILD_EVERY = 10
+
+
+async def process_conversation_memory(
+    client_id: str, 
+    session_store: Dict[str, Any], 
+    session_store_lock, 
+    chat_req, 
+    a_client,
+    current_date: Optional[str] = None,
+    max_logs: int = 50,
+    rebuild_every: int = SUMMARY_REBUILD_EVERY,
+    scheduler=None,
+    log_template: str = LOG_LINE_TEMPLATE,
+    archive=None
+) -> List[Dict[str, Any]]:
+    """
+    会話ログが最大数を超えた場合の記憶処理を行う関数
+
+    shortMemoriesは memory.summary_cursor（要約に反映済みのvery_long_logの通し番号）より後の
+    新しいログだけを既存の要約に反映して更新する。差分更新が rebuild_every 回続いたとき、
+    日付が変わったとき、反映済みの位置が分からなくなったときは、最新 max_logs 件から作り直す。
+    
+    Args:
+        client_id: クライアントID
+        session_store: セッションストア
+        session_store_lock: セッションストアのロック（キーごとのロックまたは共通のロック）
+        chat_req: チャットリクエスト関数
+        a_client: AIクライアント
+        current_date: 現在の日付（YYYY-MM-DD形式）。Noneの場合は自動取得
+        max_logs: 作り直すときに要約するログの最大件数
+        rebuild_every: 作り直すまでの差分更新の回数
+        scheduler: 要約ジョブのスケジューラ（summary_scheduler.SummaryScheduler）。
+            指定した場合は要約をジョブとして登録するだけで、完了を待たずに戻る
+        log_template: 要約に渡す会話ログ1件分の書式
+        archive: very_long_logからあふれたログの書き出し先（log_archive.LogArchive）。
+            作り直すときにメモリ上のログが max_logs 件に足りなければ、足りない分をここから読む
+    
+    Returns:
+        なし ->session_storeが更新されているため、返り値は不要
+    """
+    
+    # current_dateが指定されていない場合は現在の日付を自動取得
+    if current_date is None:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        current_date = timestamp[:10]  # YYYY-MM-DD部分を取得
+    
+    # 1. 日付変更チェック処理を最初に実行
+    await check_and_handle_date_change(
+        client_id=client_id,
+        session_store=session_store,
+        session_store_lock=session_store_lock,
+        chat_req=chat_req,
+        a_client=a_client,
+        current_date=current_date,
+        scheduler=scheduler
+    )
+    # 2. 新しいログをshortMemoriesに反映
+    job = lambda: summarize_short_memories(
+        client_id, session_store, session_store_lock, chat_req, a_client, current_date, max_logs, rebuild_every,
+        log_template, archive
+    )
+    if scheduler is not None:
+        scheduler.submit(client_id, "short", job)
+    else:
+        await job()
+    return
+
+
+async def summarize_short_memories(
+    client_id: str,
+    session_store: Dict[str, Any],
+    session_store_lock,
+    chat_req,
+    a_client,
+    current_date: str,
+    max_logs: int = 50,
+    rebuild_every: int = SUMMARY_REBUILD_EVERY,
+    log_template: str = LOG_LINE_TEMPLATE,
+    archive=None
+) -> None:
+    """very_long_logのまだ要約に反映していないログをshortMemoriesに反映する"""
+    # very_long_logからまだ要約に反映していないログを抜き出す（ロック使用）
+    plan = update_client_record(
+        session_store, session_store_lock, client_id,
+        lambda record: _plan_summary_update(client_id, record, current_date, max_logs, rebuild_every, archive),
+    )
+    if plan is None:
+        logger.debug("新しいログがないため要約を省略 %s", Fields(client_id=client_id))
+        return
+    logs, archived, previous_summary, cursor = plan
+    # 書き出したログのファイルの読み込みとテキスト変換はロックを外してから行う
+    if archived is not None:
+        logs = _read_archived_logs(client_id, archive, *archived) + logs
+    # 要約の入力は改行を除いた1行のテキストにする
+    logs_text = _convert_logs_to_text(logs, log_template, single_line=True)
+    logger.info("shortMemoriesを更新 %s", Fields(
+        client_id=client_id, mode="incremental" if previous_summary else "rebuild", cursor=cursor, chars=len(logs_text)
+    ))
+    log_payload(logger, "要約する会話ログ", logs_text, Fields(client_id=client_id))
+
+    # 要約生成処理（ロック外で実行 - AI処理は時間がかかるため）
+    # 抽出した会話ログを要約してshortMemoriesに保存
+    if logs_text:
+        await _generate_and_save_summary(
+            logs_text, client_id, session_store, session_store_lock, chat_req, a_client,
+            previous_summary=previous_summary, cursor=cursor, current_date=current_date
+        )
+
+
+def _plan_summary_update(
+    client_id: str,
+    record: SessionRecord,
+    current_date: str,
+    max_logs: int,
+    rebuild_every: int,
+    archive=None
+) -> Optional[tuple]:
+    """
+    shortMemoriesの更新方法を決め、要約するログを抜き出す（クライアントのロックを保持して呼ぶ）
+
+    ファイルに書き出したログはここでは読まず、読む範囲だけを返す（_read_archived_logs で読む）。
+
+    Returns:
+        (メモリ上の要約するログ, 書き出したログから読み足す (件数, ジャーナルの大きさ)・不要ならNone,
+        差分更新なら既存の要約・作り直しならNone, 反映後の反映済み位置)。新しいログがなければNone
+    """
+    memory = record.memory
+    very_long_log = record.logs.very_long_log
+    end = very_long_log.total
+    cursor = memory.summary_cursor
+    previous_summary = memory.short_memories
+
+    if cursor == end and previous_summary.strip() and memory.summary_date == current_date:
+        return None
+
+    rebuild = (
+        cursor is None
+        or cursor > end  # ログが削除・置換された
+        or cursor < very_long_log.offset  # 未反映のログがファイルに書き出された
+        or end - cursor > max_logs  # 差分が多すぎる
+        or not previous_summary.strip()
+        or memory.summary_date != current_date  # 日付が変わった（shortMemoriesはmidLogへ移動済み）
+        or memory.summary_updates >= rebuild_every
+    )
+    if rebuild:
+        logs, missing = _recent_logs_in_memory(very_long_log, max_logs)
+        archived = None
+        if missing > 0 and archive is not None and very_long_log.offset > len(very_long_log.spilled):
+            # ロックを外した後に追記された分を読まないよう、今のジャーナルの大きさを記録しておく
+            archived = (missing, archive.size(client_id))
+        return logs, archived, None, end
+    return very_long_log.since(cursor), None, _strip_summary_timestamp(previous_summary), end
+
+
+def _strip_summary_timestamp(summary: str) -> str:
+    """要約の先頭の "[YYYY-MM-DD HH:MM:SS] " を取り除く"""
+    if summary.startswith("["):
+        head, sep, rest = summary.partition("] ")
+        if sep and len(head) == 20:
+            return rest
+    return summary
+
+
+def _render_log_lines(logs: Iterable[LogEntry], template: str, single_line: bool) -> Iterator[str]:
+    """会話ログを1件ずつテキストにする（プレフィックスの除去と改行の削除も同じ走査で行う）"""
+    line_end = "" if single_line else "\n"
+    for log in logs:
+        content = log.content
+        if log.role == "user":
+            role_name = "ユーザー"
+            # ユーザーの場合は"ユーザーメッセージ="以降を抜き出す
+            _, sep, message = content.partition(_USER_MESSAGE_PREFIX)
+            if sep:
+                content = message
+        else:
+            role_name = "アシスタント"
+        if single_line:
+            content = content.translate(_NEWLINE_REMOVAL)
+        yield template.format(timestamp=log.timestamp, role=role_name, content=content) + line_end
+
+
+def _convert_logs_to_text(
+    logs: Iterable[LogEntry],
+    template: str = LOG_LINE_TEMPLATE,
+    single_line: bool = False
+) -> str:
+    """
+    ログをテキスト形式に変換する
+    
+    Args:
+        logs: 会話ログのリスト
+        template: 1件分の書式
+        single_line: Trueなら改行を含めず1行につなげる（要約の入力用）
+    
+    Returns:
+        テキスト形式に変換されたログ
+    """
+    return "".join(_render_log_lines(logs, template, single_line))
+
+
+def extract_recent_very_long_logs(
+    client_id: str,
+    session_store: Dict[str, Any],
+    max_logs: int = 50,
+    template: str = LOG_LINE_TEMPLATE,
+    single_line: bool = False,
+    archive=None
+) -> str:
+    """
+    session_store[client_id].logs.very_long_log から
+    新しいログを最大max_logs件抜き出し、テキストに変換する
+
+    メモリ上のログが足りなければ、まだ書き出していないログ、archive に書き出したログの順に
+    新しい方から読み足す（archive はファイルの末尾の必要な範囲だけを読む）。
+
+    Args:
+        client_id: クライアントID
+        session_store: セッションストア
+        max_logs: 抜き出す最大ログ数（デフォルトは50）
+        template: 1件分の書式
+        single_line: Trueなら改行を含めず1行につなげる
+        archive: 書き出したログの読み出し元（log_archive.LogArchive）
+
+    Returns:
+        テキスト形式に変換されたログ
+    """
+    try:
+        very_long_log = session_store[client_id].logs.very_long_log
+
+        # 新しいログを最大max_logs件抜き出し
+        recent_logs, missing = _recent_logs_in_memory(very_long_log, max_logs)
+        if missing > 0 and archive is not None and very_long_log.offset > len(very_long_log.spilled):
+            recent_logs = archive.tail(client_id, missing) + recent_logs
+
+        # ログをテキスト形式に変換
+        converted_text = _convert_logs_to_text(recent_logs, template, single_line)
+        logger.debug("very_long_logからログを抽出 %s", Fields(client_id=client_id, entries=len(recent_logs)))
+        return converted_text
+        
+    except Exception as e:
+        logger.exception("very_long_logからのログ抽出中にエラー %s", Fields(client_id=client_id, error=type(e).__name__))
+        return ""
+
+
+def _recent_logs_in_memory(very_long_log, max_logs: int) -> tuple:
+    """
+    メモリ上の新しいログを最大max_logs件、まだ書き出していないログも含めて古い順に返す
+
+    Returns:
+        (ログのリスト, 足りない件数)
+    """
+    recent_logs = very_long_log.tail(max_logs)
+    missing = max_logs - len(recent_logs)
+    spilled = very_long_log.spilled
+    if missing > 0 and spilled:
+        recent_logs = spilled[-missing:] + recent_logs
+        missing = max_logs - len(recent_logs)
+    return recent_logs, missing
+
+
+def _read_archived_logs(client_id: str, archive, count: int, end: int) -> List[LogEntry]:
+    """書き出したログのうち、ジャーナルの先頭からendバイトまでにある新しいログを最大count件読む（ロック外で呼ぶ）"""
+    try:
+        return archive.tail(client_id, count, end=end)
+    except Exception as e:
+        logger.exception("書き出したログの読み込み中にエラー %s", Fields(client_id=client_id, error=type(e).__name__))
+        return []
+
+
+async def _generate_and_save_summary(
+    memory_data_for_summary: str, 
+    client_id: str, 
+    session_store: Dict[str, Any], 
+    session_store_lock, 
+    chat_req, 
+    a_client,
+    previous_summary: Optional[str] = None,
+    cursor: Optional[int] = None,
+    current_date: Optional[str] = None
+) -> None:
+    """
+    要約を生成してセッションストアに保存する
+    
+    Args:
+        memory_data_for_summary: 要約対象データ（改行を除いた1行のテキスト）
+        client_id: クライアントID
+        session_store: セッションストア
+        session_store_lock: セッションストアのロック（キーごとのロックまたは共通のロック）
+        chat_req: チャットリクエスト関数
+        a_client: AIクライアント
+        previous_summary: 差分更新の場合は既存の要約（Noneなら要約対象データだけから作る）
+        cursor: 保存後の反映済み位置（very_long_logの通し番号）
+        current_date: 要約の対象日（YYYY-MM-DD形式）
+    """
+    try:
+        # 改行はログをテキストにする段階で削除済み
+        summarize_text = memory_data_for_summary
+        if summarize_text.strip():  # 空でない場合のみ要約処理を実行
+            if previous_summary:
+                user_msg = (
+                    "以下の「これまでの要約」に「新しい会話ログ」の出来事を反映し、400文字程度の日記形式の要約を作り直すこと。"
+                    "どちらも同じ一日のユーザーとアシスタントの会話です。"
+                    "作成する要約は会話の分析ではなく、会話ログにある出来事をまとめた要約です。特に固有名詞や、行動などは重視してください。"
+                    "絵文字は無視してください。これまでの要約=" + previous_summary + " 新しい会話ログ=" + summarize_text
+                )
+            else:
+                user_msg = (
+                    "以下のテキストを400文字程度に日記形式で要約した文章を作成すること。このテキストは一日のユーザーとアシスタントの会話ログです。"
+                    "作成する要約は会話の分析ではなく、会話ログにある出来事をまとめた要約です。特に固有名詞や、行動などは重視してください。"
+                    "絵文字は無視してください。要約するテキスト=" + summarize_text
+                )
+            now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            response_log = await chat_req(a_client, user_msg, "あなたは賢いAIです。userのリクエストに必ず日本語で答えること。リクエストの回答以外は答えないこと。")
+            response_log = f"[{now}] {response_log}"
+            logger.info("shortMemoriesの要約を保存 %s", Fields(client_id=client_id, chars=len(response_log)))
+            log_payload(logger, "shortMemories", response_log, Fields(client_id=client_id))
+            
+            # 要約結果をsession_storeに保存（再度ロック使用）
+            update_client_record(
+                session_store, session_store_lock, client_id,
+                lambda record: _save_short_memories(record, response_log, previous_summary, cursor, current_date),
+            )
+
+    except Exception as e:
+        # エラーが発生してもログ保存は続行
+        logger.exception("要約生成中にエラーが発生しました %s", Fields(client_id=client_id, error=type(e).__name__))
+
+
+def _save_short_memories(
+    record: SessionRecord,
+    response_log: str,
+    previous_summary: Optional[str],
+    cursor: Optional[int],
+    current_date: Optional[str]
+) -> None:
+    memory = record.memory
+    memory.short_memories = response_log
+    # どこまでのログを反映したかを記録し、次回はその後のログだけを要約する
+    if cursor is not None:
+        memory.summary_cursor = cursor
+        memory.summary_date = current_date
+        memory.summary_updates = memory.summary_updates + 1 if previous_summary else 0
@@ -0,0 +1,201 @@
+"""
+記憶処理（memory.py）のバックグラウンド実行
+
+返信の処理からはジョブを予約するだけにし、要約などのモデル呼び出しは専用スレッドのイベントループで後から実行する。
+同じクライアントの予約は会話が落ち着くまで（delay秒、最大max_wait秒）まとめて1回にし、
+同時に実行するジョブ数も制限するので、記憶処理がユーザーへの返信を待たせることはない。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryJobRunner:
+    """クライアントごとの記憶処理ジョブを遅延・集約して実行する"""
+
+    def __init__(
+        self,
+        job: Callable[[str], Awaitable[None]],
+        delay: float = 30.0,
+        max_wait: float = 300.0,
+        max_concurrency: int = 2,
+        name: str = "memory-jobs",
+        on_drain: Optional[Callable[[float], Awaitable[bool]]] = None
+    ) -> None:
+        """
+        Args:
+            job: クライアントIDを受け取って記憶処理を行うコルーチン関数
+            delay: 最後の予約からこの秒数だけ新しい予約がなければ実行する
+            max_wait: 最初の予約からこの秒数を過ぎたら予約が続いていても実行する
+            max_concurrency: 同時に実行するジョブの最大数
+            name: イベントループを動かすスレッドの名前
+            on_drain: 終了時にジョブの完了を待った後、同じループで呼ぶコルーチン関数（残り秒数を受け取る）
+        """
+        self._job = job
+        self._delay = max(0.0, delay)
+        self._max_wait = max(self._delay, max_wait)
+        self._max_concurrency = max(1, max_concurrency)
+        self._name = name
+        self._on_drain = on_drain
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+        # 以下はイベントループのスレッドだけが触る
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # クライアントID → (最初の予約時刻, 実行予定のTimerHandle)
+        self._scheduled: Dict[str, Any] = {}
+        self._running: Set[str] = set()
+        # 実行中に予約されたクライアント（終わったらもう一度予約する）
+        self._rerun: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        # 常駐処理（run_backgroundで起動したタスク）
+        self._background: Set[asyncio.Task] = set()
+
+        self._counters: Dict[str, int] = {
+            "scheduled": 0,
+            "coalesced": 0,
+            "completed": 0,
+            "failed": 0,
+        }
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run_loop, name=self._name, daemon=True)
+            self._thread.start()
+
+    def _run_loop(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._loop.run_forever()
+        self._loop.close()
+
+    def schedule(self, client_id: str) -> bool:
+        """
+        クライアントの記憶処理を予約する（どのスレッドからでも呼べる、すぐに戻る）
+
+        Returns:
+            予約できたか（終了処理中はFalse）
+        """
+        self.start()
+        with self._lock:
+            if self._closed:
+                return False
+            self._counters["scheduled"] += 1
+        self._loop.call_soon_threadsafe(self._arm, client_id)
+        return True
+
+    def run_background(self, factory: Callable[[], Awaitable[None]]) -> None:
+        """ジョブと同じイベントループで常駐処理（夜間の巡回など）を動かす。終了処理の最初にキャンセルされる"""
+        self.start()
+        self._loop.call_soon_threadsafe(self._start_background, factory)
+
+    def _start_background(self, factory: Callable[[], Awaitable[None]]) -> None:
+        task = self._loop.create_task(factory())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _arm(self, client_id: str) -> None:
+        if client_id in self._running:
+            self._rerun.add(client_id)
+            self._count("coalesced")
+            return
+        now = time.monotonic()
+        first_at = now
+        scheduled = self._scheduled.pop(client_id, None)
+        if scheduled is not None:
+            first_at, handle = scheduled
+            handle.cancel()
+            self._count("coalesced")
+        # 予約が続いても最初の予約から max_wait 秒後には実行する
+        delay = min(self._delay, max(0.0, first_at + self._max_wait - now))
+        self._scheduled[client_id] = (first_at, self._loop.call_later(delay, self._fire, client_id))
+
+    def _fire(self, client_id: str) -> None:
+        self._scheduled.pop(client_id, None)
+        self._running.add(client_id)
+        task = self._loop.create_task(self._execute(client_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, client_id: str) -> None:
+        try:
+            async with self._semaphore:
+                await self._job(client_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("記憶処理ジョブが失敗しました (client_id=%s)", client_id)
+            self._count("failed")
+        else:
+            self._count("completed")
+        finally:
+            self._running.discard(client_id)
+            if client_id in self._rerun:
+                self._rerun.discard(client_id)
+                if not self._closed:
+                    self._arm(client_id)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    def shutdown(self, timeout: float = 10.0) -> bool:
+        """
+        新しい予約を止め、実行中のジョブの完了を待ってループを停止する
+
+        まだ実行していない予約は破棄する（会話ログは保存済みなので、次の予約でまとめて処理される）。
+
+        Returns:
+            実行中のジョブがすべてタイムアウト内に完了したか
+        """
+        with self._lock:
+            self._closed = True
+            loop, thread = self._loop, self._thread
+        if thread is None:
+            return True
+        future = asyncio.run_coroutine_threadsafe(self._drain(timeout), loop)
+        try:
+            drained = future.result(timeout + 1.0)
+        except Exception:
+            drained = False
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=1.0)
+        return drained
+
+    async def _drain(self, timeout: float) -> bool:
+        for task in list(self._background):
+            task.cancel()
+        for _, handle in self._scheduled.values():
+            handle.cancel()
+        self._scheduled.clear()
+        deadline = time.monotonic() + timeout
+        drained = True
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=max(0.01, timeout))
+            for task in pending:
+                task.cancel()
+            drained = not pending
+        if self._on_drain is not None:
+            drained = await self._on_drain(max(0.01, deadline - time.monotonic())) and drained
+        return drained
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._counters,
+                "pending": len(self._scheduled),
+                "running": len(self._running),
+                "delay_sec": self._delay,
+                "max_wait_sec": self._max_wait,
+                "max_concurrency": self._max_concurrency,
+            }
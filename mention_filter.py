@@ -0,0 +1,68 @@
+"""
+グループ/ルームのメンション事前フィルタ
+
+Webhookの生のJSONの段階で、Botがメンションされていないグループ/ルームのメッセージを捨てる。
+SDKのイベントオブジェクトを組み立てる前に捨てるので、雑談の多いグループでも処理が軽くなる。
+"""
+
+import os
+import re
+import threading
+from typing import Any, Dict, Iterable, List
+
+
+class MentionFilter:
+    """Botの呼び名（メンション名と別名）を含むかどうかを判定する"""
+
+    def __init__(self, names: Iterable[str]) -> None:
+        names = [name for name in dict.fromkeys(n.strip() for n in names) if name]
+        if not names:
+            raise ValueError("MentionFilter needs at least one name")
+        self.names = names
+        # 長い名前を先に並べて、短い名前の部分一致より優先させる
+        self._pattern = re.compile("|".join(re.escape(name) for name in sorted(names, key=len, reverse=True)))
+        self._lock = threading.Lock()
+        self._seen = 0
+        self._dropped = 0
+
+    @classmethod
+    def from_env(cls) -> "MentionFilter":
+        """BOT_MENTION_NAME（既定は "あだT"）と BOT_MENTION_ALIASES（カンマ区切り）から作る"""
+        names = [os.getenv("BOT_MENTION_NAME", "あだT")]
+        names.extend(os.getenv("BOT_MENTION_ALIASES", "").split(","))
+        return cls(names)
+
+    def matches(self, text: str) -> bool:
+        """テキストにBotの呼び名が含まれるか"""
+        return self._pattern.search(text) is not None
+
+    def is_relevant(self, event: Dict[str, Any]) -> bool:
+        """
+        生のイベント（dict）を処理する必要があるか
+
+        個人チャットのイベントはすべて残し、グループ/ルームはメンションされたテキストメッセージだけ残す。
+        """
+        source_type = event.get("source", {}).get("type")
+        if source_type not in ("group", "room"):
+            return True
+        if event.get("type") != "message":
+            return False
+        message = event.get("message", {})
+        return message.get("type") == "text" and self.matches(message.get("text", ""))
+
+    def filter_events(self, events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """処理が必要なイベントだけを返す"""
+        kept = [event for event in events if self.is_relevant(event)]
+        with self._lock:
+            self._seen += len(events)
+            self._dropped += len(events) - len(kept)
+        return kept
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "names": self.names,
+                "events_seen": self._seen,
+                "events_dropped": self._dropped,
+                "drop_rate": round(self._dropped / self._seen, 4) if self._seen else 0.0,
+            }
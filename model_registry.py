@@ -0,0 +1,133 @@
+"""
+GenerativeModel レジストリ
+
+(モデル名, システムプロンプト) の組ごとにモデルオブジェクトを一度だけ生成して使い回す。
+キャラクター（ペルソナ）のプロンプトとバージョン→モデル名の対応もここで一元管理する。
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class ModelRegistry:
+    """ペルソナとバージョン対応を保持し、生成済みモデルをキャッシュするレジストリ"""
+
+    def __init__(
+        self,
+        factory: Callable[[str, str], Any],
+        model_versions: Dict[str, str],
+        default_version: str,
+        max_models: int = 32
+    ) -> None:
+        """
+        Args:
+            factory: (モデル名, システムプロンプト) からモデルを生成する関数
+            model_versions: バージョン文字列 → モデル名 の対応
+            default_version: 未知のバージョンが指定されたときに使うバージョン
+            max_models: キャッシュするモデルの最大数（超えたら古いものから破棄）
+        """
+        if default_version not in model_versions:
+            raise ValueError(f"default_version '{default_version}' is not in model_versions")
+        self._factory = factory
+        self._versions = dict(model_versions)
+        self._default_version = default_version
+        self._max_models = max(1, max_models)
+        self._personas: Dict[str, str] = {}
+        self._models: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._created = 0
+        self._invalidations = 0
+
+    # --- ペルソナ・バージョン対応の管理 ---
+
+    def register_persona(self, name: str, prompt: str) -> None:
+        """ペルソナを登録する。プロンプトが変わった場合は古いプロンプトのモデルを破棄する"""
+        with self._lock:
+            old_prompt = self._personas.get(name)
+            if old_prompt == prompt:
+                return
+            self._personas[name] = prompt
+            if old_prompt is not None:
+                self._drop_locked(lambda key: key[1] == old_prompt)
+
+    def persona_prompt(self, name: str) -> str:
+        """登録済みペルソナのシステムプロンプトを返す"""
+        with self._lock:
+            try:
+                return self._personas[name]
+            except KeyError:
+                raise KeyError(f"Unknown persona: {name}") from None
+
+    def set_model_versions(self, model_versions: Dict[str, str], default_version: Optional[str] = None) -> None:
+        """バージョン→モデル名の対応を差し替える。変更があればキャッシュ全体を破棄する"""
+        default_version = default_version or self._default_version
+        if default_version not in model_versions:
+            raise ValueError(f"default_version '{default_version}' is not in model_versions")
+        with self._lock:
+            if model_versions == self._versions and default_version == self._default_version:
+                return
+            self._versions = dict(model_versions)
+            self._default_version = default_version
+            self._drop_locked(lambda key: True)
+
+    def resolve_model_name(self, version: str) -> str:
+        """バージョン文字列からモデル名を求める（未知のバージョンは既定値）"""
+        with self._lock:
+            return self._versions.get(version, self._versions[self._default_version])
+
+    # --- モデルの取得 ---
+
+    def get(self, model_name: str, system_prompt: str) -> Any:
+        """(モデル名, システムプロンプト) に対応するモデルを返す。初回のみ生成する"""
+        key = (model_name, system_prompt)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self._hits += 1
+                return model
+
+        # 生成はロック外で行う（同時に生成された場合は先に登録された方を使う）
+        model = self._factory(model_name, system_prompt)
+        with self._lock:
+            existing = self._models.get(key)
+            if existing is not None:
+                self._hits += 1
+                return existing
+            self._models[key] = model
+            self._created += 1
+            while len(self._models) > self._max_models:
+                self._models.popitem(last=False)
+            return model
+
+    def for_persona(self, persona: str, version: str) -> Tuple[str, Any]:
+        """ペルソナとバージョンからモデルを取得し、(モデル名, モデル) を返す"""
+        model_name = self.resolve_model_name(version)
+        return model_name, self.get(model_name, self.persona_prompt(persona))
+
+    def invalidate(self, persona: Optional[str] = None) -> None:
+        """キャッシュ済みモデルを破棄する（persona指定時はそのペルソナ分のみ）"""
+        with self._lock:
+            if persona is None:
+                self._drop_locked(lambda key: True)
+            else:
+                prompt = self._personas.get(persona)
+                self._drop_locked(lambda key: key[1] == prompt)
+
+    def _drop_locked(self, predicate: Callable[[Tuple[str, str]], bool]) -> None:
+        for key in [k for k in self._models if predicate(k)]:
+            del self._models[key]
+            self._invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """キャッシュの利用状況を返す"""
+        with self._lock:
+            return {
+                "cached_models": len(self._models),
+                "personas": sorted(self._personas),
+                "hits": self._hits,
+                "created": self._created,
+                "invalidations": self._invalidations,
+            }
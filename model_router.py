@@ -0,0 +1,171 @@
+"""
+モデル振り分け（ルーター）
+
+入力の長さ・会話の種類（個人/グループ）・応答キューの混み具合・モデルごとの実測レイテンシから、
+リクエストごとに使うバージョン（"2.0" = Flash / "1.5" = Pro）を選ぶ。
+大半は安くて速いFlashで処理し、Proは待たせる価値があるときだけ使う。
+"""
+
+import json
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+
+class RouteRule:
+    """
+    振り分けルール（すべての条件を満たしたときにversionを使う）
+
+    条件はNoneなら判定しない。
+    """
+
+    __slots__ = ("name", "version", "min_chars", "max_chars", "source_types", "max_queue_depth", "max_p95_latency")
+
+    def __init__(
+        self,
+        version: str,
+        name: Optional[str] = None,
+        min_chars: Optional[int] = None,
+        max_chars: Optional[int] = None,
+        source_types: Optional[Iterable[str]] = None,
+        max_queue_depth: Optional[int] = None,
+        max_p95_latency: Optional[float] = None
+    ) -> None:
+        """
+        Args:
+            version: 条件を満たしたときに使うバージョン
+            name: 統計に出すルール名（省略時はversion）
+            min_chars: 入力の最小文字数
+            max_chars: 入力の最大文字数
+            source_types: 対象の会話の種類（"user" / "group" / "room"）
+            max_queue_depth: 応答キューの深さがこれ以下のときだけ使う
+            max_p95_latency: 選ぶモデルのp95レイテンシ（秒）がこれ以下のときだけ使う
+        """
+        self.name = name or version
+        self.version = version
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.source_types = frozenset(source_types) if source_types else None
+        self.max_queue_depth = max_queue_depth
+        self.max_p95_latency = max_p95_latency
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RouteRule":
+        return cls(**data)
+
+    def matches(
+        self,
+        chars: int,
+        source_type: str,
+        queue_depth: int,
+        p95_latency: Callable[[], Optional[float]]
+    ) -> bool:
+        if self.min_chars is not None and chars < self.min_chars:
+            return False
+        if self.max_chars is not None and chars > self.max_chars:
+            return False
+        if self.source_types is not None and source_type not in self.source_types:
+            return False
+        if self.max_queue_depth is not None and queue_depth > self.max_queue_depth:
+            return False
+        if self.max_p95_latency is not None:
+            # レイテンシはルールが他の条件を満たしたときだけ調べる（計測がなければ条件を満たすとみなす）
+            latency = p95_latency()
+            if latency is not None and latency > self.max_p95_latency:
+                return False
+        return True
+
+
+# 既定のルール：なし（MODEL_ROUTE_RULES を設定しない限り、すべて既定のバージョンで処理する）
+# Proへの振り分けは遅く高いモデルを使うことになるため、設定した場合だけ有効にする
+DEFAULT_RULES: List[RouteRule] = []
+
+
+def parse_rules(text: str) -> List[RouteRule]:
+    """JSON文字列（ルールのdictのリスト）からルールを作る"""
+    return [RouteRule.from_dict(item) for item in json.loads(text)]
+
+
+def parse_overrides(text: str) -> Dict[str, str]:
+    """"source_id:version,source_id:version" 形式の文字列から送信元ごとの固定バージョンを作る"""
+    overrides = {}
+    for item in text.split(","):
+        source_id, sep, version = item.strip().partition(":")
+        if sep and source_id and version:
+            overrides[source_id] = version
+    return overrides
+
+
+class ModelRouter:
+    """リクエストごとに使うバージョンを選ぶ"""
+
+    def __init__(
+        self,
+        rules: List[RouteRule],
+        default_version: str,
+        resolve_model_name: Callable[[str], str],
+        p95_latency: Callable[[str], Optional[float]],
+        queue_depth: Callable[[], int] = lambda: 0,
+        overrides: Optional[Dict[str, str]] = None
+    ) -> None:
+        """
+        Args:
+            rules: 上から順に評価する振り分けルール
+            default_version: どのルールにも当てはまらないときのバージョン
+            resolve_model_name: バージョン → モデル名 を求める関数
+            p95_latency: モデル名 → 実測p95レイテンシ（秒、計測がなければNone）を求める関数
+            queue_depth: 現在の応答キューの深さを返す関数
+            overrides: 送信元IDごとに固定するバージョン
+        """
+        self._rules = list(rules)
+        self._default_version = default_version
+        self._resolve_model_name = resolve_model_name
+        self._p95_latency = p95_latency
+        self._queue_depth = queue_depth
+        self._overrides = dict(overrides or {})
+        self._lock = threading.Lock()
+        self._routed: Dict[str, int] = {}
+
+    def set_override(self, source_id: str, version: Optional[str]) -> None:
+        """送信元のバージョンを固定する（Noneで解除）"""
+        with self._lock:
+            if version is None:
+                self._overrides.pop(source_id, None)
+            else:
+                self._overrides[source_id] = version
+
+    def choose(self, source_type: str, source_id: str, text: str, queue_depth: Optional[int] = None) -> str:
+        """このリクエストで使うバージョンを返す（queue_depthを省略した場合はqueue_depth関数で求める）"""
+        with self._lock:
+            override = self._overrides.get(source_id)
+        if override is not None:
+            self._count("override")
+            return override
+
+        chars = len(text)
+        if queue_depth is None:
+            queue_depth = self._queue_depth()
+        for rule in self._rules:
+            if rule.matches(
+                chars,
+                source_type,
+                queue_depth,
+                lambda: self._p95_latency(self._resolve_model_name(rule.version)),
+            ):
+                self._count(rule.name)
+                return rule.version
+
+        self._count("default")
+        return self._default_version
+
+    def _count(self, reason: str) -> None:
+        with self._lock:
+            self._routed[reason] = self._routed.get(reason, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rules": [rule.name for rule in self._rules],
+                "default_version": self._default_version,
+                "overrides": len(self._overrides),
+                "routed": dict(self._routed),
+            }
@@ -0,0 +1,211 @@
+"""
+LINE Webhook 応答ワーカープール
+
+Webhookでは署名検証とイベントのキュー投入だけを行って即座に200を返し、
+Geminiによる応答生成とLINEへの返信はバックグラウンドのワーカースレッドで実行する。
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# ワーカー停止用の番兵
+_STOP = object()
+
+
+class ReplyWorkerPool:
+    """有界キューと固定数のワーカースレッドでイベントを処理するプール"""
+
+    def __init__(
+        self,
+        handler: Callable[[Any], None],
+        num_workers: int = 4,
+        max_queue_size: int = 100,
+        enqueue_timeout: float = 0.0,
+        name: str = "reply-worker"
+    ) -> None:
+        """
+        Args:
+            handler: キューから取り出したイベントを処理する関数
+            num_workers: ワーカースレッド数
+            max_queue_size: キューに溜められる最大イベント数
+            enqueue_timeout: キューが満杯のときに空きを待つ秒数（0なら待たずに拒否）
+            name: スレッド名の接頭辞
+        """
+        self._handler = handler
+        self._num_workers = max(1, num_workers)
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, max_queue_size))
+        self._enqueue_timeout = enqueue_timeout
+        self._name = name
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._admission = threading.Lock()
+        self._started = False
+        self._closed = False
+
+        # バックプレッシャー計測用カウンタ
+        self._enqueued = 0
+        self._rejected = 0
+        self._processed = 0
+        self._failed = 0
+        self._busy = 0
+        self._max_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def start(self) -> None:
+        """ワーカースレッドを起動する（二重起動はしない）"""
+        with self._lock:
+            if self._started or self._closed:
+                return
+            self._started = True
+            for i in range(self._num_workers):
+                thread = threading.Thread(target=self._run, name=f"{self._name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, item: Any) -> bool:
+        """
+        イベントをキューに投入する
+
+        Returns:
+            投入できた場合はTrue、停止中またはキュー満杯で拒否した場合はFalse
+        """
+        return self.submit_all([item])
+
+    def submit_all(self, items: Iterable[Any]) -> bool:
+        """
+        複数のイベントを全件まとめて投入する（全件分の空きがなければ1件も投入しない）
+
+        Webhookの1リクエストに含まれるイベントを一部だけ受け付けると、LINE側の再送で
+        受け付けた分が二重に処理されるため、受け付けるかどうかはリクエスト単位で決める。
+
+        Returns:
+            全件投入できた場合はTrue、停止中またはキュー満杯で拒否した場合はFalse
+        """
+        items = list(items)
+        if not items:
+            return True
+        if self._closed or len(items) > self._queue.maxsize:
+            with self._lock:
+                self._rejected += len(items)
+            return False
+
+        self.start()
+        # 投入するのはこのロックを持つスレッドだけなので、確認した空きは投入まで減らない
+        with self._admission:
+            if not self._wait_for_space(len(items)):
+                with self._lock:
+                    self._rejected += len(items)
+                logger.warning(
+                    "応答キューが満杯のためイベントを拒否しました (size=%d, events=%d)",
+                    self._queue.maxsize, len(items),
+                )
+                return False
+            enqueued_at = time.monotonic()
+            for item in items:
+                self._queue.put_nowait((enqueued_at, item))
+
+        with self._lock:
+            self._enqueued += len(items)
+            depth = self._queue.qsize()
+            if depth > self._max_depth:
+                self._max_depth = depth
+        return True
+
+    def _wait_for_space(self, count: int) -> bool:
+        """キューに count 件分の空きができるまで最大 enqueue_timeout 秒待つ"""
+        q = self._queue
+        with q.not_full:
+            return q.not_full.wait_for(
+                lambda: q.maxsize - len(q.queue) >= count,
+                timeout=max(0.0, self._enqueue_timeout),
+            )
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            try:
+                if entry is _STOP:
+                    return
+                enqueued_at, item = entry
+                wait = time.monotonic() - enqueued_at
+                with self._lock:
+                    self._busy += 1
+                    self._total_wait += wait
+                    if wait > self._max_wait:
+                        self._max_wait = wait
+                try:
+                    self._handler(item)
+                    with self._lock:
+                        self._processed += 1
+                except Exception:
+                    logger.exception("応答ワーカーでイベント処理中にエラーが発生しました")
+                    with self._lock:
+                        self._failed += 1
+                finally:
+                    with self._lock:
+                        self._busy -= 1
+            finally:
+                self._queue.task_done()
+
+    def shutdown(self, timeout: float = 10.0) -> bool:
+        """
+        新規受付を止め、キューに残ったイベントを処理し終えてからワーカーを停止する
+
+        Args:
+            timeout: 処理完了を待つ最大秒数
+
+        Returns:
+            全ワーカーが時間内に停止した場合はTrue
+        """
+        with self._lock:
+            if self._closed:
+                return not any(t.is_alive() for t in self._threads)
+            self._closed = True
+            started = self._started
+
+        if not started:
+            return True
+
+        deadline = time.monotonic() + timeout
+        # 番兵はキューの末尾に入るため、残っているイベントが先に処理される
+        for _ in self._threads:
+            try:
+                self._queue.put(_STOP, timeout=max(0.01, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+        drained = not any(t.is_alive() for t in self._threads)
+        if not drained:
+            logger.warning("応答ワーカーの停止がタイムアウトしました (残り%d件)", self._queue.qsize())
+        return drained
+
+    def queue_depth(self) -> int:
+        """キューに溜まっているイベント数"""
+        return self._queue.qsize()
+
+    def metrics(self) -> Dict[str, Any]:
+        """キューの深さや処理件数などのバックプレッシャー指標を返す"""
+        with self._lock:
+            handled = self._processed + self._failed
+            return {
+                "workers": self._num_workers,
+                "queue_capacity": self._queue.maxsize,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self._max_depth,
+                "busy_workers": self._busy,
+                "enqueued": self._enqueued,
+                "rejected": self._rejected,
+                "processed": self._processed,
+                "failed": self._failed,
+                "avg_queue_wait_sec": round(self._total_wait / handled, 4) if handled else 0.0,
+                "max_queue_wait_sec": round(self._max_wait, 4),
+                "closed": self._closed,
+            }
@@ -0,0 +1,170 @@
+"""
+日付変更の夜間巡回
+
+全クライアントを深夜の空いている時間帯に巡回し、shortMemories → midLog → longLog の移動と
+要約の登録を、クライアントが次にメッセージを送ってくる前に済ませておく。
+処理済みのクライアントには memory_store["rollover_date"] が記録されるため、
+メッセージの処理では日付の比較だけで済む。
+
+巡回の進み具合はチェックポイントファイルに記録し、途中で再起動しても同じ日のうちなら続きから再開する。
+"""
+
+import asyncio
+import bisect
+import datetime
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RolloverSweeper:
+    """時間帯・レートを制限して全クライアントの日付変更を処理する"""
+
+    def __init__(
+        self,
+        list_clients: Callable[[], List[str]],
+        roll_client: Callable[[str, str], Awaitable[bool]],
+        checkpoint_path: Optional[str] = None,
+        start_hour: int = 3,
+        end_hour: int = 5,
+        rate_per_second: float = 5.0,
+        checkpoint_every: int = 20,
+        poll_interval: float = 60.0,
+        now: Callable[[], datetime.datetime] = datetime.datetime.now
+    ) -> None:
+        """
+        Args:
+            list_clients: 全クライアントIDを昇順で返す関数
+            roll_client: (クライアントID, 日付) を受け取って日付変更を処理するコルーチン関数（処理したらTrue）
+            checkpoint_path: チェックポイントファイルのパス（Noneならメモリ内のみ）
+            start_hour: 巡回する時間帯の開始時刻（時）
+            end_hour: 巡回する時間帯の終了時刻（時、開始より小さければ日付をまたぐ）
+            rate_per_second: 1秒あたりに処理するクライアント数の上限
+            checkpoint_every: この件数ごとにチェックポイントを書き込む
+            poll_interval: 時間帯に入ったかを確認する間隔（秒）
+            now: 現在の日時を返す関数
+        """
+        self._list_clients = list_clients
+        self._roll_client = roll_client
+        self._checkpoint_path = checkpoint_path
+        self._start_hour = start_hour % 24
+        self._end_hour = end_hour % 24
+        self._interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._checkpoint_every = max(1, checkpoint_every)
+        self._poll_interval = max(1.0, poll_interval)
+        self._now = now
+        self._checkpoint: Dict[str, Any] = self._load_checkpoint()
+        self._counters: Dict[str, int] = {
+            "sweeps_started": 0,
+            "sweeps_completed": 0,
+            "clients_checked": 0,
+            "clients_rolled": 0,
+            "errors": 0,
+        }
+
+    def in_window(self, now: Optional[datetime.datetime] = None) -> bool:
+        """巡回する時間帯か"""
+        hour = (now or self._now()).hour
+        if self._start_hour <= self._end_hour:
+            return self._start_hour <= hour < self._end_hour
+        return hour >= self._start_hour or hour < self._end_hour
+
+    async def run(self) -> None:
+        """時間帯に入るたびにその日の巡回を行う（キャンセルされるまで続ける）"""
+        while True:
+            now = self._now()
+            current_date = now.strftime("%Y-%m-%d")
+            if self.in_window(now) and not self._is_completed(current_date):
+                try:
+                    await self.sweep(current_date)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("日付変更の巡回が失敗しました (date=%s)", current_date)
+                    self._counters["errors"] += 1
+            await asyncio.sleep(self._poll_interval)
+
+    async def sweep(self, current_date: str) -> bool:
+        """
+        current_date の日付変更を全クライアントに対して処理する
+
+        Returns:
+            最後まで処理したか（時間帯を過ぎて中断した場合はFalse）
+        """
+        if self._is_completed(current_date):
+            return True
+        self._counters["sweeps_started"] += 1
+        resume_after = self._checkpoint.get("last_client_id") if self._checkpoint.get("date") == current_date else None
+        done = self._checkpoint.get("done", 0) if resume_after else 0
+
+        client_ids = await asyncio.get_running_loop().run_in_executor(None, self._list_clients)
+        if resume_after is not None:
+            # 前回処理したクライアントの次から再開する
+            client_ids = client_ids[bisect.bisect_right(client_ids, resume_after):]
+            logger.info("日付変更の巡回を再開します (date=%s, 残り%d件)", current_date, len(client_ids))
+
+        last_client_id = resume_after
+        for i, client_id in enumerate(client_ids, 1):
+            if not self.in_window():
+                self._save_checkpoint(current_date, last_client_id, done, completed=False)
+                logger.info("時間帯を過ぎたため日付変更の巡回を中断します (date=%s, 処理済み%d件)", current_date, done)
+                return False
+            try:
+                if await self._roll_client(client_id, current_date):
+                    self._counters["clients_rolled"] += 1
+            except Exception:
+                logger.exception("日付変更の処理に失敗しました (client_id=%s)", client_id)
+                self._counters["errors"] += 1
+            self._counters["clients_checked"] += 1
+            last_client_id = client_id
+            done += 1
+            if i % self._checkpoint_every == 0:
+                self._save_checkpoint(current_date, last_client_id, done, completed=False)
+            if self._interval:
+                await asyncio.sleep(self._interval)
+
+        self._save_checkpoint(current_date, last_client_id, done, completed=True)
+        self._counters["sweeps_completed"] += 1
+        logger.info("日付変更の巡回が完了しました (date=%s, %d件)", current_date, done)
+        return True
+
+    def _is_completed(self, current_date: str) -> bool:
+        return self._checkpoint.get("date") == current_date and bool(self._checkpoint.get("completed"))
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        if not self._checkpoint_path or not os.path.exists(self._checkpoint_path):
+            return {}
+        try:
+            with open(self._checkpoint_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning("チェックポイントを読み込めないため最初から巡回します (%s)", self._checkpoint_path)
+            return {}
+
+    def _save_checkpoint(self, current_date: str, last_client_id: Optional[str], done: int, completed: bool) -> None:
+        self._checkpoint = {
+            "date": current_date,
+            "last_client_id": last_client_id,
+            "done": done,
+            "completed": completed,
+        }
+        if not self._checkpoint_path:
+            return
+        # 書き込み途中で止まっても壊れたファイルが残らないよう、一時ファイルから置き換える
+        tmp_path = self._checkpoint_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._checkpoint, f, ensure_ascii=False)
+            os.replace(tmp_path, self._checkpoint_path)
+        except OSError:
+            logger.exception("チェックポイントを書き込めませんでした (%s)", self._checkpoint_path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._counters,
+            "window_hours": [self._start_hour, self._end_hour],
+            "checkpoint": dict(self._checkpoint),
+        }
@@ -0,0 +1,443 @@
+"""
+セッション永続化バックエンド
+
+Botの会話履歴（chat_histories）と、memoryモジュールが更新するsession_storeを
+共通のインターフェースで保存・読み込みする。
+インメモリ実装とSQLite（WALモード）実装を用意し、環境変数で切り替える。
+
+SQLiteのスキーマはBot・メモリ処理・dashboard_server.pyで共通:
+    sessions       … session_storeの1クライアント分（last_activity / memory_store / long_conversation_logs、
+                     session_model.SessionRecord.to_dict() の形式のJSON）
+    sessions_quarantine … 形式が正しくなく読み込めなかったセッション（調査用に退避したもの）
+    chat_histories … Botの直近の会話履歴（source_idごと）
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from session_model import SessionRecord
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    client_id TEXT PRIMARY KEY,
+    last_activity TEXT NOT NULL DEFAULT '',
+    memory_store TEXT NOT NULL DEFAULT '{}',
+    long_conversation_logs TEXT NOT NULL DEFAULT '{}',
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions_quarantine (
+    client_id TEXT NOT NULL,
+    last_activity TEXT,
+    memory_store TEXT,
+    long_conversation_logs TEXT,
+    quarantined_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_histories (
+    source_id TEXT PRIMARY KEY,
+    history TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SessionBackend(ABC):
+    """セッションと会話履歴の保存先の共通インターフェース"""
+
+    # プロセス外に永続化されるかどうか（Falseならプロセス終了で消える）
+    persistent = False
+
+    # --- session_store（memoryモジュール用） ---
+
+    @abstractmethod
+    def get_session(self, client_id: str) -> Optional[SessionRecord]:
+        """クライアントのセッションを取得する（存在しなければNone）"""
+
+    @abstractmethod
+    def put_session(self, client_id: str, record: SessionRecord) -> None:
+        """クライアントのセッションを保存する"""
+
+    @abstractmethod
+    def delete_session(self, client_id: str) -> None:
+        """クライアントのセッションを削除する"""
+
+    def quarantine_session(self, client_id: str) -> None:
+        """読み込めなかったセッションを退避し、そのクライアントを新しいセッションから始められるようにする"""
+        self.delete_session(client_id)
+
+    @abstractmethod
+    def list_sessions(self) -> Dict[str, SessionRecord]:
+        """全クライアントのセッションを {client_id: record} で返す"""
+
+    def list_session_ids(self) -> List[str]:
+        """全クライアントのIDを昇順で返す"""
+        return sorted(self.list_sessions())
+
+    # --- chat_histories（Bot用） ---
+
+    @abstractmethod
+    def get_history(self, source_id: str) -> Optional[List[Dict[str, Any]]]:
+        """会話履歴を取得する（存在しなければNone）"""
+
+    @abstractmethod
+    def put_history(self, source_id: str, history: List[Dict[str, Any]]) -> None:
+        """会話履歴を保存する"""
+
+    # --- 共通 ---
+
+    def flush(self) -> None:
+        """未書き込みのデータを保存先に書き出す"""
+
+    def close(self) -> None:
+        """保存先を閉じる"""
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        """統計情報を返す"""
+        return {"backend": type(self).__name__}
+
+
+class InMemorySessionBackend(SessionBackend):
+    """プロセス内のdictに保持するバックエンド（従来と同じ挙動）"""
+
+    def __init__(self) -> None:
+        self._sessions: Dict[str, SessionRecord] = {}
+        self._histories: Dict[str, List[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, client_id: str) -> Optional[SessionRecord]:
+        with self._lock:
+            return self._sessions.get(client_id)
+
+    def put_session(self, client_id: str, record: SessionRecord) -> None:
+        with self._lock:
+            self._sessions[client_id] = record
+
+    def delete_session(self, client_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(client_id, None)
+
+    def list_sessions(self) -> Dict[str, SessionRecord]:
+        with self._lock:
+            return dict(self._sessions)
+
+    def get_history(self, source_id: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            return self._histories.get(source_id)
+
+    def put_history(self, source_id: str, history: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._histories[source_id] = history
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "histories": len(self._histories),
+            }
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    SQLite（WALモード）に保存するバックエンド
+
+    書き込みはバッファに溜めてまとめてコミットし、読み込みは上限付きのキャッシュを経由する。
+    書き込むプロセスは1つだけにする（Botは自分のキャッシュ上のセッションを書き戻すため、
+    複数のプロセスから書き込むと他のプロセスの更新を上書きしてしまう）。
+    ダッシュボードのように読むだけのプロセスは、cache_ttl ごとに書き込み側の更新を読み直す。
+
+    バッファとキャッシュには書き込んだ時点でシリアライズした行を保持し、読み込むたびにレコードを作り直す。
+    呼び出し元が書き込み後にレコードを変更しても、書き込み済みの内容や他の呼び出し元には影響しない。
+    """
+
+    persistent = True
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        cache_size: int = 1000,
+        cache_ttl: Optional[float] = 5.0
+    ) -> None:
+        """
+        Args:
+            path: SQLiteファイルのパス
+            batch_size: この件数の書き込みが溜まったら即座にコミットする
+            flush_interval: 書き込みバッファをコミットする間隔（秒、0以下なら自動コミットしない）
+            cache_size: 読み込みキャッシュの最大件数
+            cache_ttl: キャッシュの有効秒数（Noneなら無期限。読むだけのプロセスで書き込み側の更新を取り込む間隔）
+        """
+        self._path = path
+        self._batch_size = max(1, batch_size)
+        self._cache_size = max(0, cache_size)
+        self._cache_ttl = cache_ttl if cache_ttl and cache_ttl > 0 else None
+        self._lock = threading.RLock()
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.executescript(SCHEMA)
+
+        # 書き込み待ちの行（キーはテーブル名とID、値は _encode の戻り値。削除はNone）
+        self._pending: "OrderedDict[Tuple[str, str], Optional[Any]]" = OrderedDict()
+        # 読み込みキャッシュ: (テーブル名, ID) -> (読み込み時刻, 行)
+        self._cache: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._flushes = 0
+        self._rows_written = 0
+        self._quarantined = 0
+
+        self._closed = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, args=(flush_interval,), name="session-backend-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    # --- session_store ---
+
+    def get_session(self, client_id: str) -> Optional[SessionRecord]:
+        return self._read(("sessions", client_id))
+
+    def put_session(self, client_id: str, record: SessionRecord) -> None:
+        self._write(("sessions", client_id), record)
+
+    def delete_session(self, client_id: str) -> None:
+        self._write(("sessions", client_id), None)
+
+    def quarantine_session(self, client_id: str) -> None:
+        # 壊れた行は消さずに sessions_quarantine へ移す
+        with self._lock:
+            self._flush_locked()
+            key = ("sessions", client_id)
+            self._cache.pop(key, None)
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.execute(
+                    "INSERT INTO sessions_quarantine "
+                    "(client_id, last_activity, memory_store, long_conversation_logs, quarantined_at) "
+                    "SELECT client_id, last_activity, memory_store, long_conversation_logs, ? "
+                    "FROM sessions WHERE client_id = ?",
+                    (time.time(), client_id),
+                )
+                self._conn.execute("DELETE FROM sessions WHERE client_id = ?", (client_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                raise
+            self._quarantined += 1
+
+    def list_sessions(self) -> Dict[str, SessionRecord]:
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT client_id, last_activity, memory_store, long_conversation_logs FROM sessions"
+            ).fetchall()
+        sessions = {}
+        for row in rows:
+            try:
+                sessions[row[0]] = self._decode_session(row[1:])
+            except ValueError:  # JSONが壊れている・SessionFormatError
+                logger.warning("形式が正しくないセッションを読み飛ばしました (client_id=%s)", row[0])
+        return sessions
+
+    def list_session_ids(self) -> List[str]:
+        # セッションの中身は読み込まずにIDだけを取得する
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute("SELECT client_id FROM sessions ORDER BY client_id").fetchall()
+        return [row[0] for row in rows]
+
+    # --- chat_histories ---
+
+    def get_history(self, source_id: str) -> Optional[List[Dict[str, Any]]]:
+        return self._read(("chat_histories", source_id))
+
+    def put_history(self, source_id: str, history: List[Dict[str, Any]]) -> None:
+        self._write(("chat_histories", source_id), list(history))
+
+    # --- 読み書きの共通処理 ---
+
+    def _read(self, key: Tuple[str, str]) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            if key in self._pending:
+                row = self._pending[key]
+            else:
+                cached = self._cache.get(key)
+                if cached is not None and (self._cache_ttl is None or now - cached[0] <= self._cache_ttl):
+                    self._cache.move_to_end(key)
+                    self._cache_hits += 1
+                    row = cached[1]
+                else:
+                    self._cache_misses += 1
+                    row = self._load(key)
+                    self._remember(key, row, now)
+        # ロックの外で作り直す（形式が正しくなければ SessionFormatError）
+        return self._decode(key[0], row) if row is not None else None
+
+    def _write(self, key: Tuple[str, str], value: Any) -> None:
+        # 呼び出し元のロックを保持している間にシリアライズし、フラッシュ時には変更中のレコードに触れない
+        row = self._encode(key[0], value) if value is not None else None
+        with self._lock:
+            self._pending[key] = row
+            self._pending.move_to_end(key)
+            self._remember(key, row, time.monotonic())
+            if len(self._pending) >= self._batch_size:
+                self._flush_locked()
+
+    def _remember(self, key: Tuple[str, str], value: Any, now: float) -> None:
+        if self._cache_size == 0:
+            return
+        self._cache[key] = (now, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, key: Tuple[str, str]) -> Any:
+        table, item_id = key
+        if table == "sessions":
+            return self._conn.execute(
+                "SELECT last_activity, memory_store, long_conversation_logs FROM sessions WHERE client_id = ?",
+                (item_id,),
+            ).fetchone()
+        row = self._conn.execute(
+            "SELECT history FROM chat_histories WHERE source_id = ?", (item_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _encode(table: str, value: Any) -> Any:
+        if table == "sessions":
+            return (
+                value.last_activity,
+                json.dumps(value.memory.to_dict(), ensure_ascii=False),
+                json.dumps(value.logs.to_dict(), ensure_ascii=False),
+            )
+        return json.dumps(value, ensure_ascii=False)
+
+    def _decode(self, table: str, row: Any) -> Any:
+        if table == "sessions":
+            return self._decode_session(row)
+        return json.loads(row)
+
+    @staticmethod
+    def _decode_session(row) -> SessionRecord:
+        # 読み込むときに形式を検証する（正しくなければ SessionFormatError）
+        return SessionRecord.from_dict({
+            "last_activity": row[0],
+            "memory_store": json.loads(row[1]),
+            "long_conversation_logs": json.loads(row[2]),
+        })
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        if not self._pending:
+            return
+        pending = list(self._pending.items())
+        now = time.time()
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for (table, item_id), row in pending:
+                if table == "sessions":
+                    if row is None:
+                        self._conn.execute("DELETE FROM sessions WHERE client_id = ?", (item_id,))
+                    else:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO sessions "
+                            "(client_id, last_activity, memory_store, long_conversation_logs, updated_at) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (item_id, *row, now),
+                        )
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO chat_histories (source_id, history, updated_at) VALUES (?, ?, ?)",
+                        (item_id, row, now),
+                    )
+            self._conn.execute("COMMIT")
+        except Exception:
+            # BEGIN自体が失敗した（ロック待ちのタイムアウトなど）場合はトランザクションが始まっていない
+            logger.exception("セッションの書き込みに失敗しました（%d件）", len(pending))
+            if self._conn.in_transaction:
+                try:
+                    self._conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    logger.exception("セッションの書き込みのロールバックに失敗しました")
+            return
+        self._pending.clear()
+        self._flushes += 1
+        self._rows_written += len(pending)
+
+    def _flush_loop(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("セッションの定期書き込みに失敗しました")
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        with self._lock:
+            self._flush_locked()
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._cache_hits + self._cache_misses
+            return {
+                "backend": "sqlite",
+                "path": self._path,
+                "pending_writes": len(self._pending),
+                "cached": len(self._cache),
+                "cache_hits": self._cache_hits,
+                "cache_misses": self._cache_misses,
+                "cache_hit_rate": round(self._cache_hits / lookups, 4) if lookups else 0.0,
+                "flushes": self._flushes,
+                "rows_written": self._rows_written,
+                "quarantined_sessions": self._quarantined,
+            }
+
+
+def create_session_backend(kind: Optional[str] = None, path: Optional[str] = None) -> SessionBackend:
+    """
+    環境変数の設定に従ってバックエンドを作成する
+
+    SESSION_BACKEND: "memory"（既定）または "sqlite"
+    SESSION_DB_PATH: SQLiteファイルのパス（既定は sessions.db）
+    SESSION_BATCH_SIZE / SESSION_FLUSH_INTERVAL / SESSION_CACHE_SIZE / SESSION_CACHE_TTL: SQLiteの書き込み・キャッシュ設定
+    （SESSION_CACHE_TTL=0 でキャッシュを無期限にする。DBに書き込めるのは1プロセスだけで、複数プロセスでの共有には対応しない）
+    """
+    kind = (kind or os.getenv("SESSION_BACKEND", "memory")).lower()
+    if kind == "memory":
+        return InMemorySessionBackend()
+    if kind == "sqlite":
+        return SQLiteSessionBackend(
+            path or os.getenv("SESSION_DB_PATH", "sessions.db"),
+            batch_size=int(os.getenv("SESSION_BATCH_SIZE", "50")),
+            flush_interval=float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0")),
+            cache_size=int(os.getenv("SESSION_CACHE_SIZE", "1000")),
+            cache_ttl=float(os.getenv("SESSION_CACHE_TTL", "5")) or None,
+        )
+    raise ValueError(f"Unknown SESSION_BACKEND: {kind}")
@@ -0,0 +1,378 @@
+"""
+クライアントのセッション（session_storeの1クライアント分）
+
+memoryモジュールが読み書きするセッションを、文字列キーの入れ子のdictではなく __slots__ のクラスで持つ。
+midLog（最大7件）とlongLog（最大52件）は上限付きのdequeで持ち、上限を超えた古いエントリは追加するときに捨てる。
+永続化先やダッシュボードとは従来と同じJSONの形（to_dict / from_dict）でやり取りし、
+読み込むときに型を検証する（古い形式の文字列のログなどはここで直す）。
+
+very_long_log もメモリ上には直近の VERY_LONG_LOG_RETENTION 件だけを保持する。
+それより古いログは呼び出し側が追記専用のファイル（log_archive.py）に書き出す。
+
+環境変数:
+    VERY_LONG_LOG_RETENTION: メモリ上（と永続化先のセッション）に保持する会話ログの件数（既定 200）
+"""
+
+import os
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional
+
+# メモリ上に保持するvery_long_logの件数（要約に使う件数より少なければ、足りない分はアーカイブから読む）
+VERY_LONG_LOG_RETENTION = int(os.getenv("VERY_LONG_LOG_RETENTION", "200"))
+# midLogに保持する日数（1週間分）
+MID_LOG_MAX = 7
+# longLogに保持する週数（1年分）
+LONG_LOG_MAX = 52
+
+
+# approx_bytes の見積もりに使う、レコード全体と文字列1つあたりのオブジェクトのヘッダ分
+_RECORD_OVERHEAD_BYTES = 1024
+_ITEM_OVERHEAD_BYTES = 60
+
+
+class SessionFormatError(ValueError):
+    """保存されたセッションの形式が正しくない"""
+
+
+def _require_dict(value: Any, name: str) -> Dict[str, Any]:
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise SessionFormatError(f"{name} must be an object, got {type(value).__name__}")
+    return value
+
+
+def _optional_str(data: Dict[str, Any], key: str, default: Optional[str] = "") -> Optional[str]:
+    value = data.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise SessionFormatError(f"{key} must be a string, got {type(value).__name__}")
+    return value
+
+
+def _optional_int(data: Dict[str, Any], key: str, default: Optional[int] = None) -> Optional[int]:
+    value = data.get(key)
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise SessionFormatError(f"{key} must be an integer, got {type(value).__name__}")
+    return value
+
+
+def _text_log(value: Any, name: str) -> List[str]:
+    # 古い形式では1件分の文字列がそのまま入っていることがある
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise SessionFormatError(f"{name} must be a list of strings")
+    return value
+
+
+class LogEntry:
+    """very_long_logの1件（1発言）"""
+
+    __slots__ = ("role", "content", "timestamp")
+
+    def __init__(self, role: str, content: str, timestamp: str = "") -> None:
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content, "timestamp": self.timestamp}
+
+    @classmethod
+    def from_dict(cls, data: Any) -> "LogEntry":
+        data = _require_dict(data, "very_long_log entry")
+        role = _optional_str(data, "role", None)
+        content = _optional_str(data, "content", None)
+        if role is None or content is None:
+            raise SessionFormatError("very_long_log entry must have role and content")
+        return cls(role, content, _optional_str(data, "timestamp"))
+
+    def __repr__(self) -> str:
+        return f"LogEntry(role={self.role!r}, timestamp={self.timestamp!r}, chars={len(self.content)})"
+
+
+class VeryLongLog:
+    """
+    直近の会話ログを上限（retention）件まで保持する
+
+    上限を超えて追加すると最も古いログを spilled に移す。spilled は呼び出し側がファイルに書き出してから
+    clear_spilled() で空にする（書き出すまでは to_dict() の出力にも含まれるので失われない）。
+    位置（memory.summary_cursor など）はクライアントの最初のログからの通し番号で数え、
+    メモリ上の先頭のログの通し番号が offset になる。
+    """
+
+    __slots__ = ("_entries", "_spilled", "offset")
+
+    def __init__(
+        self,
+        entries: Iterable[LogEntry] = (),
+        offset: int = 0,
+        retention: int = VERY_LONG_LOG_RETENTION
+    ) -> None:
+        self._entries: Deque[LogEntry] = deque(maxlen=max(1, retention))
+        self._spilled: List[LogEntry] = []
+        self.offset = offset
+        for entry in entries:
+            self.append(entry)
+
+    @property
+    def retention(self) -> int:
+        return self._entries.maxlen
+
+    @property
+    def total(self) -> int:
+        """これまでに追加したログの件数（末尾の通し番号）"""
+        return self.offset + len(self._entries)
+
+    @property
+    def spilled(self) -> List[LogEntry]:
+        """上限からあふれ、まだ書き出していないログ（古い順）"""
+        return self._spilled
+
+    def append(self, entry: LogEntry) -> None:
+        entries = self._entries
+        if len(entries) == entries.maxlen:
+            self._spilled.append(entries[0])
+            self.offset += 1
+        entries.append(entry)
+
+    def clear_spilled(self) -> None:
+        self._spilled = []
+
+    def drop_spilled(self, keep: int) -> int:
+        """
+        まだ書き出していないログを新しい方から keep 件だけ残して捨てる
+
+        Returns:
+            捨てた件数
+        """
+        dropped = len(self._spilled) - max(0, keep)
+        if dropped <= 0:
+            return 0
+        del self._spilled[:dropped]
+        return dropped
+
+    def tail(self, count: int) -> List[LogEntry]:
+        """新しいログを最大count件、古い順に返す（メモリ上のログ全体はコピーしない）"""
+        entries = self._entries
+        if count <= 0:
+            return []
+        if count >= len(entries):
+            return list(entries)
+        recent = list(islice(reversed(entries), count))
+        recent.reverse()
+        return recent
+
+    def since(self, position: int) -> List[LogEntry]:
+        """通し番号 position 以降のログを返す（メモリ上にない分は含まない）"""
+        return self.tail(self.total - max(position, self.offset))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[LogEntry]:
+        return iter(self._entries)
+
+    def __getitem__(self, index: int) -> LogEntry:
+        return self._entries[index]
+
+    def to_list(self) -> List[Dict[str, str]]:
+        return [entry.to_dict() for entry in self._spilled] + [entry.to_dict() for entry in self._entries]
+
+    def __repr__(self) -> str:
+        return f"VeryLongLog(offset={self.offset}, entries={len(self._entries)}, spilled={len(self._spilled)})"
+
+
+class MemoryStore:
+    """要約した記憶と、記憶処理の進み具合（JSONの memory_store）"""
+
+    __slots__ = (
+        "short_memories",
+        "mid_memories",
+        "long_memories",
+        "total_memories",
+        "rollover_date",
+        "rollover_pending",
+        "summary_cursor",
+        "summary_date",
+        "summary_updates",
+    )
+
+    def __init__(
+        self,
+        short_memories: str = "",
+        mid_memories: str = "",
+        long_memories: str = "",
+        total_memories: str = "",
+        rollover_date: Optional[str] = None,
+        rollover_pending: Iterable[str] = (),
+        summary_cursor: Optional[int] = None,
+        summary_date: Optional[str] = None,
+        summary_updates: int = 0
+    ) -> None:
+        self.short_memories = short_memories
+        self.mid_memories = mid_memories
+        self.long_memories = long_memories
+        self.total_memories = total_memories
+        # 日付変更の処理を行った日付
+        self.rollover_date = rollover_date
+        # 日付変更で要約し直す必要があり、まだ終わっていない階層（"long" / "mid"）
+        self.rollover_pending: List[str] = list(rollover_pending)
+        # shortMemoriesに反映済みのvery_long_logの件数と、その要約の対象日・差分更新の回数
+        self.summary_cursor = summary_cursor
+        self.summary_date = summary_date
+        self.summary_updates = summary_updates
+
+    def to_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "shortMemories": self.short_memories,
+            "midMemories": self.mid_memories,
+            "longMemories": self.long_memories,
+            "totalMemories": self.total_memories,
+        }
+        # 記憶処理の進み具合は記録したものだけを書き出す
+        if self.rollover_date is not None:
+            data["rollover_date"] = self.rollover_date
+        if self.rollover_pending:
+            data["rollover_pending"] = list(self.rollover_pending)
+        if self.summary_cursor is not None:
+            data["summary_cursor"] = self.summary_cursor
+            data["summary_date"] = self.summary_date
+            data["summary_updates"] = self.summary_updates
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Any) -> "MemoryStore":
+        data = _require_dict(data, "memory_store")
+        return cls(
+            short_memories=_optional_str(data, "shortMemories"),
+            mid_memories=_optional_str(data, "midMemories"),
+            long_memories=_optional_str(data, "longMemories"),
+            total_memories=_optional_str(data, "totalMemories"),
+            rollover_date=_optional_str(data, "rollover_date", None),
+            rollover_pending=_text_log(data.get("rollover_pending"), "rollover_pending"),
+            summary_cursor=_optional_int(data, "summary_cursor"),
+            summary_date=_optional_str(data, "summary_date", None),
+            summary_updates=_optional_int(data, "summary_updates", 0),
+        )
+
+
+class ConversationLogs:
+    """会話ログと日ごと・週ごとの要約の履歴（JSONの long_conversation_logs）"""
+
+    __slots__ = ("very_long_log", "mid_log", "long_log")
+
+    def __init__(
+        self,
+        very_long_log: Optional[VeryLongLog] = None,
+        mid_log: Iterable[str] = (),
+        long_log: Iterable[str] = ()
+    ) -> None:
+        self.very_long_log = very_long_log if very_long_log is not None else VeryLongLog()
+        # 上限を超えて追加すると最も古いエントリが捨てられる
+        self.mid_log: Deque[str] = deque(mid_log, maxlen=MID_LOG_MAX)
+        self.long_log: Deque[str] = deque(long_log, maxlen=LONG_LOG_MAX)
+
+    def to_dict(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {
+            "very_long_log": self.very_long_log.to_list(),
+            "midLog": list(self.mid_log),
+            "longLog": list(self.long_log),
+        }
+        # ファイルに書き出したログの件数（very_long_logの先頭の通し番号）
+        offset = self.very_long_log.offset - len(self.very_long_log.spilled)
+        if offset:
+            data["very_long_log_offset"] = offset
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Any) -> "ConversationLogs":
+        data = _require_dict(data, "long_conversation_logs")
+        very_long_log = data.get("very_long_log")
+        # 古い形式では文字列が入っていることがある（会話ログとしては読めないので捨てる）
+        if very_long_log is None or isinstance(very_long_log, str):
+            very_long_log = []
+        if not isinstance(very_long_log, list):
+            raise SessionFormatError("very_long_log must be a list")
+        return cls(
+            very_long_log=VeryLongLog(
+                (LogEntry.from_dict(entry) for entry in very_long_log),
+                offset=_optional_int(data, "very_long_log_offset", 0),
+            ),
+            mid_log=_text_log(data.get("midLog"), "midLog"),
+            long_log=_text_log(data.get("longLog"), "longLog"),
+        )
+
+
+class SessionRecord:
+    """1クライアント分のセッション"""
+
+    __slots__ = ("last_activity", "memory", "logs")
+
+    def __init__(
+        self,
+        last_activity: str = "",
+        memory: Optional[MemoryStore] = None,
+        logs: Optional[ConversationLogs] = None
+    ) -> None:
+        # 記憶処理を行った最後の会話の時刻（YYYY-MM-DD HH:MM:SS）
+        self.last_activity = last_activity
+        self.memory = memory if memory is not None else MemoryStore()
+        self.logs = logs if logs is not None else ConversationLogs()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """従来のsession_storeの形式（JSON）に変換する"""
+        return {
+            "last_activity": self.last_activity,
+            "memory_store": self.memory.to_dict(),
+            "long_conversation_logs": self.logs.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Any) -> "SessionRecord":
+        """
+        to_dict() の形式（従来のsession_storeの形式）から復元する
+
+        Raises:
+            SessionFormatError: 形式が正しくない場合
+        """
+        data = _require_dict(data, "session")
+        return cls(
+            last_activity=_optional_str(data, "last_activity"),
+            memory=MemoryStore.from_dict(data.get("memory_store")),
+            logs=ConversationLogs.from_dict(data.get("long_conversation_logs")),
+        )
+
+    def approx_bytes(self) -> int:
+        """おおよそのメモリ量（バイト）。文字数から概算する（履歴ストアの容量管理用）"""
+        # 日本語は1文字2バイト、文字列・会話ログ1件ごとにオブジェクトのヘッダ分を加算
+        memory = self.memory
+        chars = (
+            len(memory.short_memories) + len(memory.mid_memories)
+            + len(memory.long_memories) + len(memory.total_memories)
+        )
+        items = 4
+        for text in self.logs.mid_log:
+            chars += len(text)
+        for text in self.logs.long_log:
+            chars += len(text)
+        items += len(self.logs.mid_log) + len(self.logs.long_log)
+        very_long_log = self.logs.very_long_log
+        for entries in (very_long_log, very_long_log.spilled):
+            for entry in entries:
+                chars += len(entry.content) + len(entry.timestamp)
+            items += len(entries) * 3
+        return _RECORD_OVERHEAD_BYTES + items * _ITEM_OVERHEAD_BYTES + chars * 2
+
+    def __repr__(self) -> str:
+        return (
+            f"SessionRecord(last_activity={self.last_activity!r}, very_long_log={self.logs.very_long_log.total}, "
+            f"midLog={len(self.logs.mid_log)}, longLog={len(self.logs.long_log)})"
+        )
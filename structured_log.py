@@ -0,0 +1,109 @@
+"""
+構造化ログ
+
+ログの出力はキュー経由で専用スレッド（QueueListener）に任せ、呼び出し元ではメッセージの整形もI/Oも行わない。
+項目は Fields で渡し、出力されるときにだけ "key=value" またはJSONに整形する。
+要約本文や会話ログなどの中身は DEBUG でのみ、サンプリングした一部だけを出力する（INFOでは件数・文字数・IDだけ）。
+
+環境変数:
+    LOG_LEVEL: ルートロガーのレベル（既定 INFO）
+    LOG_FORMAT: "text"（既定）または "json"
+    LOG_PAYLOAD_SAMPLE_RATE: DEBUGで中身を出力する割合（0〜1、既定 0.1）
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, Optional
+
+_listener: Optional[QueueListener] = None
+
+
+class Fields:
+    """ログの項目（出力されるときにだけ "key=value ..." に整形される）"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, **values: Any) -> None:
+        self.values = values
+
+    def __str__(self) -> str:
+        return " ".join(f"{key}={value}" for key, value in self.values.items())
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする（メッセージの引数の Fields は個別の項目として展開する）"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        args = record.args if isinstance(record.args, tuple) else ()
+        for arg in args:
+            if isinstance(arg, Fields):
+                data.update(arg.values)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """レコードを整形せずにキューへ渡す（整形はリスナーのスレッドで行う）"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class PayloadSampler:
+    """DEBUGで中身を出力するレコードを間引く"""
+
+    def __init__(self, rate: float, rng: Callable[[], float] = random.random) -> None:
+        self.rate = min(1.0, max(0.0, rate))
+        self._rng = rng
+
+    def sampled(self) -> bool:
+        return self.rate >= 1.0 or (self.rate > 0.0 and self._rng() < self.rate)
+
+
+payload_sampler = PayloadSampler(float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1")))
+
+
+def log_payload(logger: logging.Logger, message: str, payload: str, fields: Optional[Fields] = None) -> None:
+    """中身（要約本文・会話ログなど）をDEBUGで、サンプリングした分だけ出力する"""
+    if logger.isEnabledFor(logging.DEBUG) and payload_sampler.sampled():
+        logger.debug("%s %s payload=%s", message, fields or "", payload)
+
+
+def setup_queue_logging(level: Optional[str] = None, fmt: Optional[str] = None) -> QueueListener:
+    """
+    ルートロガーの出力をキュー経由にする（2回目以降は何もしない）
+
+    Returns:
+        出力を担当するQueueListener（プロセス終了時に自動で停止する）
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    handler = logging.StreamHandler()
+    if (fmt or os.getenv("LOG_FORMAT", "text")).lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
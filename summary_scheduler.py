@@ -0,0 +1,277 @@
+"""
+要約ジョブのスケジューラ
+
+memory.py の要約処理（shortMemories / midMemories / longMemories）をジョブとして受け取り、
+優先度順に、全体の同時実行数と1分あたりの実行数を制限して実行する。
+同じクライアント・同じ階層のジョブは実行待ちの間に1つにまとめ、
+日付変更で発生する要約は指定した時間幅に分散させて、深夜0時過ぎにモデル呼び出しが集中しないようにする。
+"""
+
+import asyncio
+import heapq
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 階層ごとの優先度（小さいほど先に実行する）
+DEFAULT_TIER_PRIORITIES = {
+    "short": 0,
+    "mid": 1,
+    "long": 2,
+}
+
+
+class _Job:
+    __slots__ = ("key", "factory", "priority", "seq", "ready_at")
+
+    def __init__(
+        self,
+        key: Tuple[str, str],
+        factory: Callable[[], Awaitable[None]],
+        priority: int,
+        seq: int,
+        ready_at: float
+    ) -> None:
+        self.key = key
+        self.factory = factory
+        self.priority = priority
+        self.seq = seq
+        self.ready_at = ready_at
+
+
+class SummaryScheduler:
+    """
+    要約ジョブを優先度付きキューで管理し、同時実行数とレート制限の範囲で実行する
+
+    ジョブを登録したイベントループの中で動く（最初の submit で実行用のタスクを起動する）。
+    stats だけは他のスレッドからも呼べるよう、実行待ちのジョブと計測値の変更はロックを取って行う。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 2,
+        rate_per_minute: float = 30.0,
+        spread_window: float = 0.0,
+        tier_priorities: Optional[Dict[str, int]] = None,
+        on_complete: Optional[Callable[[str], None]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        rng: Callable[[], float] = random.random
+    ) -> None:
+        """
+        Args:
+            max_concurrency: 同時に実行する要約の最大数
+            rate_per_minute: 1分あたりに開始する要約の最大数（0以下なら制限しない）
+            spread_window: spread=True で登録したジョブを遅らせる最大秒数（この範囲でランダムに分散）
+            tier_priorities: 階層 → 優先度（小さいほど先に実行）
+            on_complete: ジョブが終わるたびにクライアントIDを渡して呼ぶ関数（永続化など）
+            clock: 現在時刻を返す関数
+            rng: 0以上1未満の乱数を返す関数
+        """
+        self._max_concurrency = max(1, max_concurrency)
+        self._rate = rate_per_minute / 60.0 if rate_per_minute and rate_per_minute > 0 else None
+        # 枠が溜まっていても一度に開始するのは同時実行数まで
+        self._burst = float(self._max_concurrency) if self._rate else None
+        self._tokens = self._burst or 0.0
+        self._spread_window = max(0.0, spread_window)
+        self._priorities = dict(DEFAULT_TIER_PRIORITIES if tier_priorities is None else tier_priorities)
+        self._on_complete = on_complete
+        self._clock = clock
+        self._rng = rng
+        self._refilled_at = clock()
+
+        # (クライアントID, 階層) → 実行待ちのジョブ
+        self._pending: Dict[Tuple[str, str], _Job] = {}
+        # 実行可能時刻を待っているジョブ: (実行可能時刻, 登録順, キー)
+        self._delayed: List[Tuple[float, int, Tuple[str, str]]] = []
+        # 実行可能なジョブ: (優先度, 登録順, キー)
+        self._ready: List[Tuple[int, int, Tuple[str, str]]] = []
+        self._seq = 0
+        self._active = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+        # stats を他のスレッドから読むためのロック（イベントループの中では待つことはほとんどない）
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "submitted": 0,
+            "deduplicated": 0,
+            "completed": 0,
+            "failed": 0,
+        }
+        self._total_queue_wait = 0.0
+        self._max_queue_wait = 0.0
+
+    def submit(
+        self,
+        client_id: str,
+        tier: str,
+        factory: Callable[[], Awaitable[None]],
+        spread: bool = False
+    ) -> bool:
+        """
+        要約ジョブを登録する（イベントループの中から呼ぶ）
+
+        Args:
+            client_id: クライアントID
+            tier: 要約の階層（"short" / "mid" / "long"）
+            factory: 実行時に呼んで要約処理のコルーチンを作る関数
+            spread: Trueなら spread_window の範囲でランダムに実行を遅らせる
+
+        Returns:
+            新しく登録したか。同じクライアント・階層のジョブが実行待ちならFalseで、
+            そのジョブの順番はそのままに、実行する処理を新しい factory に置き換える
+        """
+        self._ensure_started()
+        key = (client_id, tier)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                # 後から登録された方が新しい引数（日付など）を持つので、そちらを実行する
+                pending.factory = factory
+                self._counters["deduplicated"] += 1
+                return False
+
+            now = self._clock()
+            delay = self._rng() * self._spread_window if spread else 0.0
+            self._seq += 1
+            job = _Job(key, factory, self._priorities.get(tier, len(self._priorities)), self._seq, now + delay)
+            self._pending[key] = job
+            self._counters["submitted"] += 1
+        if delay > 0:
+            heapq.heappush(self._delayed, (job.ready_at, job.seq, key))
+        else:
+            heapq.heappush(self._ready, (job.priority, job.seq, key))
+        self._wakeup.set()
+        return True
+
+    def _ensure_started(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = self._clock()
+            # 実行可能時刻になったジョブを実行可能キューへ移す
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, key = heapq.heappop(self._delayed)
+                job = self._pending[key]
+                heapq.heappush(self._ready, (job.priority, seq, key))
+
+            timeout = None
+            if self._ready and self._active < self._max_concurrency:
+                wait = self._take_token(now)
+                if wait == 0.0:
+                    _, _, key = heapq.heappop(self._ready)
+                    with self._lock:
+                        job = self._pending.pop(key)
+                    self._start(job, now)
+                    continue
+                timeout = wait
+            if self._delayed:
+                until_ready = self._delayed[0][0] - now
+                timeout = until_ready if timeout is None else min(timeout, until_ready)
+
+            # 新しい登録・ジョブの完了・時刻の到来のどれかまで待つ
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _take_token(self, now: float) -> float:
+        """レート制限の枠を1つ使う。使えたら0、使えなければ使えるようになるまでの秒数を返す"""
+        if self._rate is None:
+            return 0.0
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self._rate
+
+    def _start(self, job: _Job, now: float) -> None:
+        queue_wait = max(0.0, now - job.ready_at)
+        with self._lock:
+            self._total_queue_wait += queue_wait
+            if queue_wait > self._max_queue_wait:
+                self._max_queue_wait = queue_wait
+            self._active += 1
+        task = asyncio.get_running_loop().create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: _Job) -> None:
+        client_id, tier = job.key
+        try:
+            await job.factory()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("要約ジョブが失敗しました (client_id=%s, tier=%s)", client_id, tier)
+            self._count("failed")
+        else:
+            self._count("completed")
+        finally:
+            with self._lock:
+                self._active -= 1
+            if self._on_complete is not None:
+                try:
+                    self._on_complete(client_id)
+                except Exception:
+                    logger.exception("要約ジョブの完了処理に失敗しました (client_id=%s)", client_id)
+            self._wakeup.set()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counters[name] += 1
+
+    async def drain(self, timeout: float = 10.0) -> bool:
+        """
+        実行中のジョブの完了を待って停止する（実行待ちのジョブは破棄する）
+
+        Returns:
+            実行中のジョブがすべてタイムアウト内に完了したか
+        """
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        with self._lock:
+            self._pending.clear()
+            self._delayed.clear()
+        self._ready.clear()
+        if not self._tasks:
+            return True
+        _, pending = await asyncio.wait(set(self._tasks), timeout=max(0.01, timeout))
+        for task in pending:
+            task.cancel()
+        return not pending
+
+    def stats(self) -> Dict[str, Any]:
+        """計測値を返す（どのスレッドからも呼べる）"""
+        with self._lock:
+            counters = dict(self._counters)
+            tiers = [tier for _, tier in self._pending]
+            delayed = len(self._delayed)
+            active = self._active
+            total_queue_wait = self._total_queue_wait
+            max_queue_wait = self._max_queue_wait
+        started = counters["completed"] + counters["failed"] + active
+        pending_by_tier: Dict[str, int] = {}
+        for tier in tiers:
+            pending_by_tier[tier] = pending_by_tier.get(tier, 0) + 1
+        return {
+            **counters,
+            "pending": pending_by_tier,
+            "delayed": delayed,
+            "running": active,
+            "max_concurrency": self._max_concurrency,
+            "rate_per_minute": round(self._rate * 60, 3) if self._rate else None,
+            "spread_window_sec": self._spread_window,
+            "avg_queue_wait_sec": round(total_queue_wait / started, 3) if started else 0.0,
+            "max_queue_wait_sec": round(max_queue_wait, 3),
+        }
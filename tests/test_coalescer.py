@@ -0,0 +1,81 @@
+import threading
+import time
+
+from coalescer import MessageCoalescer
+
+
+class Collector:
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.batches = []
+        self.flushed = threading.Event()
+
+    def __call__(self, key, items):
+        self.batches.append((key, list(items)))
+        self.flushed.set()
+        return self.accept
+
+
+def test_messages_within_window_are_merged():
+    collector = Collector()
+    coalescer = MessageCoalescer(collector, window=0.1, max_wait=5)
+    coalescer.add("u1", "a")
+    coalescer.add("u1", "b")
+    coalescer.add("u2", "c")
+    assert collector.batches == []
+
+    time.sleep(0.3)
+    assert sorted(collector.batches) == [("u1", ["a", "b"]), ("u2", ["c"])]
+    stats = coalescer.stats()
+    assert stats["batches"] == 2 and stats["merged_messages"] == 1 and stats["pending_sources"] == 0
+
+
+def test_new_message_extends_the_window():
+    collector = Collector()
+    coalescer = MessageCoalescer(collector, window=0.2, max_wait=5)
+    coalescer.add("u1", "a")
+    time.sleep(0.1)
+    coalescer.add("u1", "b")
+    time.sleep(0.15)
+    # 最初のメッセージからは window を過ぎたが、最後のメッセージからはまだ
+    assert collector.batches == []
+    assert collector.flushed.wait(1)
+    assert collector.batches == [("u1", ["a", "b"])]
+
+
+def test_max_messages_flushes_immediately():
+    collector = Collector()
+    coalescer = MessageCoalescer(collector, window=10, max_wait=10, max_messages=2)
+    coalescer.add("u1", "a")
+    coalescer.add("u1", "b")
+    assert collector.batches == [("u1", ["a", "b"])]
+    assert coalescer.stats()["pending_sources"] == 0
+
+
+def test_flush_all_runs_pending_batches():
+    collector = Collector()
+    coalescer = MessageCoalescer(collector, window=10, max_wait=10)
+    coalescer.add("u1", "a")
+    coalescer.add("u2", "b")
+    coalescer.flush_all()
+    assert sorted(collector.batches) == [("u1", ["a"]), ("u2", ["b"])]
+    assert coalescer.stats()["scheduled_deadlines"] == 0
+
+
+def test_rejected_batches_are_counted():
+    collector = Collector(accept=False)
+    coalescer = MessageCoalescer(collector, window=10, max_wait=10, max_messages=2)
+    coalescer.add("u1", "a")
+    coalescer.add("u1", "b")
+    stats = coalescer.stats()
+    assert stats["dropped_batches"] == 1 and stats["dropped_messages"] == 2
+
+
+def test_timers_share_one_scheduler_thread():
+    collector = Collector()
+    coalescer = MessageCoalescer(collector, window=10, max_wait=10, name="test-coalescer")
+    for i in range(20):
+        coalescer.add(f"u{i}", i)
+    names = [thread.name for thread in threading.enumerate()]
+    assert names.count("test-coalescer") == 1
+    coalescer.flush_all()
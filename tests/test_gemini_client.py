@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from gemini_client import CallPolicy, CircuitBreaker, GeminiCallError, GeminiCaller, is_retryable
+
+
+def _caller(policies, **kwargs):
+    return GeminiCaller(policies, sleep=lambda seconds: None, rng=lambda: 0.0, **kwargs)
+
+
+def test_only_transient_errors_are_retryable():
+    assert is_retryable(TimeoutError())
+    assert is_retryable(ConnectionError())
+    assert not is_retryable(ValueError())
+
+
+def test_breaker_opens_then_lets_one_trial_through():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, open_seconds=10, clock=lambda: now[0])
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    now[0] = 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+    # 試行が失敗すれば開き直す
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_request_errors_are_not_retried_or_counted_by_the_breaker():
+    caller = _caller({"a": CallPolicy(breaker_failures=1, fallback_model="b")})
+    calls = []
+
+    def attempt(model_name, remaining):
+        calls.append(model_name)
+        raise ValueError("bad request")
+
+    with pytest.raises(GeminiCallError):
+        caller.call("a", attempt)
+    assert calls == ["a"]
+    assert caller.stats()["a"]["breaker"] == CircuitBreaker.CLOSED
+
+
+def test_transient_errors_retry_then_fall_back():
+    caller = _caller({"a": CallPolicy(max_retries=1, breaker_failures=5, fallback_model="b")})
+    calls = []
+
+    def attempt(model_name, remaining):
+        calls.append(model_name)
+        if model_name == "a":
+            raise ConnectionError("unavailable")
+        return "ok"
+
+    assert caller.call("a", attempt) == ("ok", "b")
+    assert calls == ["a", "a", "b"]
+    stats = caller.stats()["a"]
+    assert stats["failures"] == 2 and stats["retries"] == 1
+
+
+def test_open_breaker_short_circuits_to_fallback():
+    caller = _caller({"a": CallPolicy(max_retries=0, breaker_failures=1, fallback_model="b")})
+    caller.call("a", lambda model_name, remaining: _fail_on(model_name, "a"))
+    calls = []
+
+    def attempt(model_name, remaining):
+        calls.append(model_name)
+        return "ok"
+
+    assert caller.call("a", attempt) == ("ok", "b")
+    assert calls == ["b"]
+    assert caller.stats()["a"]["short_circuited"] == 1
+
+
+def _fail_on(model_name, failing):
+    if model_name == failing:
+        raise ConnectionError("unavailable")
+    return "ok"
+
+
+def test_hedge_wins_and_slow_primary_is_tracked_until_it_finishes():
+    caller = _caller({"a": CallPolicy(hedge=True, hedge_min_samples=1, deadline=5)}, max_workers=1)
+    caller.latency("a").record(0.01)
+    release = threading.Event()
+    calls = []
+
+    def attempt(model_name, remaining):
+        calls.append(model_name)
+        if len(calls) == 1:
+            release.wait(5)
+            return "slow"
+        return "hedged"
+
+    assert caller.call("a", attempt) == ("hedged", "a")
+    stats = caller.stats()["a"]
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+    assert stats["abandoned_calls"] == 1 and stats["abandoned_in_flight"] == 1
+
+    release.set()
+    caller.shutdown()
+    for _ in range(100):
+        if caller.stats()["a"]["abandoned_in_flight"] == 0:
+            break
+        time.sleep(0.01)
+    assert caller.stats()["a"]["abandoned_in_flight"] == 0
+
+
+def test_waiting_for_a_free_thread_is_not_counted_as_a_failure():
+    caller = _caller({"a": CallPolicy(deadline=0.1, max_retries=0, breaker_failures=2)}, max_workers=1)
+    release = threading.Event()
+
+    # 1本目は期限切れで失敗し、終わるまでスレッドを使い続ける
+    with pytest.raises(GeminiCallError):
+        caller.call("a", lambda model_name, remaining: release.wait(5))
+    # 2本目はスレッドが空かないまま期限が切れる
+    with pytest.raises(GeminiCallError):
+        caller.call("a", lambda model_name, remaining: "ok")
+    release.set()
+
+    stats = caller.stats()["a"]
+    assert stats["failures"] == 1
+    assert stats["queue_timeouts"] == 1
+    assert stats["breaker"] == CircuitBreaker.CLOSED
+    caller.shutdown()
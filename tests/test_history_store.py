@@ -0,0 +1,98 @@
+from history_store import HistoryRing, HistoryStore, fit_history_to_budget
+
+
+def _ring(turns, capacity=10):
+    ring = HistoryRing(capacity)
+    for role, text in turns:
+        ring.append(role, text)
+    return ring
+
+
+def _texts(turns):
+    return [turn.text for turn in turns]
+
+
+def test_ring_overwrites_oldest_turn():
+    ring = _ring([("user", "a"), ("model", "bb"), ("user", "ccc")], capacity=2)
+    assert _texts(ring) == ["bb", "ccc"]
+    assert ring.total_chars == 5
+    assert _texts(reversed(ring)) == ["ccc", "bb"]
+    assert ring.popleft().text == "bb"
+    assert len(ring) == 1
+
+
+def test_ring_round_trips_through_list():
+    ring = _ring([("user", "こんにちは"), ("model", "やあ")])
+    restored = HistoryRing.from_list(ring.to_list(), capacity=10)
+    assert [(turn.role, turn.text) for turn in restored] == [("user", "こんにちは"), ("model", "やあ")]
+
+
+def test_newest_within_after_overwrites_and_pops():
+    ring = _ring([("user", "1"), ("model", "22"), ("user", "333"), ("model", "4444"), ("user", "55555")], capacity=4)
+    ring.popleft()
+    ring.append("model", "666666")
+    # 保持しているのは 333 / 4444 / 55555 / 666666
+    assert ring.newest_within(18) == 4
+    # 新しい3ターン（15文字）は入るが、先頭がmodelになるので2ターンにする
+    assert ring.newest_within(17) == 2
+    assert ring.newest_within(11) == 2
+    # 新しい1ターンだけではmodelから始まる
+    assert ring.newest_within(10) == 0
+    assert ring.newest_within(0) == 0
+
+
+def test_fit_history_keeps_newest_turns_without_mutating():
+    ring = _ring([("user", "1111"), ("model", "2222"), ("user", "3333"), ("model", "4444")])
+    window = fit_history_to_budget(ring, char_budget=10, reserve_chars=2)
+    # 残り8文字に収まる新しい2ターン
+    assert _texts(window) == ["3333", "4444"]
+    assert len(window) == 2
+    # 履歴そのものは減らない
+    assert len(ring) == 4
+    assert _texts(fit_history_to_budget(ring, char_budget=100)) == ["1111", "2222", "3333", "4444"]
+
+
+def test_fit_history_does_not_start_with_model_turn():
+    ring = _ring([("user", "1111"), ("model", "2222"), ("user", "3333"), ("model", "4444")])
+    # 新しい3ターン分（12文字）は入るが、先頭がmodelになるので2ターンにする
+    assert _texts(fit_history_to_budget(ring, char_budget=12)) == ["3333", "4444"]
+
+
+def test_fit_history_pins_summary_within_budget():
+    ring = _ring([("user", "1111"), ("model", "2222"), ("user", "3333"), ("model", "4444")])
+    unpinned = fit_history_to_budget(ring, char_budget=30)
+    pinned = fit_history_to_budget(ring, char_budget=30, pinned_summary="記憶")
+    turns = list(pinned)
+    assert turns[0].role == "user" and turns[0].text.endswith("記憶")
+    assert turns[1].role == "model"
+    assert len(pinned) == len(turns)
+    # 要約の分だけ履歴のターンが減る
+    assert len(turns) - 2 < len(unpinned)
+
+
+def test_store_evicts_least_recently_used():
+    store = HistoryStore(max_conversations=2, sizer=lambda value: 0)
+    store["a"] = 1
+    store["b"] = 2
+    assert store.get("a") == 1
+    store["c"] = 3
+    assert "b" not in store
+    assert store.get("a") == 1 and store.get("c") == 3
+    assert sorted(store.keys()) == ["a", "c"]
+
+
+def test_store_expires_idle_entries():
+    now = [0.0]
+    store = HistoryStore(idle_ttl=10, sizer=lambda value: 0, clock=lambda: now[0])
+    store["a"] = 1
+    now[0] = 11.0
+    assert store.get("a") is None
+    assert store.stats()["expirations"] == 1
+
+
+def test_store_enforces_byte_budget():
+    store = HistoryStore(max_bytes=100, sizer=lambda value: value)
+    store["a"] = 60
+    store["b"] = 60
+    assert "a" not in store
+    assert "b" in store
@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import time
+
+from keyed_lock import AsyncKeyedLocks, KeyedLocks
+
+
+def test_same_key_is_serialized_and_released():
+    locks = KeyedLocks()
+    inside = []
+    overlaps = []
+
+    def worker():
+        with locks.hold("a"):
+            inside.append(1)
+            if len(inside) > 1:
+                overlaps.append(1)
+            time.sleep(0.005)
+            inside.pop()
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = locks.stats()
+    assert overlaps == []
+    assert stats["acquisitions"] == 5
+    assert stats["active_keys"] == 0
+
+
+def test_different_keys_do_not_block():
+    locks = KeyedLocks()
+    entered = threading.Event()
+
+    def other():
+        with locks.hold("b"):
+            entered.set()
+
+    with locks.hold("a"):
+        thread = threading.Thread(target=other)
+        thread.start()
+        assert entered.wait(1.0)
+        thread.join()
+    assert locks.stats()["contended"] == 0
+
+
+def test_lock_is_released_when_block_raises():
+    locks = KeyedLocks()
+    try:
+        with locks.hold("a"):
+            raise ValueError
+    except ValueError:
+        pass
+    with locks.hold("a"):
+        pass
+    assert locks.stats()["active_keys"] == 0
+
+
+def test_async_locks_serialize_same_key():
+    async def main():
+        locks = AsyncKeyedLocks()
+        order = []
+
+        async def worker(name):
+            async with locks.hold("a"):
+                order.append(("start", name))
+                await asyncio.sleep(0.005)
+                order.append(("end", name))
+
+        await asyncio.gather(worker(1), worker(2), worker(3))
+        return order, locks.stats()
+
+    order, stats = asyncio.run(main())
+    # 開始と終了が交互に並ぶ（同時に2つ入らない）
+    assert [kind for kind, _ in order] == ["start", "end"] * 3
+    assert stats["contended"] == 2
+    assert stats["active_keys"] == 0
+
+
+def test_hold_async_shares_the_thread_lock_without_blocking_the_loop():
+    locks = KeyedLocks()
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold_in_thread():
+        with locks.hold("a"):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold_in_thread)
+    thread.start()
+    held.wait(5)
+
+    async def main():
+        ticks = 0
+
+        async def waiter():
+            async with locks.hold_async("a"):
+                return ticks
+
+        task = asyncio.ensure_future(waiter())
+        # 待っている間もイベントループは動き続ける
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+            ticks += 1
+        release.set()
+        return await task
+
+    assert asyncio.run(main()) == 5
+    thread.join()
+    assert locks.stats()["active_keys"] == 0
+
+
+def test_hold_async_releases_when_cancelled_while_waiting():
+    locks = KeyedLocks()
+    release = threading.Event()
+    held = threading.Event()
+
+    def hold_in_thread():
+        with locks.hold("a"):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold_in_thread)
+    thread.start()
+    held.wait(5)
+
+    async def main():
+        async def waiter():
+            async with locks.hold_async("a"):
+                pass
+
+        task = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        release.set()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # 待機中のスレッドが取ったロックは、キャンセル後に手放される
+        for _ in range(100):
+            if locks.stats()["active_keys"] == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    thread.join()
+    assert locks.stats()["active_keys"] == 0
+    with locks.hold("a"):
+        pass
@@ -0,0 +1,83 @@
+import pytest
+
+pytest.importorskip("linebot")
+
+from linebot.exceptions import LineBotApiError  # noqa: E402
+from linebot.models.error import Error  # noqa: E402
+
+from line_delivery import ReplyDelivery, is_invalid_reply_token  # noqa: E402
+
+
+class FakeEvent:
+    def __init__(self, reply_token, timestamp=0):
+        self.reply_token = reply_token
+        self.timestamp = timestamp
+
+
+class FakeApi:
+    def __init__(self, reply_error=None):
+        self.reply_error = reply_error
+        self.sent = []
+
+    def reply_message(self, reply_token, messages):
+        if self.reply_error is not None:
+            raise self.reply_error
+        self.sent.append(("reply", reply_token))
+
+    def push_message(self, to, messages):
+        self.sent.append(("push", to))
+
+
+def _api_error(status_code, message):
+    return LineBotApiError(status_code, {}, error=Error(message=message))
+
+
+def _delivery(api, now=100.0):
+    return ReplyDelivery(api, token_ttl=50, safety_margin=2, clock=lambda: now)
+
+
+def test_fresh_token_is_used_for_reply():
+    api = FakeApi()
+    delivery = _delivery(api)
+    event = FakeEvent("t1")
+    delivery.mark_received([event], received_at=90.0)
+    assert delivery.send("U1", [event], "hi") == "reply"
+    assert api.sent == [("reply", "t1")]
+
+
+def test_expired_token_is_pushed_without_trying_reply():
+    api = FakeApi()
+    delivery = _delivery(api)
+    event = FakeEvent("t1")
+    delivery.mark_received([event], received_at=40.0)
+    assert delivery.send("U1", [event], "hi") == "push"
+    assert api.sent == [("push", "U1")]
+    assert delivery.stats()["pushed_token_expired"] == 1
+
+
+def test_invalid_reply_token_falls_back_to_push():
+    api = FakeApi(reply_error=_api_error(400, "Invalid reply token"))
+    delivery = _delivery(api)
+    event = FakeEvent("t1")
+    delivery.mark_received([event], received_at=90.0)
+    assert delivery.send("U1", [event], "hi") == "push"
+    assert api.sent == [("push", "U1")]
+    assert delivery.stats()["pushed_after_reply_error"] == 1
+
+
+@pytest.mark.parametrize("status_code, message", [(500, "Internal error"), (400, "The request body has 1 error(s)")])
+def test_other_reply_errors_are_raised_without_push(status_code, message):
+    api = FakeApi(reply_error=_api_error(status_code, message))
+    delivery = _delivery(api)
+    event = FakeEvent("t1")
+    delivery.mark_received([event], received_at=90.0)
+    with pytest.raises(LineBotApiError):
+        delivery.send("U1", [event], "hi")
+    assert api.sent == []
+    assert delivery.stats()["reply_failed"] == 1
+
+
+def test_invalid_reply_token_detection():
+    assert is_invalid_reply_token(_api_error(400, "Invalid reply token"))
+    assert not is_invalid_reply_token(_api_error(400, "Invalid request"))
+    assert not is_invalid_reply_token(_api_error(503, "Invalid reply token"))
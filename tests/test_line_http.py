@@ -0,0 +1,71 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("linebot")
+
+from line_http import PooledHttpClient, create_line_http_client_factory  # noqa: E402
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_POST(self):
+        self.connections.add(self.client_address)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _Handler.connections = set()
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_requests_reuse_one_pooled_connection(server):
+    client = PooledHttpClient(timeout=5)
+    for i in range(3):
+        response = client.post(server, data=str(i))
+        assert response.status_code == 200 and response.text == str(i)
+    stats = client.stats()
+    assert stats["requests"] == 3
+    assert stats["connections_opened"] == 1
+    assert stats["connection_reuse_rate"] == pytest.approx(2 / 3, abs=1e-3)
+    assert len(_Handler.connections) == 1
+    client.close()
+
+
+def test_keep_alive_off_opens_a_connection_per_request(server):
+    client = PooledHttpClient(timeout=5, keep_alive=False)
+    for i in range(3):
+        client.post(server, data=str(i))
+    assert len(_Handler.connections) == 3
+    client.close()
+
+
+def test_close_releases_pooled_connections(server):
+    client = PooledHttpClient(timeout=5)
+    client.post(server, data="x")
+    client.close()
+    assert client.stats()["connections_opened"] == 0
+
+
+def test_factory_falls_back_to_http11_without_http2_support(monkeypatch):
+    monkeypatch.setenv("LINE_HTTP_POOL_SIZE", "4")
+    monkeypatch.setattr("line_http._http2_available", lambda: False)
+    client = create_line_http_client_factory(http2=True)(timeout=5)
+    assert isinstance(client, PooledHttpClient)
+    client.close()
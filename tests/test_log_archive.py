@@ -0,0 +1,98 @@
+import os
+
+from log_archive import LogArchive
+from session_model import LogEntry
+
+
+def _entries(start, count):
+    return [LogEntry("user", f"message {i}", f"2026-01-01 00:00:{i:02d}") for i in range(start, start + count)]
+
+
+def _contents(entries):
+    return [entry.content for entry in entries]
+
+
+def test_directory_is_created_on_first_append(tmp_path):
+    directory = tmp_path / "archive"
+    archive = LogArchive(str(directory))
+    assert not directory.exists()
+    assert archive.tail("c1", 5) == []
+
+    assert archive.append("c1", _entries(0, 2)) == 2
+    assert directory.is_dir()
+    assert _contents(archive.tail("c1", 5)) == ["message 0", "message 1"]
+
+
+def test_client_id_is_escaped_in_file_name(tmp_path):
+    archive = LogArchive(str(tmp_path))
+    archive.append("../group/1", _entries(0, 1))
+    assert os.path.dirname(archive.path("../group/1")) == str(tmp_path)
+    assert _contents(archive.tail("../group/1", 1)) == ["message 0"]
+
+
+def test_partial_tail_is_ignored_and_truncated_before_next_append(tmp_path):
+    archive = LogArchive(str(tmp_path))
+    archive.append("c1", _entries(0, 3))
+    path = archive.path("c1")
+    # 書き込み途中で止まったレコード（見出しだけで本文がない）
+    with open(path, "ab") as f:
+        f.write(b"\x00\x00\x01\x00\xde\xad")
+
+    assert _contents(archive.tail("c1", 10)) == ["message 0", "message 1", "message 2"]
+    assert _contents(archive.read("c1")) == ["message 0", "message 1", "message 2"]
+
+    archive.append("c1", _entries(3, 1))
+    assert archive.stats()["truncated_tails"] == 1
+    assert _contents(archive.read("c1")) == ["message 0", "message 1", "message 2", "message 3"]
+
+
+def test_tail_across_index_checkpoints(tmp_path):
+    # 10件は索引済み（間隔4）、続く3件は索引の後ろ
+    LogArchive(str(tmp_path), index_stride=4, compact_bytes=1).append("c1", _entries(0, 10))
+    archive = LogArchive(str(tmp_path), index_stride=4, compact_bytes=1 << 20)
+    archive.append("c1", _entries(10, 3))
+    assert archive.stats()["index_compactions"] == 0
+
+    expected = _contents(_entries(0, 13))
+    for count in range(1, 16):
+        assert _contents(archive.tail("c1", count)) == expected[-count:]
+
+
+def test_tail_ignores_index_with_other_stride(tmp_path):
+    LogArchive(str(tmp_path), index_stride=4, compact_bytes=1).append("c1", _entries(0, 9))
+    archive = LogArchive(str(tmp_path), index_stride=8)
+    assert _contents(archive.tail("c1", 6)) == _contents(_entries(3, 6))
+
+
+def test_reading_stops_at_corrupt_record(tmp_path):
+    archive = LogArchive(str(tmp_path))
+    archive.append("c1", _entries(0, 3))
+    path = archive.path("c1")
+    with open(path, "r+b") as f:
+        data = f.read()
+        # 2件目の本文の1バイトを書き換える（CRCが合わなくなる）
+        f.seek(data.index(b"message 1"))
+        f.write(b"X")
+
+    # チェックサムの合わないレコードは書き込み途中の末尾と同じ扱いで、そこから後ろは読まない
+    assert _contents(archive.tail("c1", 3)) == ["message 0"]
+    assert _contents(archive.read("c1")) == ["message 0"]
+
+
+def test_record_dropped_is_reported(tmp_path):
+    archive = LogArchive(str(tmp_path))
+    archive.record_dropped(5)
+    assert archive.stats()["entries_dropped"] == 5
+
+
+def test_tail_up_to_recorded_size_ignores_later_appends(tmp_path):
+    archive = LogArchive(str(tmp_path), index_stride=2, compact_bytes=1)
+    archive.append("c1", _entries(0, 3))
+    size = archive.size("c1")
+    # 記録した後の追記で索引も作り直され、索引の範囲が size より後ろまで伸びる
+    archive.append("c1", _entries(3, 2))
+
+    assert _contents(archive.tail("c1", 2, end=size)) == ["message 1", "message 2"]
+    assert _contents(archive.tail("c1", 10, end=size)) == ["message 0", "message 1", "message 2"]
+    assert _contents(archive.tail("c1", 2)) == ["message 3", "message 4"]
+    assert archive.size("missing") == 0
@@ -0,0 +1,130 @@
+import asyncio
+
+import memory
+from keyed_lock import KeyedLocks
+from log_archive import LogArchive
+from session_model import ConversationLogs, LogEntry, SessionRecord, VeryLongLog
+
+
+class FakeModel:
+    """要約の依頼を記録し、決まった要約を返す"""
+
+    def __init__(self, fail=False):
+        self.requests = []
+        self.fail = fail
+
+    async def __call__(self, a_client, user_msg, system_prompt):
+        self.requests.append(user_msg)
+        if self.fail:
+            raise RuntimeError("model unavailable")
+        return f"summary {len(self.requests)}"
+
+
+def _add_turn(record, text, timestamp="2026-01-01 10:00:00"):
+    record.logs.very_long_log.append(LogEntry("user", text, timestamp))
+    record.logs.very_long_log.append(LogEntry("assistant", "reply to " + text, timestamp))
+
+
+def _process(store, model, current_date="2026-01-01", **kwargs):
+    asyncio.run(memory.process_conversation_memory(
+        "c1", store, KeyedLocks(), model, "model", current_date=current_date, **kwargs
+    ))
+
+
+def test_short_memories_are_updated_incrementally_from_cursor():
+    record = SessionRecord(last_activity="2026-01-01 09:00:00")
+    store = {"c1": record}
+    model = FakeModel()
+
+    _add_turn(record, "first")
+    _process(store, model)
+    assert record.memory.summary_cursor == 2
+    assert record.memory.summary_updates == 0
+    assert record.memory.short_memories.endswith("summary 1")
+
+    _add_turn(record, "second")
+    _process(store, model)
+    incremental = model.requests[-1]
+    # 反映済みのログは送らず、既存の要約に新しいログだけを反映する
+    assert "second" in incremental and "first" not in incremental
+    assert "summary 1" in incremental
+    assert record.memory.summary_cursor == 4
+    assert record.memory.summary_updates == 1
+
+    # 新しいログがなければモデルを呼ばない
+    _process(store, model)
+    assert len(model.requests) == 2
+
+
+def test_short_memories_are_rebuilt_after_rebuild_every_updates():
+    record = SessionRecord(last_activity="2026-01-01 09:00:00")
+    store = {"c1": record}
+    model = FakeModel()
+    for i in range(3):
+        _add_turn(record, f"turn{i}")
+        _process(store, model, rebuild_every=2)
+
+    _add_turn(record, "turn3")
+    _process(store, model, rebuild_every=2)
+    rebuild = model.requests[-1]
+    assert "turn0" in rebuild and "turn3" in rebuild
+    assert record.memory.summary_updates == 0
+
+
+def test_archived_logs_are_read_after_releasing_the_client_lock(tmp_path):
+    locks = KeyedLocks()
+    archive = LogArchive(str(tmp_path))
+    record = SessionRecord(
+        last_activity="2026-01-01 09:00:00",
+        logs=ConversationLogs(very_long_log=VeryLongLog(retention=2)),
+    )
+    for i in range(3):
+        _add_turn(record, f"turn{i}")
+    archive.append("c1", record.logs.very_long_log.spilled)
+    record.logs.very_long_log.clear_spilled()
+
+    class CheckingArchive:
+        def size(self, client_id):
+            return archive.size(client_id)
+
+        def tail(self, client_id, count, end=None):
+            assert locks.stats()["active_keys"] == 0
+            # ロックを外した後に別の会話が書き出した分は、今回の要約には含めない
+            archive.append(client_id, [LogEntry("user", "later", "2026-01-01 11:00:00")])
+            return archive.tail(client_id, count, end=end)
+
+    model = FakeModel()
+    asyncio.run(memory.process_conversation_memory(
+        "c1", {"c1": record}, locks, model, "model", current_date="2026-01-01", archive=CheckingArchive()
+    ))
+    request = model.requests[-1]
+    assert "turn0" in request and "turn2" in request
+    assert "later" not in request
+
+
+def test_unfinished_rollover_is_kept_and_resumed():
+    record = SessionRecord(last_activity="2026-01-01 22:00:00")
+    record.memory.short_memories = "yesterday"
+    record.logs.long_log.append("old weeks")
+    store = {"c1": record}
+
+    asyncio.run(memory.check_and_handle_date_change(
+        "c1", store, KeyedLocks(), FakeModel(fail=True), "model", "2026-01-02"
+    ))
+    # 要約に失敗しても、移動は済ませて未完了の階層を記録する
+    assert record.memory.rollover_date == "2026-01-02"
+    assert list(record.logs.mid_log) == ["\nyesterday"]
+    assert record.memory.rollover_pending == ["long", "mid"]
+
+    # 再起動後（保存した形式から復元）に登録し直すと、midLogに二重に移さずに要約だけを作る
+    restored = SessionRecord.from_dict(record.to_dict())
+    store = {"c1": restored}
+    model = FakeModel()
+    asyncio.run(memory.check_and_handle_date_change("c1", store, KeyedLocks(), model, "model", "2026-01-02"))
+    assert restored.memory.rollover_pending == []
+    assert list(restored.logs.mid_log) == ["\nyesterday"]
+    assert restored.memory.long_memories.endswith("summary 1")
+    assert restored.memory.mid_memories.endswith("summary 2")
+
+    asyncio.run(memory.check_and_handle_date_change("c1", store, KeyedLocks(), model, "model", "2026-01-02"))
+    assert len(model.requests) == 2
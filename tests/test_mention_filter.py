@@ -0,0 +1,44 @@
+import pytest
+
+from mention_filter import MentionFilter
+
+
+def _event(source_type, text=None, event_type="message", message_type="text"):
+    event = {"type": event_type, "source": {"type": source_type}}
+    if event_type == "message":
+        event["message"] = {"type": message_type, "text": text or ""}
+    return event
+
+
+def test_user_chats_are_always_kept():
+    mention_filter = MentionFilter(["あだT"])
+    assert mention_filter.is_relevant(_event("user", "こんにちは"))
+    assert mention_filter.is_relevant(_event("user", event_type="follow"))
+
+
+@pytest.mark.parametrize("source_type", ["group", "room"])
+def test_group_messages_need_a_mention(source_type):
+    mention_filter = MentionFilter(["あだT", "あだおか"])
+    assert mention_filter.is_relevant(_event(source_type, "ねえあだTどう思う？"))
+    assert mention_filter.is_relevant(_event(source_type, "あだおか、おはよう"))
+    assert not mention_filter.is_relevant(_event(source_type, "今日は雨だね"))
+    assert not mention_filter.is_relevant(_event(source_type, "あだT", message_type="sticker"))
+    assert not mention_filter.is_relevant(_event(source_type, event_type="join"))
+
+
+def test_filter_events_counts_dropped_events():
+    mention_filter = MentionFilter(["あだT"])
+    events = [_event("group", "あだT"), _event("group", "雑談"), _event("user", "雑談")]
+    assert mention_filter.filter_events(events) == [events[0], events[2]]
+    stats = mention_filter.stats()
+    assert stats["events_seen"] == 3 and stats["events_dropped"] == 1
+
+
+def test_names_come_from_env_and_blank_aliases_are_ignored(monkeypatch):
+    monkeypatch.setenv("BOT_MENTION_NAME", "ボット")
+    monkeypatch.setenv("BOT_MENTION_ALIASES", "bot, ,ボット")
+    mention_filter = MentionFilter.from_env()
+    assert mention_filter.names == ["ボット", "bot"]
+    assert mention_filter.matches("hey bot")
+    with pytest.raises(ValueError):
+        MentionFilter([" ", ""])
@@ -0,0 +1,53 @@
+import pytest
+
+from model_registry import ModelRegistry
+
+
+def _registry(max_models=2):
+    created = []
+
+    def factory(model_name, system_prompt):
+        created.append((model_name, system_prompt))
+        return object()
+
+    registry = ModelRegistry(factory, {"2.0": "flash", "1.5": "pro"}, default_version="2.0", max_models=max_models)
+    return registry, created
+
+
+def test_models_are_created_once_per_name_and_prompt():
+    registry, created = _registry()
+    model = registry.get("flash", "p")
+    assert registry.get("flash", "p") is model
+    assert created == [("flash", "p")]
+    assert registry.stats()["hits"] == 1
+
+
+def test_least_recently_used_model_is_evicted():
+    registry, created = _registry(max_models=2)
+    a = registry.get("flash", "a")
+    registry.get("flash", "b")
+    # a を使ったので、次に追い出されるのは b
+    assert registry.get("flash", "a") is a
+    registry.get("flash", "c")
+    assert registry.stats()["cached_models"] == 2
+
+    assert registry.get("flash", "a") is a
+    registry.get("flash", "b")
+    assert created == [("flash", "a"), ("flash", "b"), ("flash", "c"), ("flash", "b")]
+
+
+def test_changing_a_persona_prompt_drops_its_models():
+    registry, created = _registry()
+    registry.register_persona("adoka", "old")
+    name, old_model = registry.for_persona("adoka", "2.0")
+    assert name == "flash"
+    registry.register_persona("adoka", "new")
+    assert registry.stats()["cached_models"] == 0
+    assert registry.for_persona("adoka", "2.0")[1] is not old_model
+
+
+def test_unknown_version_uses_the_default():
+    registry, _ = _registry()
+    assert registry.resolve_model_name("9.9") == "flash"
+    with pytest.raises(ValueError):
+        registry.set_model_versions({"1.5": "pro"})
@@ -0,0 +1,88 @@
+import threading
+
+from reply_worker import ReplyWorkerPool
+
+
+class BlockingHandler:
+    """release されるまで処理を止めておくハンドラ"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.handled = []
+
+    def __call__(self, item):
+        self.started.set()
+        self.release.wait(5)
+        self.handled.append(item)
+
+
+def test_full_queue_rejects_without_waiting():
+    handler = BlockingHandler()
+    pool = ReplyWorkerPool(handler, num_workers=1, max_queue_size=2)
+    assert pool.submit("busy")
+    handler.started.wait(5)
+    assert pool.submit("q1") and pool.submit("q2")
+    assert not pool.submit("q3")
+
+    metrics = pool.metrics()
+    assert metrics["rejected"] == 1 and metrics["queue_depth"] == 2
+    handler.release.set()
+    pool.shutdown(5)
+
+
+def test_submit_all_admits_all_or_nothing():
+    handler = BlockingHandler()
+    pool = ReplyWorkerPool(handler, num_workers=1, max_queue_size=3)
+    pool.submit("busy")
+    handler.started.wait(5)
+    assert pool.submit_all(["a", "b"])
+    # 空きは1件なので、2件まとめては1件も投入しない
+    assert not pool.submit_all(["c", "d"])
+    assert pool.queue_depth() == 2
+    # キューの容量を超える件数は空きを待たずに拒否する
+    assert not pool.submit_all(["x"] * 4)
+    assert pool.metrics()["rejected"] == 6
+
+    handler.release.set()
+    pool.shutdown(5)
+    assert handler.handled == ["busy", "a", "b"]
+
+
+def test_submit_all_waits_for_space_up_to_the_timeout():
+    handler = BlockingHandler()
+    pool = ReplyWorkerPool(handler, num_workers=1, max_queue_size=1, enqueue_timeout=2)
+    pool.submit("busy")
+    handler.started.wait(5)
+    pool.submit("queued")
+    # ワーカーが進めば空きができて投入できる
+    threading.Timer(0.05, handler.release.set).start()
+    assert pool.submit_all(["late"])
+    pool.shutdown(5)
+    assert handler.handled == ["busy", "queued", "late"]
+
+
+def test_shutdown_drains_queued_events_and_refuses_new_ones():
+    handled = []
+    pool = ReplyWorkerPool(handled.append, num_workers=2, max_queue_size=10)
+    assert pool.submit_all(range(5))
+    assert pool.shutdown(5)
+    assert sorted(handled) == [0, 1, 2, 3, 4]
+    assert not pool.submit(5)
+    metrics = pool.metrics()
+    assert metrics["processed"] == 5 and metrics["closed"]
+
+
+def test_handler_errors_are_counted_and_do_not_stop_the_worker():
+    handled = []
+
+    def handler(item):
+        if item == "bad":
+            raise ValueError(item)
+        handled.append(item)
+
+    pool = ReplyWorkerPool(handler, num_workers=1, max_queue_size=10)
+    pool.submit_all(["bad", "good"])
+    pool.shutdown(5)
+    assert handled == ["good"]
+    assert pool.metrics()["failed"] == 1
@@ -0,0 +1,76 @@
+import asyncio
+import datetime
+
+from rollover_sweeper import RolloverSweeper
+
+
+def _at(hour):
+    return datetime.datetime(2026, 1, 2, hour, 30)
+
+
+def _sweeper(clients, rolled, now, checkpoint_path=None, **kwargs):
+    async def roll_client(client_id, current_date):
+        rolled.append(client_id)
+        return True
+
+    return RolloverSweeper(
+        list_clients=lambda: list(clients),
+        roll_client=roll_client,
+        checkpoint_path=checkpoint_path,
+        rate_per_second=0,
+        now=lambda: now[0],
+        **kwargs,
+    )
+
+
+def test_window_is_start_inclusive_and_end_exclusive():
+    sweeper = _sweeper([], [], [_at(0)], start_hour=3, end_hour=5)
+    assert [hour for hour in range(24) if sweeper.in_window(_at(hour))] == [3, 4]
+
+
+def test_window_can_wrap_past_midnight():
+    sweeper = _sweeper([], [], [_at(0)], start_hour=23, end_hour=2)
+    assert [hour for hour in range(24) if sweeper.in_window(_at(hour))] == [0, 1, 23]
+
+
+def test_sweep_resumes_from_checkpoint_after_leaving_the_window(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    clients = ["c1", "c2", "c3", "c4"]
+    now = [_at(3)]
+    rolled = []
+
+    async def roll_client(client_id, current_date):
+        rolled.append(client_id)
+        if client_id == "c2":
+            # 2件目を処理したところで時間帯を過ぎる
+            now[0] = _at(5)
+        return True
+
+    sweeper = RolloverSweeper(lambda: list(clients), roll_client, checkpoint_path=path, rate_per_second=0, now=lambda: now[0])
+    assert asyncio.run(sweeper.sweep("2026-01-02")) is False
+    assert rolled == ["c1", "c2"]
+
+    # 再起動後は同じ日のうちなら続きから処理する
+    now[0] = _at(4)
+    rolled.clear()
+    resumed = _sweeper(clients, rolled, now, checkpoint_path=path)
+    assert asyncio.run(resumed.sweep("2026-01-02")) is True
+    assert rolled == ["c3", "c4"]
+    assert resumed.stats()["checkpoint"] == {"date": "2026-01-02", "last_client_id": "c4", "done": 4, "completed": True}
+
+    # 完了した日はもう巡回しない
+    rolled.clear()
+    assert asyncio.run(_sweeper(clients, rolled, now, checkpoint_path=path).sweep("2026-01-02")) is True
+    assert rolled == []
+
+
+def test_checkpoint_from_another_day_starts_over(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    clients = ["c1", "c2"]
+    now = [_at(3)]
+    rolled = []
+    asyncio.run(_sweeper(clients, rolled, now, checkpoint_path=path).sweep("2026-01-02"))
+
+    rolled.clear()
+    assert asyncio.run(_sweeper(clients, rolled, now, checkpoint_path=path).sweep("2026-01-03")) is True
+    assert rolled == ["c1", "c2"]
@@ -0,0 +1,100 @@
+import pytest
+
+from session_model import LogEntry, SessionFormatError, SessionRecord, VeryLongLog
+
+
+def _log(count, retention=3, offset=0):
+    log = VeryLongLog(offset=offset, retention=retention)
+    for i in range(count):
+        log.append(LogEntry("user", f"m{i}", "2026-01-01 00:00:00"))
+    return log
+
+
+def test_very_long_log_spills_past_retention():
+    log = _log(5)
+    assert [entry.content for entry in log] == ["m2", "m3", "m4"]
+    assert [entry.content for entry in log.spilled] == ["m0", "m1"]
+    assert log.offset == 2
+    assert log.total == 5
+    # 通し番号で指定し、メモリ上にない分は含まない
+    assert [entry.content for entry in log.since(0)] == ["m2", "m3", "m4"]
+    assert [entry.content for entry in log.since(4)] == ["m4"]
+    assert [entry.content for entry in log.tail(2)] == ["m3", "m4"]
+
+
+def test_drop_spilled_keeps_newest():
+    log = _log(6)
+    assert log.drop_spilled(1) == 2
+    assert [entry.content for entry in log.spilled] == ["m2"]
+    assert log.drop_spilled(5) == 0
+    log.clear_spilled()
+    assert log.spilled == []
+
+
+def test_record_round_trips_through_dict():
+    record = SessionRecord(last_activity="2026-01-01 10:00:00")
+    record.memory.short_memories = "short"
+    record.memory.rollover_date = "2026-01-01"
+    record.memory.rollover_pending = ["long", "mid"]
+    record.memory.summary_cursor = 4
+    record.memory.summary_date = "2026-01-01"
+    record.memory.summary_updates = 2
+    record.logs.mid_log.append("day")
+    for i in range(3):
+        record.logs.very_long_log.append(LogEntry("assistant", f"a{i}", "t"))
+
+    data = record.to_dict()
+    restored = SessionRecord.from_dict(data)
+    assert restored.to_dict() == data
+    assert restored.memory.rollover_pending == ["long", "mid"]
+    assert restored.memory.summary_cursor == 4
+
+
+def test_spilled_entries_are_kept_until_archived():
+    record = SessionRecord()
+    record.logs.very_long_log = _log(5)
+    data = record.to_dict()
+    # 書き出すまではあふれた分も含めて保存する
+    assert len(data["long_conversation_logs"]["very_long_log"]) == 5
+    assert "very_long_log_offset" not in data["long_conversation_logs"]
+
+    record.logs.very_long_log.clear_spilled()
+    data = record.to_dict()
+    assert data["long_conversation_logs"]["very_long_log_offset"] == 2
+    restored = SessionRecord.from_dict(data)
+    assert restored.logs.very_long_log.total == 5
+
+
+def test_legacy_formats_are_accepted():
+    record = SessionRecord.from_dict({
+        "memory_store": {"shortMemories": "s"},
+        "long_conversation_logs": {"very_long_log": "old text", "midLog": "one day"},
+    })
+    assert record.memory.short_memories == "s"
+    assert len(record.logs.very_long_log) == 0
+    assert list(record.logs.mid_log) == ["one day"]
+    assert SessionRecord.from_dict(None).last_activity == ""
+
+
+@pytest.mark.parametrize("data", [
+    [],
+    {"last_activity": 1},
+    {"memory_store": []},
+    {"memory_store": {"summary_cursor": "3"}},
+    {"memory_store": {"summary_cursor": True}},
+    {"memory_store": {"rollover_pending": [1]}},
+    {"long_conversation_logs": {"very_long_log": {}}},
+    {"long_conversation_logs": {"very_long_log": [{"role": "user"}]}},
+    {"long_conversation_logs": {"midLog": [1, 2]}},
+])
+def test_malformed_records_raise(data):
+    with pytest.raises(SessionFormatError):
+        SessionRecord.from_dict(data)
+
+
+def test_approx_bytes_grows_with_logs():
+    record = SessionRecord()
+    empty = record.approx_bytes()
+    record.logs.very_long_log.append(LogEntry("user", "あ" * 100, "2026-01-01 00:00:00"))
+    record.memory.short_memories = "い" * 100
+    assert record.approx_bytes() >= empty + 400
@@ -0,0 +1,63 @@
+import io
+import json
+import logging
+import queue
+from logging.handlers import QueueListener
+
+from structured_log import Fields, JsonFormatter, PayloadSampler, _DeferredQueueHandler
+
+
+def _queued_logger(name, formatter):
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = _DeferredQueueHandler(log_queue)
+    logger.addHandler(handler)
+    stream = io.StringIO()
+    output = logging.StreamHandler(stream)
+    output.setFormatter(formatter)
+    listener = QueueListener(log_queue, output)
+    return logger, handler, listener, stream
+
+
+def test_listener_formats_records_with_their_args():
+    logger, handler, listener, stream = _queued_logger("test.structured.text", logging.Formatter("%(message)s"))
+    try:
+        logger.info("summary saved %s chars=%d", Fields(client_id="c1", tier="short"), 42)
+        logger.warning("plain %s", "arg")
+        listener.start()
+    finally:
+        listener.stop()
+        logger.removeHandler(handler)
+    assert stream.getvalue().splitlines() == ["summary saved client_id=c1 tier=short chars=42", "plain arg"]
+
+
+def test_records_are_queued_unformatted():
+    log_queue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    record = logging.LogRecord("x", logging.INFO, __file__, 1, "value=%s", (Fields(a=1),), None)
+    handler.emit(record)
+    queued = log_queue.get_nowait()
+    # 呼び出し元のスレッドでは整形しない
+    assert queued.msg == "value=%s" and isinstance(queued.args[0], Fields)
+
+
+def test_json_formatter_expands_fields():
+    logger, handler, listener, stream = _queued_logger("test.structured.json", JsonFormatter())
+    listener.start()
+    try:
+        logger.info("done %s", Fields(client_id="c1", count=3))
+    finally:
+        listener.stop()
+        logger.removeHandler(handler)
+    data = json.loads(stream.getvalue())
+    assert data["message"] == "done client_id=c1 count=3"
+    assert data["client_id"] == "c1" and data["count"] == 3 and data["level"] == "INFO"
+
+
+def test_payload_sampler_rate_bounds():
+    assert PayloadSampler(1.0).sampled()
+    assert not PayloadSampler(0.0).sampled()
+    assert PayloadSampler(0.5, rng=lambda: 0.4).sampled()
+    assert not PayloadSampler(0.5, rng=lambda: 0.6).sampled()
@@ -0,0 +1,139 @@
+import asyncio
+
+from summary_scheduler import SummaryScheduler
+
+
+def _job(log, name, delay=0.0):
+    async def run():
+        if delay:
+            await asyncio.sleep(delay)
+        log.append(name)
+    return run
+
+
+async def _wait_until(predicate, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not predicate():
+        assert loop.time() < end, "timed out"
+        await asyncio.sleep(0.005)
+
+
+def test_same_client_and_tier_is_deduplicated():
+    async def main():
+        log = []
+        scheduler = SummaryScheduler(max_concurrency=1, rate_per_minute=0)
+        assert scheduler.submit("c1", "short", _job(log, "first"))
+        assert not scheduler.submit("c1", "short", _job(log, "second"))
+        assert scheduler.submit("c2", "short", _job(log, "other"))
+        await _wait_until(lambda: len(log) == 2)
+        await scheduler.drain()
+        return log, scheduler.stats()
+
+    log, stats = asyncio.run(main())
+    # 実行待ちのジョブは新しく登録された方に置き換わる
+    assert log == ["second", "other"]
+    assert stats["deduplicated"] == 1
+    assert stats["completed"] == 2
+
+
+def test_stats_can_be_read_from_another_thread():
+    async def main():
+        log = []
+        scheduler = SummaryScheduler(max_concurrency=1, rate_per_minute=0)
+        scheduler.submit("c1", "short", _job(log, "c1", delay=0.05))
+        scheduler.submit("c2", "short", _job(log, "c2"))
+        scheduler.submit("c3", "long", _job(log, "c3"))
+        await _wait_until(lambda: scheduler.stats()["running"] == 1)
+        stats = await asyncio.to_thread(scheduler.stats)
+        await scheduler.drain()
+        return stats
+
+    stats = asyncio.run(main())
+    assert stats["submitted"] == 3
+    assert stats["pending"] == {"short": 1, "long": 1}
+    assert stats["running"] == 1
+
+
+def test_jobs_run_in_tier_priority_order():
+    async def main():
+        log = []
+        scheduler = SummaryScheduler(max_concurrency=1, rate_per_minute=0)
+        scheduler.submit("c1", "long", _job(log, "long"))
+        scheduler.submit("c1", "mid", _job(log, "mid"))
+        scheduler.submit("c1", "short", _job(log, "short"))
+        await _wait_until(lambda: len(log) == 3)
+        await scheduler.drain()
+        return log
+
+    assert asyncio.run(main()) == ["short", "mid", "long"]
+
+
+def test_concurrency_limit():
+    async def main():
+        running = []
+        peak = []
+
+        def job():
+            async def run():
+                running.append(1)
+                peak.append(len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+            return run
+
+        scheduler = SummaryScheduler(max_concurrency=2, rate_per_minute=0)
+        for i in range(6):
+            scheduler.submit(f"c{i}", "short", job())
+        await _wait_until(lambda: scheduler.stats()["completed"] == 6)
+        await scheduler.drain()
+        return max(peak)
+
+    assert asyncio.run(main()) == 2
+
+
+def test_spread_jobs_wait_until_ready():
+    async def main():
+        log = []
+        scheduler = SummaryScheduler(rate_per_minute=0, spread_window=0.05, rng=lambda: 1.0)
+        scheduler.submit("c1", "mid", _job(log, "mid"), spread=True)
+        await asyncio.sleep(0.01)
+        early = list(log)
+        await _wait_until(lambda: log == ["mid"])
+        await scheduler.drain()
+        return early
+
+    assert asyncio.run(main()) == []
+
+
+def test_on_complete_is_called_after_failures_too():
+    async def main():
+        completed = []
+
+        async def fail():
+            raise RuntimeError("boom")
+
+        scheduler = SummaryScheduler(rate_per_minute=0, on_complete=completed.append)
+        scheduler.submit("c1", "short", fail)
+        await _wait_until(lambda: completed == ["c1"])
+        await scheduler.drain()
+        return scheduler.stats()
+
+    stats = asyncio.run(main())
+    assert stats["failed"] == 1
+    assert stats["completed"] == 0
+
+
+def test_drain_discards_queued_jobs():
+    async def main():
+        log = []
+        scheduler = SummaryScheduler(rate_per_minute=0, spread_window=60, rng=lambda: 1.0)
+        scheduler.submit("c1", "long", _job(log, "long"), spread=True)
+        drained = await scheduler.drain(timeout=0.1)
+        await asyncio.sleep(0.01)
+        return drained, log, scheduler.stats()
+
+    drained, log, stats = asyncio.run(main())
+    assert drained
+    assert log == []
+    assert stats["pending"] == {}